@@ -304,6 +304,21 @@ function init_dom(e) {
     require('selectize');
 
     scope.find('.selectize').selectize()
+    // Selects with server side suggestions, e.g. data-suggest="/suggest?world=eon" answering {suggestions: [{value, text}]}
+    scope.find('.selectize-suggest').each(function () {
+        var url = $(this).data('suggest')
+        $(this).selectize({
+            valueField: 'value',
+            labelField: 'text',
+            searchField: 'text',
+            load: function (query, callback) {
+                if (!query.length) return callback()
+                $.getJSON(url, { q: query })
+                    .done(function (data) { callback(data.suggestions) })
+                    .fail(function () { callback() })
+            }
+        })
+    })
     scope.find('.selectize-tags').selectize({
         delimiter: ',',
         persist: false,
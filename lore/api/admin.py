@@ -19,6 +19,7 @@ from lore.api.resource import (
     ItemResponse,
     ListResponse,
     ResourceAccessPolicy,
+    memoize_authorization,
     ResourceView,
     filterable_fields_parser,
 )
@@ -26,6 +27,7 @@ from lore.extensions import csrf
 from lore.model.world import Shortcut
 from tools.import_textalk import order_default_fields_to_return, product_default_fields_to_return, rpc_get
 from lore.model.shop import Order, OrderStatus, import_order, import_product
+from lore.model.import_topic import import_markdown_topics
 from tools.batch import Job
 
 admin = Blueprint("admin", __name__)
@@ -34,6 +36,7 @@ logger = current_app.logger if current_app else logging.getLogger(__name__)
 
 
 class ShortcutAccessPolicy(ResourceAccessPolicy):
+    @memoize_authorization
     def authorize(self, op, user=None, res=None):
         # TODO temporary translation between old and new op words, e.g. patch vs edit
         op = self.translate.get(op, op)
@@ -249,4 +252,14 @@ def git_webhook(get_json=None):
         except subprocess.CalledProcessError as cpe:
             logger.warning("Error fetching repo for {data}, got {out}".format(data=repo_meta, out=cpe.output))
             return json.dumps({"msg": "Error fetching repo"}), 403
+
+        import_args = current_app.config.get("TOPIC_IMPORT_REPOS", {}).get(path, None)
+        if import_args is not None:
+            # Only files changed since last import are parsed, so this is quick enough to do while GitHub waits
+            try:
+                batch = import_markdown_topics(cwd, commit=True, **import_args)
+                logger.info(f"git_webhook: Imported topics from {path}, {len(batch.jobs)} changed files")
+            except Exception as e:
+                logger.exception(e)  # Also reports to Sentry
+                return json.dumps({"msg": "Error importing topics"}), 500
         return "OK commit {commit} to {path}".format(path=path, **repo_meta)
@@ -8,7 +8,8 @@ from flask import Blueprint, current_app, redirect, url_for, g, request, Respons
 from flask_babel import lazy_gettext as _
 from flask_mongoengine.wtf import model_form
 from mongoengine import NotUniqueError, ValidationError
-from werkzeug.exceptions import abort
+from werkzeug.exceptions import RequestedRangeNotSatisfiable, abort
+from werkzeug.http import is_byte_range_valid, is_resource_modified, parse_range_header
 from werkzeug.utils import secure_filename
 from flask_classy import route
 
@@ -27,10 +28,10 @@ from lore.api.resource import (
     set_theme,
 )
 
-from lore.model.asset import FileAccessType, FileAsset, get_google_urls
+from lore.model.asset import FileAccessType, FileAsset, find_fingerprint_offsets, get_google_urls, iter_chunks
 from lore.model.misc import set_lang_options, filter_is_owner
 from lore.model.shop import products_owned_by_user, user_has_asset
-from lore.model.world import Publisher, filter_authorized_by_publisher
+from lore.model.world import filter_authorized_by_publisher, get_access_scope, ref_id, resolve_publisher_world
 
 logger = current_app.logger if current_app else logging.getLogger(__name__)
 
@@ -45,6 +46,54 @@ def set_cache(rv, cache_timeout):
     return rv
 
 
+def get_byte_ranges(length, etag=None, last_modified=None):
+    """Returns the list of (start, stop) byte ranges requested in the Range header, or None if the full file
+    should be sent. Follows werkzeug's parsing, but also supports multiple ranges.
+
+    :raises: RequestedRangeNotSatisfiable if the Range header can't be parsed or satisfied
+    """
+    if "Range" not in request.headers:
+        return None
+    # If-Range means the client only wants the range if it has the same version of the file as we have
+    if "If-Range" in request.headers and is_resource_modified(
+        request.environ, etag, None, last_modified, ignore_if_range=False
+    ):
+        return None
+    parsed_range = parse_range_header(request.headers["Range"])
+    if parsed_range is None or parsed_range.units != "bytes":
+        raise RequestedRangeNotSatisfiable(length)
+    ranges = []
+    for start, stop in parsed_range.ranges:
+        if stop is None:
+            stop = length
+            if start < 0:
+                start = max(start + length, 0)  # A suffix range longer than the file means the whole file
+        stop = min(stop, length)
+        if not is_byte_range_valid(start, stop, length):
+            raise RequestedRangeNotSatisfiable(length)
+        ranges.append((start, stop))
+    if ranges == [(0, length)]:
+        return None
+    return ranges
+
+
+def multipart_byteranges(stream, ranges, length, mimetype, boundary):
+    """Returns an iterator over a multipart/byteranges body, and the length of that body."""
+    heads = [
+        f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n".encode()
+        for start, stop in ranges
+    ]
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def body():
+        for head, (start, stop) in zip(heads, ranges):
+            yield head
+            yield from stream(start, stop)
+        yield tail
+
+    return body(), sum(map(len, heads)) + len(tail) + sum(stop - start for start, stop in ranges)
+
+
 # Inspiration
 # https://github.com/RedBeard0531/python-gridfs-server/blob/master/gridfs_server.py
 def send_gridfs_file(
@@ -56,6 +105,7 @@ def send_gridfs_file(
     cache_timeout=2628000,
     conditional=True,
     fingerprint_user_id=None,
+    fingerprint_offsets=None,
 ):
     # Default cache timeout is 1 month in seconds
     if not mimetype:
@@ -64,8 +114,9 @@ def send_gridfs_file(
         mimetype = gridfile.content_type
 
     # TODO check that this is in UTC-time
+    length = gridfile.length
     headers = {
-        "Content-Length": gridfile.length,
+        "Content-Length": length,
         "Last-Modified": gridfile.upload_date.strftime("%a, %d %b %Y %H:%M:%S GMT"),
     }  #
     if as_attachment:
@@ -78,21 +129,46 @@ def send_gridfs_file(
         headers["Content-Disposition"] = "attachment; filename*=UTF-8''{quoted_filename}".format(
             quoted_filename=quote(attachment_filename.encode("utf8"))
         )
-    md5 = gridfile.md5  # as we may overwrite gridfile with own iterator, save this
-    if fingerprint_user_id:
-        gridfile = fingerprint_pdf(gridfile, fingerprint_user_id)
-    rv = Response(gridfile, headers=headers, content_type=mimetype, direct_passthrough=True)  # is an iterator
+    md5 = gridfile.md5
+    if fingerprint_user_id and fingerprint_offsets is None:
+        # Find them once, not for every range
+        fingerprint_offsets = find_fingerprint_offsets(gridfile)
+
+    def stream(start=0, stop=None):
+        # Seeks directly to the GridFS chunk where start is, and applies fingerprints if they are within range
+        if fingerprint_user_id:
+            return fingerprint_pdf(gridfile, fingerprint_user_id, fingerprint_offsets, start, stop)
+        return iter_chunks(gridfile, start, stop)
+
+    rv = Response(stream(), headers=headers, content_type=mimetype, direct_passthrough=True)  # is an iterator
     set_cache(rv, cache_timeout)
     if add_etags:
         rv.set_etag(md5)
     if conditional:
-        rv.make_conditional(request)
+        # Only sets Accept-Ranges, as werkzeug can't seek in our stream or send multiple ranges
+        rv.make_conditional(request, accept_ranges=True)
+    if not conditional or rv.status_code != 200 or request.method not in ("GET", "HEAD"):
+        return rv
+
+    ranges = get_byte_ranges(length, md5 if add_etags else None, rv.headers["Last-Modified"])
+    if ranges is None:
+        return rv
+    rv.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        rv.response = stream(start, stop)
+        rv.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+        rv.headers["Content-Length"] = stop - start
+    else:
+        boundary = md5 or str(time()).replace(".", "")
+        rv.response, rv.headers["Content-Length"] = multipart_byteranges(stream, ranges, length, mimetype, boundary)
+        rv.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
     return rv
 
 
 def authorize_and_return(fileasset_slug, as_attachment=False):
     asset = FileAsset.objects(slug=fileasset_slug).first_or_404()
-    publisher = Publisher.objects(slug=g.pub_host).first()
+    publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
     if publisher:
         # For better error pages
         set_theme(g, "publisher", publisher.theme)
@@ -119,16 +195,16 @@ def authorize_and_return(fileasset_slug, as_attachment=False):
         if g.user.admin or user_has_asset(g.user, asset):
 
             # A pdf that should be unique per user - we need to fingerprint it
+            fpid, offsets = None, None
             if mime == "application/pdf" and asset.access_type == FileAccessType.user:
-                fpid = g.user.id
-            else:
-                fpid = None
+                fpid, offsets = g.user.id, asset.get_fingerprint_offsets()
             rv = send_gridfs_file(
                 asset.file_data.get(),
                 mimetype=mime,
                 as_attachment=as_attachment,
                 attachment_filename=attachment_filename,
                 fingerprint_user_id=fpid,
+                fingerprint_offsets=offsets,
             )
             # rv.headers['Cache-Control'] = 'private'  # Override the public cache
             return rv
@@ -149,7 +225,7 @@ def authorize_and_return(fileasset_slug, as_attachment=False):
 
 class AssetAccessPolicy(ResourceAccessPolicy):
     def is_editor(self, op, user, res):
-        if user == res.owner or (res.publisher and user in res.publisher.editors):
+        if user.id == ref_id(res, "owner") or get_access_scope(user).is_editor(ref_id(res, "publisher")):
             return Authorization(
                 True, _('Allowed access to %(op)s "%(res)s" as editor', op=op, res=res), privileged=True
             )
@@ -157,7 +233,7 @@ class AssetAccessPolicy(ResourceAccessPolicy):
             return Authorization(False, _('Not allowed access to %(op)s "%(res)s" as not an editor', op=op, res=res))
 
     def is_reader(self, op, user, res):
-        if user == res.owner or (res.publisher and user in res.publisher.readers):
+        if user.id == ref_id(res, "owner") or get_access_scope(user).is_reader(ref_id(res, "publisher")):
             return Authorization(
                 True, _('Allowed access to %(op)s "%(res)s" as reader', op=op, res=res), privileged=True
             )
@@ -174,7 +250,17 @@ class FileAssetsView(ResourceView):
     item_template = "asset/fileasset_item.html"
     form_class = model_form(
         FileAsset,
-        exclude=["md5", "source_filename", "length", "created_date", "content_type", "width", "height", "file_data"],
+        exclude=[
+            "md5",
+            "source_filename",
+            "length",
+            "created_date",
+            "content_type",
+            "width",
+            "height",
+            "file_data",
+            "fingerprint_offsets",
+        ],
         base_class=ImprovedBaseForm,
         converter=ImprovedModelConverter(),
     )
@@ -197,7 +283,7 @@ class FileAssetsView(ResourceView):
     item_arg_parser = prefillable_fields_parser(["slug", "owner", "access_type", "tags", "length"])
 
     def index(self, **kwargs):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
 
         r = ListResponse(
@@ -227,7 +313,7 @@ class FileAssetsView(ResourceView):
 
     @route("<path:id>", methods=["GET"])
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
 
         if id == "post":
@@ -243,7 +329,7 @@ class FileAssetsView(ResourceView):
 
     @route("<path:id>", methods=["PATCH"])
     def patch(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
 
         fileasset = FileAsset.objects(slug=id).first_or_404()
@@ -265,7 +351,7 @@ class FileAssetsView(ResourceView):
         return redirect(r.args["next"] or url_for("assets.FileAssetsView:get", id=fileasset.slug))
 
     def post(self):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
 
         r = ItemResponse(FileAssetsView, [("fileasset", None)], method="post")
@@ -302,7 +388,7 @@ class FileAssetsView(ResourceView):
 
     @route("<path:id>", methods=["DELETE"])
     def delete(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
         fileasset = FileAsset.objects(slug=id).first_or_404()
         r = ItemResponse(FileAssetsView, [("fileasset", fileasset)], method="delete")
@@ -26,7 +26,7 @@ from sentry_sdk import configure_scope, capture_message, capture_exception, star
 
 from lore.model.misc import safe_next_url, set_lang_options
 from lore.model.user import User, UserStatus
-from lore.model.world import Publisher
+from lore.model.world import resolve_publisher_world
 from auth0.v3.management import Auth0
 from auth0.v3.authentication import GetToken
 
@@ -288,7 +288,7 @@ def sso():
 @auth_app.route("/logout", subdomain="<pub_host>")
 def logout():
     # Clears logged in flag to effectively log out from all domains, even if session is only cleared in current domain.
-    publisher = Publisher.objects(slug=g.pub_host).first()
+    publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
     set_lang_options(publisher)
 
     logout_user()
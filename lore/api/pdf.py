@@ -1,6 +1,8 @@
 import re
 from hashlib import md5
 
+from lore.model.asset import doc_id, find_fingerprint_offsets, iter_chunks, pdf_id, window_size
+
 """
 PDF fingerprint
 
@@ -42,53 +44,36 @@ def hex(s):
     return ' '.join(x.encode('hex') for x in s)
 
 # rb = bytes regex
-pdf_id = re.compile(rb'trailer\s+<<.*?ID\[<(.{12})')  # may be multiline
-doc_id = re.compile(rb'<xmpMM:DocumentID>xmp.did:(.{12})')  # wouldn't be multiline
-font_id = re.compile(rb'/FontFamily\(([^)]{12})')  # wouldn't be multiline
 font_id_find = re.compile(rb'/FontFamily\(([0-9A-F]{12})')  # Only look for hex characters
-
-window_size = 512  # size in bytes of the sliding window
+fingerprint_length = 12
 
 
 def fingerprint_from_user(user_id):
     return md5(str(user_id).encode()).hexdigest()[:12].upper().encode()  # first 12 chars of hexdigest
 
 
-def fingerprint_pdf(file_object, user_id):
-    """Generator that will fingerprint a PDF"""
+def fingerprint_pdf(file_object, user_id, offsets=None, start=0, stop=None):
+    """Generator that will fingerprint a PDF, optionally only from byte start to stop. Give offsets from
+    find_fingerprint_offsets() to avoid scanning the file, in which case the chunks are passed through as is,
+    except the few that need to be patched."""
     uid = fingerprint_from_user(user_id)
     print("Fingerprinting uid %s as hash %s" % (user_id, uid))
-    pdf_id_num, doc_id_num, font_id_num = 0, 0, 0
-    window = file_object.read(window_size * 2)
-    buf = window  # just to start with a buffer that equals true
-    do_yield = True
-    while buf:
-        if not pdf_id_num:
-            m = pdf_id.search(window)
-            if m:
-                window = window[:m.start(1)] + uid + window[m.start(1) + 12:]
-                pdf_id_num += 1
-            # print window[m.start(0) : window.find('\n', m.start(1))]
-        if not doc_id_num:
-            m = doc_id.search(window)
-            if m:
-                window = window[:m.start(1)] + uid + window[m.start(1) + 12:]
-                doc_id_num += 1
-            # print window[m.start(0) : window.find('\n', m.start(1))]
-        if not font_id_num:
-            m = font_id.search(window)
-            if m:
-                window = window[:m.start(1)] + uid + window[m.start(1) + 12:]
-                font_id_num += 1
-            # print window[m.start(0) : window.find('\n', m.start(1))]
-
-        # We use a sliding window which means we can't yield every loop,
-        # it would duplicate half window in the output
-        if do_yield:
-            yield window
-        do_yield = not do_yield
-        buf = file_object.read(window_size)
-        window = window[window_size:] + buf
+    if offsets is None:
+        offsets = find_fingerprint_offsets(file_object)
+    patches = sorted(offsets.values())
+    pos = start
+    for chunk in iter_chunks(file_object, start, stop):
+        end = pos + len(chunk)
+        patched = None
+        for offset in patches:
+            # A patch may start in the previous chunk or end in the next one, so only patch the overlap
+            begin, until = max(offset, pos), min(offset + fingerprint_length, end)
+            if begin < until:
+                if patched is None:
+                    patched = bytearray(chunk)
+                patched[begin - pos : until - pos] = uid[begin - offset : until - offset]
+        yield chunk if patched is None else bytes(patched)
+        pos = end
 
 
 def get_fingerprints(file):
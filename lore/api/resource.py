@@ -8,6 +8,8 @@
 
   :copyright: (c) 2014 by Helmgast AB
 """
+import base64
+import functools
 import itertools
 import logging
 import math
@@ -19,7 +21,19 @@ import types
 from itertools import chain
 from typing import Dict, Sequence
 
-from flask import Response, abort, current_app, flash, g, render_template, request, session, url_for
+from flask import (
+    Response,
+    abort,
+    current_app,
+    flash,
+    g,
+    has_app_context,
+    has_request_context,
+    render_template,
+    request,
+    session,
+    url_for,
+)
 from flask.json import jsonify
 from flask_babel import lazy_gettext as _
 from flask_classy import FlaskView
@@ -29,7 +43,8 @@ from flask_mongoengine.wtf.fields import JSONField, ModelSelectField, ModelSelec
 from flask_mongoengine.wtf.models import ModelForm
 from flask_mongoengine.wtf.orm import ModelConverter, converts
 from jinja2 import TemplatesNotFound
-from mongoengine import InvalidQueryError, OperationError, Q, ReferenceField
+from mongoengine import InvalidQueryError, OperationError, Q, ReferenceField, signals
+from mongoengine.base import BaseDocument
 from mongoengine.errors import NotUniqueError, ValidationError
 from mongoengine.queryset.visitor import QNode
 from pymongo.errors import OperationFailure
@@ -44,8 +59,9 @@ from wtforms.utils import unset_value
 from wtforms.widgets import HTMLString, Select, html5, html_params
 from wtforms.widgets.core import HiddenInput
 from sentry_sdk import start_span
+from bson import SON, DBRef, ObjectId, json_util
 
-from lore.model.misc import METHODS, extract, localized_field_labels, safe_next_url
+from lore.model.misc import METHODS, extract, facet_filter_options, get, localized_field_labels, safe_next_url
 from lore.model.world import EMBEDDED_TYPES, Article
 
 logger = current_app.logger if current_app else logging.getLogger(__name__)
@@ -155,7 +171,7 @@ mime_types = {"html": "text/html", "json": "application/json", "csv": "text/csv"
 #     return type(model_class.__name__ + 'Args', (baseform,), arg_fields)
 
 common_args = frozenset(
-    ["debug", "as_user", "render", "out", "intent", "view", "next", "q", "action", "method", "order_by"]
+    ["debug", "as_user", "render", "out", "intent", "view", "next", "q", "action", "method", "order_by", "after"]
 )
 
 re_operators = re.compile(
@@ -481,6 +497,61 @@ def set_form_fields_errors(error_dict, form, general_errors=None, error_path="")
 #         return query
 
 
+def prefetch(docs, *paths):
+    """Fetches referenced documents with one $in query per path, instead of MongoEngine dereferencing one at a time
+    when accessed. Paths are field names, and can go through embedded documents and lists, e.g. "user" or
+    "order_lines.product". References are replaced in place, so that accessing them won't query again.
+
+    Arguments:
+        docs {QuerySet or list} -- the documents to prefetch references for
+
+    Returns:
+        list -- the documents, as a static list
+    """
+
+    def ref_id(ref):
+        return ref.id if isinstance(ref, DBRef) else ref if isinstance(ref, ObjectId) else None
+
+    docs = list(docs)
+    for path in paths:
+        *parents, name = path.split(".")
+        containers = docs
+        for parent in parents:
+            children = []
+            for c in containers:
+                value = c._data.get(parent, None)
+                if isinstance(value, (list, tuple)):
+                    children.extend(value)
+                elif value is not None:
+                    children.append(value)
+            containers = children
+        containers = [c for c in containers if name in getattr(c, "_fields", {})]
+        if not containers:
+            continue
+        field = containers[0]._fields[name]
+        document_type = getattr(getattr(field, "field", field), "document_type", None)  # Also ListField(Reference)
+        if document_type is None:
+            continue
+        ids = set()
+        for c in containers:
+            value = c._data.get(name, None)
+            for ref in value if isinstance(value, (list, tuple)) else [value]:
+                if ref_id(ref) is not None:
+                    ids.add(ref_id(ref))
+        if not ids:
+            continue
+        fetched = {d.pk: d for d in document_type.objects(pk__in=list(ids))}
+        for c in containers:
+            value = c._data.get(name, None)
+            if isinstance(value, (list, tuple)):
+                for i, ref in enumerate(value):
+                    if ref_id(ref) in fetched:
+                        list.__setitem__(value, i, fetched[ref_id(ref)])  # Don't mark the field as changed
+            elif ref_id(value) in fetched:
+                c._data[name] = fetched[ref_id(value)]
+    return docs
+
+
 class ListResponse(ResourceResponse):
     """index, listing of resources"""
 
@@ -493,10 +564,11 @@ class ListResponse(ResourceResponse):
             "view": lambda x: x.lower() if x.lower() in ["card", "table", "list", "index"] else None,
             "order_by": lambda x: [],  # Will be replaced by fields using a filterable_arg_parser
             "q": lambda x: x,
+            "after": lambda x: x,  # Opaque cursor token, only used if view has cursor_pagination
         },
     )
     method = "list"
-    pagination, filter_options = None, {}
+    pagination, filter_options, summary = None, {}, None
 
     def __init__(self, resource_view, queries, method="list", formats=None, extra_args=None):
         list_arg_parser = getattr(resource_view, "list_arg_parser", None)
@@ -523,10 +595,11 @@ class ListResponse(ResourceResponse):
     # filterable?
 
     def finalize_query(
-        self, aggregation=None, paginate=True, select_related=True
+        self, aggregation=None, paginate=True, select_related=True, facet=False, summary=None
     ):  # also filter by authorization, paginate
         """Prepares an original query based on request args provided, such as
-        ordering, filtering, pagination etc"""
+        ordering, filtering, pagination etc. With facet=True, or if summary accumulators are given, the page,
+        total count and summary are fetched with one aggregation, and summary values are set on self.summary"""
 
         # Start instrumentation (avoid using with: to not change the whole code/indentation)
         span = start_span(op="db", description=f"{self.resource_view}.finalize_query()")
@@ -535,6 +608,8 @@ class ListResponse(ResourceResponse):
 
         if aggregation is None:
             aggregation = []
+        # Views can declare references to fetch in bulk for the list, e.g. list_prefetch = ["user", "lines.product"]
+        list_prefetch = getattr(self.resource_view, "list_prefetch", None) if select_related else None
 
         self.pagination = ResponsePagination(self)
 
@@ -575,13 +650,20 @@ class ListResponse(ResourceResponse):
             self.query = self.query.filter(built_query)
 
         # Populate filter options, options may be reduced by current query
+        self.filter_options = {}
+        facet_options = {}
         for field in self.filterable_fields.filter_dict.keys():
             # Fields may be composite like field.subfield, which we don't support with filter options
             field = field.split(".", 1)[0]
             fieldObj = self.model._fields.get(field, None)
             if fieldObj and hasattr(fieldObj, "filter_options"):
-                # Popupate all filter options per field
-                self.filter_options[field] = fieldObj.filter_options(self.query)
+                if hasattr(fieldObj.filter_options, "facet_field"):
+                    # Options that need to query distinct values are fetched together below
+                    facet_options[field] = fieldObj.filter_options
+                else:
+                    # Popupate all filter options per field
+                    self.filter_options[field] = fieldObj.filter_options(self.query)
+        self.filter_options.update(facet_filter_options(self.query, facet_options))
 
         # Filterable fields
 
@@ -626,8 +708,21 @@ class ListResponse(ResourceResponse):
         if self.args["random"] > 0:
             aggregation.append({"$sample": {"size": self.args["random"]}})
 
+        # Cursor pagination can't follow aggregations (sorting on references, random) or text score sorting
+        if self.pagination.cursor and (aggregation or self.args["q"]):
+            self.pagination.cursor = False
+
         try:
-            self.query = self.pagination.apply_to_query(self.query)
+            if facet or summary:
+                base_query = self.query
+                self.query, self.summary = self.pagination.apply_to_facet(base_query, aggregation, summary)
+                aggregation, select_related = None, False  # Already applied, and query is now a static list
+                span.set_tag("facet", True)
+            elif self.pagination.cursor:
+                self.query = self.pagination.apply_cursor_to_query(self.query)
+                select_related = False  # Query is now a static list
+            else:
+                self.query = self.pagination.apply_to_query(self.query)
         except OperationFailure as of:
             if "text index required for $text query" in of._message:
                 abort(400)  # Doesn't support the q parameter but got it anyway
@@ -642,11 +737,16 @@ class ListResponse(ResourceResponse):
             agg_results = self.query._collection.aggregate(aggregation, cursor={})
             # Note, turns query into a static list
             self.query = [self.model._from_son(a) for a in agg_results]
+        elif facet or summary:
+            qs = query_representation(query=base_query, aggregation=self.pagination.pipeline)
         else:
             span.set_tag("aggregation", False)
-            qs = query_representation(self.query)
-            if select_related:
+            qs = query_representation(self.pagination.base_query if self.pagination.cursor else self.query)
+            if select_related and not list_prefetch:
                 self.query.select_related()
+        if list_prefetch:
+            # Note, turns query into a static list
+            self.query = prefetch(self.query, *list_prefetch)
         logger.debug(qs)
         span.set_data("mongo_query", qs)
         # End instrumentation
@@ -672,9 +772,16 @@ class ResponsePagination(Pagination):
 
         self.page = page
         self.per_page = per_page
-        self.count = 0
+        self._count = None
         self.response = r
         self.skip = (page - 1) * per_page
+        # Views can opt in to cursor pagination, which avoids counting and skipping on each request. Instead of a
+        # page number, the next page is given by an opaque after= token that holds the sort key values of the last item
+        self.cursor = bool(getattr(r.resource_view, "cursor_pagination", False))
+        self.after = r.args.get("after", None)
+        self.next_after = None
+        self.base_query = None  # The filtered but not yet paginated query
+        self.pipeline = None  # The aggregation pipeline, if using facet mode
 
     def apply_to_aggregation(self, pipeline):
         # Below comment from base.py in MongoEngine:
@@ -690,9 +797,134 @@ class ResponsePagination(Pagination):
         return pipeline
 
     def apply_to_query(self, query):
-        self.count = query.count()
+        self.base_query = query
+        self._count = query.count()
         return query.skip(self.skip).limit(self.per_page)
 
+    def apply_cursor_to_query(self, query):
+        """Fetches the page after the current cursor using a range query on the sort keys, returning a static list."""
+        self.base_query = query
+        self.page, self.skip = 1, 0
+        order = self.cursor_order(query)
+        query = query.order_by(*[("-" if direction < 0 else "") + key for key, direction in order])
+        if self.after:
+            query = query.filter(__raw__=self.cursor_range(order))
+        return self.trim_cursor_page(list(query.limit(self.per_page + 1)), order)
+
+    def apply_to_facet(self, query, aggregation=None, summary=None):
+        """Fetches the page of documents, the total count and any summary accumulators with one $facet aggregation,
+        instead of one scan each. Note that the whole result has to fit in one 16MB MongoDB document.
+
+        Arguments:
+            query {QuerySet} -- the filtered query
+            aggregation {list} -- pipeline stages to apply to the documents before pagination
+            summary {dict} -- $group accumulators indexed by name, e.g. {"total": {"$sum": "$total_price"}}
+
+        Returns:
+            tuple -- list of hydrated documents, and a dict of summary values (or None)
+        """
+        self.base_query = query
+        items = list(aggregation or [])
+        if self.cursor and items:
+            self.cursor = False  # Cursor pagination can't follow aggregations
+        if self.cursor:
+            self.page, self.skip = 1, 0
+            order = self.cursor_order(query)
+            if self.after:
+                items.append({"$match": self.cursor_range(order)})
+            items += [{"$sort": SON(order)}, {"$limit": self.per_page + 1}]
+        else:
+            if query._ordering and not any("$sort" in stage for stage in items):
+                items.insert(0, {"$sort": SON(query._ordering)})
+            self.apply_to_aggregation(items)
+        facets = {"items": items, "count": [{"$count": "count"}]}
+        if summary:
+            facets["summary"] = [{"$group": dict(_id=None, **summary)}]
+        pipeline = [{"$match": query._query}] if query._query else []
+        pipeline.append({"$facet": facets})
+        self.pipeline = pipeline
+
+        result = next(query._collection.aggregate(pipeline, cursor={}), {})
+        self._count = result["count"][0]["count"] if result.get("count", None) else 0
+        docs = [query._document._from_son(son) for son in result.get("items", [])]
+        if self.cursor:
+            docs = self.trim_cursor_page(docs, order)
+        summary_values = result["summary"][0] if result.get("summary", None) else None
+        if summary_values:
+            summary_values.pop("_id", None)
+        return docs, summary_values
+
+    def cursor_order(self, query):
+        """Gives the sort keys of the query as a list of (db key, direction). The id is always added as the last sort
+        key, so that the sort order is unique."""
+        order = list(query._ordering or query._get_order_by(query._document._meta.get("ordering", None) or []))
+        if "_id" not in [key for key, direction in order]:
+            order.append(("_id", order[-1][1] if order else 1))
+        return order
+
+    def cursor_range(self, order):
+        values = self.decode_cursor(self.after)
+        if len(values) != len(order):
+            abort(400)
+        ranges = []
+        for i, (key, direction) in enumerate(order):
+            # All previous keys equal to the cursor and this key after it, e.g. a lexicographic comparison. $gt and
+            # $lt never match null or missing values, which MongoDB sorts first ascending and last descending.
+            rng = {prev_key: value for (prev_key, prev_direction), value in zip(order[:i], values[:i])}
+            if values[i] is None:
+                if direction < 0:
+                    continue  # Nothing comes after null in descending order
+                rng[key] = {"$ne": None}
+            elif direction > 0:
+                rng[key] = {"$gt": values[i]}
+            else:
+                rng["$or"] = [{key: {"$lt": values[i]}}, {key: None}]
+            ranges.append(rng)
+        return {"$or": ranges}
+
+    def trim_cursor_page(self, items, order):
+        """Items should be fetched with one extra, which tells if there is a next page"""
+        if len(items) > self.per_page:
+            items = items[: self.per_page]
+            last = items[-1].to_mongo()
+            self.next_after = self.encode_cursor([get(last, key, None) for key, direction in order])
+        return items
+
+    @staticmethod
+    def encode_cursor(values):
+        return base64.urlsafe_b64encode(json_util.dumps(values).encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode_cursor(token):
+        try:
+            values = json_util.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        except (ValueError, TypeError):
+            abort(400)
+        if not isinstance(values, list):
+            abort(400)
+        return values
+
+    @property
+    def count(self):
+        """Total number of items. In cursor mode it is only counted when needed, and estimated from collection
+        metadata if there is no filter."""
+        if self._count is None:
+            if self.base_query is None:
+                self._count = 0
+            elif self.cursor and not self.base_query._query:
+                self._count = self.base_query._collection.estimated_document_count()
+            else:
+                self._count = self.base_query.count()
+        return self._count
+
+    @count.setter
+    def count(self, x):
+        self._count = x
+
+    @property
+    def has_next(self):
+        return bool(self.next_after) if self.cursor else self.page < self.pages
+
     @property
     def pages(self):
         """The total number of pages"""
@@ -1428,11 +1660,46 @@ class Authorization(object):
         return self.is_authorized
 
 
+def memoize_authorization(authorize):
+    """Remembers the Authorization for (policy, op, user, resource) for the rest of the request, as templates and
+    views tend to ask the same question many times. Only saved and unmodified resources are memoized, and the memo
+    is dropped whenever any document is saved or deleted."""
+
+    @functools.wraps(authorize)
+    def wrapper(self, op, user=None, res=None):
+        if not has_request_context():
+            return authorize(self, op, user, res)
+        user = user or g.user
+        if res is None:
+            res_key = None
+        elif isinstance(res, BaseDocument) and res.pk and not res._changed_fields:
+            res_key = (res._class_name, res.pk)
+        else:
+            return authorize(self, op, user, res)
+        key = (id(self), authorize.__qualname__, self.translate.get(op, op), getattr(user, "id", None), res_key)
+        memo = g.setdefault("authorizations", {})
+        if key not in memo:
+            memo[key] = authorize(self, op, user, res)
+        return memo[key]
+
+    return wrapper
+
+
+def clear_authorizations(sender, document, **kwargs):
+    if has_app_context():
+        g.pop("authorizations", None)
+
+
+signals.post_save.connect(clear_authorizations)
+signals.post_delete.connect(clear_authorizations)
+
+
 # Checks if user is authorized to access this resource
 class ResourceAccessPolicy(object):
     translate = {"post": "new", "patch": "edit", "put": "edit", "index": "list", "delete": "edit", "get": "view"}
     new_allowed = Authorization(False, _("Creating new resource is not allowed"), error_code=403)
 
+    @memoize_authorization
     def authorize(self, op, user=None, res=None):
         op = self.translate.get(op, op)  # TODO temporary translation between old and new op words, e.g. patch vs edit
         if not user:
@@ -26,6 +26,7 @@ from lore.api.mailer import send_mail
 from lore.api.resource import (
     FilterableFields,
     ResourceAccessPolicy,
+    memoize_authorization,
     ImprovedModelConverter,
     ImprovedBaseForm,
     ResourceView,
@@ -47,7 +48,7 @@ from lore.model.shop import (
     products_owned_by_user,
 )
 from lore.model.user import User
-from lore.model.world import Publisher, World, filter_authorized_by_publisher
+from lore.model.world import filter_authorized_by_publisher, get_access_scope, ref_id, resolve_publisher_world
 
 logger = current_app.logger if current_app else logging.getLogger(__name__)
 
@@ -70,7 +71,7 @@ def filter_product_published():
 
 class ProductAccessPolicy(ResourceAccessPolicy):
     def is_editor(self, op, user, res):
-        if res.publisher and user in res.publisher.editors:
+        if get_access_scope(user).is_editor(ref_id(res, "publisher")):
             return Authorization(
                 True, _('Allowed access to %(op)s "%(res)s" as editor', op=op, res=res), privileged=True
             )
@@ -78,7 +79,7 @@ class ProductAccessPolicy(ResourceAccessPolicy):
             return Authorization(False, _('Not allowed access to %(op)s "%(res)s" as not an editor', op=op, res=res))
 
     def is_reader(self, op, user, res):
-        if res.publisher and user in res.publisher.readers:
+        if get_access_scope(user).is_reader(ref_id(res, "publisher")):
             return Authorization(
                 True, _('Allowed access to %(op)s "%(res)s" as reader', op=op, res=res), privileged=True
             )
@@ -112,7 +113,7 @@ class ProductsView(ResourceView):
     # form_class.stock_count = IntegerField(label=_("Remaining Stock"), validators=[InputRequired(), NumberRange(min=-1)])
 
     def index(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
         products = Product.objects(publisher=publisher).order_by("type", "-created")
         r = ListResponse(ProductsView, [("products", products), ("publisher", publisher)])
@@ -122,13 +123,12 @@ class ProductsView(ResourceView):
         r.auth_or_abort(res=publisher)
         r.finalize_query()
         if r.args.get("fields", None) and r.args["fields"].get("world", None):
-            world = World.objects(slug=r.args["fields"].get("world", "")).first()
-            r.world = world
+            r.world = resolve_publisher_world(g.pub_host, r.args["fields"]["world"], or_404=False)[1]
 
         return r
 
     def my_products(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
         # products = Product.objects().order_by('type', '-created')
 
@@ -157,7 +157,7 @@ class ProductsView(ResourceView):
         return r
 
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         if id == "post":
@@ -180,7 +180,7 @@ class ProductsView(ResourceView):
         return r
 
     def post(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         r = ItemResponse(ProductsView, [("product", None), ("publisher", publisher)], method="post")
@@ -206,7 +206,7 @@ class ProductsView(ResourceView):
         #     fa.append(FileAsset.objects(id=i).first())
         # print fa
 
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         product = Product.objects(slug=id).first_or_404()
@@ -367,6 +367,7 @@ class OrdersAccessPolicy(ResourceAccessPolicy):
                 False, _('Not allowed access to %(op)s "%(res)s" as not owner of order', op=op, res=res)
             )
 
+    @memoize_authorization
     def authorize(self, op, user=None, res=None):
         auth = super(OrdersAccessPolicy, self).authorize(op, user, res)
         if not user:
@@ -394,6 +395,8 @@ class OrdersView(ResourceView):
     filterable_fields = FilterableFields(
         Order, [("id", _("ID")), "external_key", "created", "updated", "status", "total_price", "total_items",],
     )
+    cursor_pagination = True  # Admins page deep into many orders, avoid count and skip
+    list_prefetch = ["user", "publisher", "order_lines.product"]
     item_template = "shop/order_item.html"
     item_arg_parser = prefillable_fields_parser(
         ["id", "user", "created", "updated", "status", "total_price", "total_items"]
@@ -406,7 +409,7 @@ class OrdersView(ResourceView):
     )
 
     def index(self):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
 
         orders = Order.objects().order_by("-updated")  # last updated will show paid highest
@@ -417,25 +420,19 @@ class OrdersView(ResourceView):
         r.auth_or_abort(res=publisher)
         if not (g.user and g.user.admin):
             r.query = r.query.filter(filter_is_user() | filter_authorized_by_publisher(publisher))
-        r.finalize_query()
-        aggregate = list(
-            r.orders.aggregate(
-                {
-                    "$group": {
-                        "_id": None,
-                        "total_value": {"$sum": "$total_price"},
-                        "min_created": {"$min": "$created"},
-                        "max_created": {"$max": "$created"},
-                    }
-                }
-            )
+        r.finalize_query(
+            summary={
+                "total_value": {"$sum": "$total_price"},
+                "min_created": {"$min": "$created"},
+                "max_created": {"$max": "$created"},
+            }
         )
-        r.aggregate = aggregate[0] if aggregate else None
+        r.aggregate = r.summary
 
         return r
 
     def my_orders(self):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
 
         orders = Order.objects(user=g.user).order_by("-created")  # last created shown first
@@ -454,7 +451,7 @@ class OrdersView(ResourceView):
         return r
 
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         # TODO we dont support new order creation outside of cart yet
@@ -469,7 +466,7 @@ class OrdersView(ResourceView):
     @route("/key/<key>", methods=["GET", "PATCH"])
     def key(self, key):
         # Custom authentication
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         order = Order.objects(external_key=key).get_or_404()  # get_or_404 handles exception if not a valid object ID
@@ -501,7 +498,7 @@ class OrdersView(ResourceView):
 
     @route("/buy", methods=["PATCH"])
     def buy(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         cart_order = get_cart_order()
@@ -539,7 +536,7 @@ class OrdersView(ResourceView):
     # Post means go to next step, patch means to stay
     @route("/cart", methods=["GET", "PATCH", "POST"])
     def cart(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         cart_order = get_cart_order()
@@ -569,7 +566,7 @@ class OrdersView(ResourceView):
 
     @route("/details", methods=["GET", "POST"])
     def details(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         cart_order = get_cart_order()
@@ -620,7 +617,7 @@ class OrdersView(ResourceView):
 
     @route("/pay", methods=["GET", "POST"])
     def pay(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         cart_order = get_cart_order()
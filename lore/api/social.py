@@ -31,6 +31,7 @@ from lore.api.resource import (
     ListResponse,
     OrderedModelSelectMultipleField,
     ResourceAccessPolicy,
+    memoize_authorization,
     ResourceView,
     filterable_fields_parser,
     prefillable_fields_parser,
@@ -38,7 +39,7 @@ from lore.api.resource import (
 from lore.extensions import csrf
 from lore.model.misc import EMPTY_ID, set_lang_options
 from lore.model.user import Event, Group, User
-from lore.model.world import Publisher, World
+from lore.model.world import World, resolve_publisher_world
 from wtforms.fields.simple import BooleanField, HiddenField
 from wtforms.widgets.core import CheckboxInput, HiddenInput, ListWidget
 from wtforms.fields.core import SelectMultipleField
@@ -55,6 +56,7 @@ def filter_authorized():
 
 
 class UserAccessPolicy(ResourceAccessPolicy):
+    @memoize_authorization
     def authorize(self, op, user=None, res=None):
         # TODO temporary translation between old and new op words, e.g. patch vs edit
         op = self.translate.get(op, op)
@@ -89,6 +91,7 @@ class UsersView(ResourceView):
     model = User
     list_template = "social/user_list.html"
     filterable_fields = FilterableFields(User, ["username", "status", "xp", "location", "join_date", "last_login"])
+    cursor_pagination = True  # Admins page deep into many users, avoid count and skip
     item_template = "social/user_item.html"
     item_arg_parser = prefillable_fields_parser(["username", "realname", "location", "description"])
 
@@ -118,7 +121,7 @@ class UsersView(ResourceView):
     )
 
     def index(self):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
 
         users = User.objects().order_by("-username")
@@ -132,7 +135,7 @@ class UsersView(ResourceView):
         return r
 
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
 
         user = None
@@ -155,7 +158,7 @@ class UsersView(ResourceView):
         return r
 
     def patch(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first()
+        publisher = resolve_publisher_world(g.pub_host, or_404=False)[0]
         set_lang_options(publisher)
 
         # get_or_404 handles exception if not a valid object ID
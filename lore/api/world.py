@@ -11,16 +11,32 @@
 
     :copyright: (c) 2014 by Helmgast AB
 """
+import hashlib
 import logging
+import threading
 from datetime import datetime
 from itertools import groupby
 from bson.py3compat import b
 
-from flask import request, redirect, url_for, Blueprint, g, abort, current_app, render_template, flash
+from cachetools import TTLCache
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app,
+    flash,
+    g,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
 from flask_babel import lazy_gettext as _
 from flask_classy import route
 from flask_mongoengine.wtf import model_form
-from mongoengine import NotUniqueError, ValidationError
+from mongoengine import NotUniqueError, ValidationError, signals
 from mongoengine.context_managers import query_counter
 from mongoengine.queryset import Q
 from werkzeug.contrib.atom import AtomFeed
@@ -41,8 +57,21 @@ from lore.api.resource import (
     Authorization,
 )
 from lore.model.misc import EMPTY_ID, set_lang_options
-from lore.model.world import Article, World, PublishStatus, Publisher, WorldMeta, Shortcut
-from lore.model.topic import Topic
+from lore.model.world import (
+    Article,
+    World,
+    PublishStatus,
+    Publisher,
+    WorldMeta,
+    Shortcut,
+    filter_authorized_by_publisher,
+    get_access_scope,
+    ref_id,
+    ref_ids,
+    resolve_publisher_world,
+)
+from lore.model.search import search_publisher
+from lore.model.topic import Topic, suggest_topics
 
 logger = current_app.logger if current_app else logging.getLogger(__name__)
 
@@ -80,41 +109,30 @@ def filter_authorized():
     return Q(editors__in=[g.user]) | Q(readers__in=[g.user])
 
 
-def filter_authorized_by_world(world=None):
-    if not g.user:
-        return Q(id=EMPTY_ID)  # Empty
-    elif not world:
-        # Check all worlds
-        return Q(world__in=World.objects(Q(editors__all=[g.user]) | Q(readers__all=[g.user])))
-    elif g.user in world.editors or g.user in world.readers:
-        # Save some time and only check given world
-        return Q(world__in=[world])
-    else:
-        return Q(id=EMPTY_ID)
-
-
-def filter_authorized_by_publisher(publisher=None):
-    if not g.user:
-        return Q(id=EMPTY_ID)
-    if not publisher:
-        # Check all publishers
-        return Q(publisher__in=Publisher.objects(Q(editors__all=[g.user]) | Q(readers__all=[g.user])))
-    elif g.user in publisher.editors or g.user in publisher.readers:
-        # Save some time and only check given publisher
-        return Q(publisher__in=[publisher])
-    else:
-        return Q(id=EMPTY_ID)
+def filter_readable(publisher=None, world=None):
+    """Articles the current user can see: published ones, and those where the user is editor or reader of the
+    article, of the given publisher or world, or of any world if none is given. Parts that can't match anything are
+    left out, so the query stays small and can use indexes."""
+    q = filter_published()
+    if g.user:
+        q |= filter_authorized()
+        scope = get_access_scope()
+        if publisher_ids := (scope.readable_publishers & {publisher.id} if publisher else scope.readable_publishers):
+            q |= Q(publisher__in=list(publisher_ids))
+        if world_ids := (scope.readable_worlds & {world.id} if world else scope.readable_worlds):
+            q |= Q(world__in=list(world_ids))
+    return q
 
 
 class PublisherAccessPolicy(ResourceAccessPolicy):
     def is_editor(self, op, user, res):
-        if user in res.editors:
+        if user.id in ref_ids(res, "editors"):
             return Authorization(True, _('Allowed access to "%(res)s" as editor', res=res), privileged=True)
         else:
             return Authorization(False, _('Not allowed access to "%(res)s" as not an editor', res=res))
 
     def is_reader(self, op, user, res):
-        if user in res.readers:
+        if user.id in ref_ids(res, "readers"):
             return Authorization(True, _('Allowed access to "%(res)s" as reader', res=res), privileged=True)
         else:
             return Authorization(False, _('Not allowed access to "%(res)s" as not a reader', res=res))
@@ -136,7 +154,7 @@ class PublisherAccessPolicy(ResourceAccessPolicy):
 
 class WorldAccessPolicy(PublisherAccessPolicy):
     def is_editor(self, op, user, res):
-        if user in res.editors or (res.publisher and user in res.publisher.editors):
+        if user.id in ref_ids(res, "editors") or get_access_scope(user).is_editor(ref_id(res, "publisher")):
             return Authorization(
                 True, _('Allowed access to %(op)s "%(res)s" as editor', op=op, res=res), privileged=True
             )
@@ -144,7 +162,7 @@ class WorldAccessPolicy(PublisherAccessPolicy):
             return Authorization(False, _('Not allowed access to %(op)s "%(res)s" as not an editor', op=op, res=res))
 
     def is_reader(self, op, user, res):
-        if user in res.readers or (res.publisher and user in res.publisher.readers):
+        if user.id in ref_ids(res, "readers") or get_access_scope(user).is_reader(ref_id(res, "publisher")):
             return Authorization(
                 True, _('Allowed access to %(op)s "%(res)s" as reader', op=op, res=res), privileged=True
             )
@@ -163,10 +181,8 @@ class ArticleAccessPolicy(PublisherAccessPolicy):
     new_allowed = Authorization(True, _("Creating new resource is allowed"))
 
     def is_editor(self, op, user, res):
-        if (
-            user in res.editors
-            or (res.publisher and user in res.publisher.editors)
-            or (res.world and user in res.world.editors)
+        if user.id in ref_ids(res, "editors") or get_access_scope(user).is_editor(
+            ref_id(res, "publisher"), ref_id(res, "world")
         ):
             return Authorization(
                 True, _('Allowed access to %(op)s "%(res)s" as editor', op=op, res=res), privileged=True
@@ -175,10 +191,8 @@ class ArticleAccessPolicy(PublisherAccessPolicy):
             return Authorization(False, _('Not allowed access to %(op)s "%(res)s" as not an editor', op=op, res=res))
 
     def is_reader(self, op, user, res):
-        if (
-            user in res.readers
-            or (res.publisher and user in res.publisher.readers)
-            or (res.world and user in res.world.readers)
+        if user.id in ref_ids(res, "readers") or get_access_scope(user).is_reader(
+            ref_id(res, "publisher"), ref_id(res, "world")
         ):
             return Authorization(
                 True, _('Allowed access to %(op)s "%(res)s" as reader', op=op, res=res), privileged=True
@@ -258,7 +272,7 @@ class WorldsView(ResourceView):
     # @route('/worlds/')
 
     def index(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
         owned_worlds = World.objects(publisher=publisher).order_by("-publishing_year", "-created")
         distinct_world_associations = Topic.objects().aggregate(
@@ -306,7 +320,7 @@ class WorldsView(ResourceView):
         return r
 
     def get(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
 
         if id == "post":
             set_lang_options(publisher)
@@ -315,7 +329,7 @@ class WorldsView(ResourceView):
             r.set_theme("world")  # Will pick from args if exist
             r.auth_or_abort(res=publisher)  # check auth scoped to publisher, as we want to create new
         else:
-            world = World.objects(slug=id).first_or_404()
+            world = resolve_publisher_world(g.pub_host, id)[1]
             if "intent" not in request.args:
                 # Redirect to home if we are just doing a get
                 return redirect(url_for("world.ArticlesView:world_home", world_=world.slug))
@@ -328,7 +342,7 @@ class WorldsView(ResourceView):
         return r
 
     def post(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         set_lang_options(publisher)
 
         r = ItemResponse(WorldsView, [("world", None), ("publisher", publisher)], method="post")
@@ -346,7 +360,7 @@ class WorldsView(ResourceView):
         return redirect(r.args["next"] or url_for("world.WorldsView:get", pub_host=publisher.slug, id=world.slug))
 
     def patch(self, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         world = World.objects(slug=id).first_or_404()
         set_lang_options(world, publisher)
 
@@ -380,7 +394,78 @@ class TopicsView(ResourceView):
     access_policy = ResourceAccessPolicy()
     model = Topic
     list_template = "world/topic_list.html"
-    filterable_fields = FilterableFields(Topic, ["names", "kind", "associations", "occurrences", "created_at"],)
+    filterable_fields = FilterableFields(
+        Topic,
+        ["names", "name_key", "kind", "associations", "occurrences", "created_at"],
+    )
+
+
+# Cache of fully rendered article pages for anonymous visitors, as they all see the same page. Any saved Article,
+# Topic, World or Publisher in this process clears it, other processes (and bulk writes) rely on the TTL.
+_page_cache = None
+_page_cache_lock = threading.Lock()
+page_cache_args = frozenset(["out", "render", "theme"])
+
+
+def get_page_cache():
+    global _page_cache
+    if _page_cache is None:
+        _page_cache = TTLCache(
+            maxsize=current_app.config.get("PAGE_CACHE_SIZE", 1000), ttl=current_app.config.get("PAGE_CACHE_TTL", 600)
+        )
+    return _page_cache
+
+
+def invalidate_page_cache(sender=None, document=None, **kwargs):
+    if _page_cache is not None:
+        with _page_cache_lock:
+            _page_cache.clear()
+
+
+def page_cache_key(world_, id):
+    """Returns a key for the page cache if the current request can be served from it, otherwise None"""
+    # Only anonymous visitors without session (e.g. no cart or flashed messages) and with no other args see the same page
+    if (
+        g.user
+        or session
+        or request.method != "GET"
+        or not current_app.config.get("PAGE_CACHE_TTL", 0)
+        or not page_cache_args.issuperset(request.args.keys())
+    ):
+        return None
+    return (
+        g.pub_host,
+        g.lang,
+        world_,
+        id,
+        request.args.get("out", None),
+        request.args.get("render", None),
+        request.args.get("theme", None),
+        request.accept_mimetypes.best_match(["text/html", "application/json"]),
+    )
+
+
+def cached_page_response(key):
+    with _page_cache_lock:
+        hit = get_page_cache().get(key, None)
+    if hit:
+        body, etag, last_modified = hit
+        rv = Response(body, mimetype="text/html")
+        rv.set_etag(etag)
+        rv.last_modified = last_modified
+        return rv.make_conditional(request)
+
+
+def cache_page_response(key, response):
+    if response.status_code == 200 and response.mimetype == "text/html" and not session:
+        body = response.get_data()
+        etag = hashlib.md5(body).hexdigest()
+        last_modified = datetime.utcnow().replace(microsecond=0)
+        with _page_cache_lock:
+            get_page_cache()[key] = (body, etag, last_modified)
+        response.set_etag(etag)
+        response.last_modified = last_modified
+    return response
 
 
 class ArticlesView(ResourceView):
@@ -418,8 +503,7 @@ class ArticlesView(ResourceView):
     @route("/", route_base="/")
     def publisher_home(self):
         # Explicitly take pub_host as argument, not g variable
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = WorldMeta(publisher)
+        publisher, world = resolve_publisher_world(g.pub_host, "meta")
         articles = (
             Article.objects(publisher=publisher).filter(type="blogpost").order_by("-sort_priority", "-created_date")
         )
@@ -431,12 +515,7 @@ class ArticlesView(ResourceView):
         r.set_theme("publisher", publisher.theme)
         r.template = "world/publisher_home.html"
         if not (g.user and g.user.admin):
-            r.query = r.query.filter(
-                filter_published()
-                | filter_authorized()
-                | filter_authorized_by_publisher(publisher)
-                | filter_authorized_by_world()
-            )
+            r.query = r.query.filter(filter_readable(publisher))
         # Ensure we only show worlds with an image
         r.worlds = publisher.worlds().filter(__raw__={"images": {"$gt": []}}).filter(filter_published()).order_by("-publishing_year", "-created")
         r.query = r.query.limit(8)
@@ -445,7 +524,7 @@ class ArticlesView(ResourceView):
 
     @route("/<not(en,sv):world_>/", route_base="/")
     def world_home(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher = resolve_publisher_world(g.pub_host)[0]
         if world_ == "post":
             set_lang_options(publisher)
             r = ItemResponse(WorldsView, [("world", None), ("publisher", publisher)], extra_args={"intent": "post"})
@@ -454,7 +533,7 @@ class ArticlesView(ResourceView):
         if world_ == "meta":
             return redirect(url_for("world.ArticlesView:publisher_home", pub_host=publisher.slug))
         else:
-            world = World.objects(slug=world_).first_or_404()
+            world = resolve_publisher_world(g.pub_host, world_)[1]
             set_lang_options(world, publisher)
 
             r = ItemResponse(WorldsView, [("world", world), ("publisher", publisher)])
@@ -463,59 +542,66 @@ class ArticlesView(ResourceView):
             # if world.external_host:
             #     return redirect(world.external_host)
             r.set_theme("world", world.theme)
-            r.articles = Article.objects(world=world).filter(
-                filter_published()
-                | filter_authorized()
-                | filter_authorized_by_publisher(publisher)
-                | filter_authorized_by_world(world)
-            )
+            r.articles = Article.objects(world=world).filter(filter_readable(publisher, world))
         r.template = "world/world_home.html"
         return r
 
     @route("/search", route_base="/")
     def search(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = WorldMeta(publisher)
+        publisher, world = resolve_publisher_world(g.pub_host, "meta")
         articles = Article.objects(publisher=publisher)
         set_lang_options(publisher)
         r = ListResponse(ArticlesView, [("articles", articles), ("world", world), ("publisher", publisher)])
         r.set_theme("publisher", publisher.theme)
         r.auth_or_abort(res=publisher)
         if not (g.user and g.user.admin):
-            r.query = r.query.filter(
-                filter_published()
-                | filter_authorized()
-                | filter_authorized_by_publisher(publisher)
-                | filter_authorized_by_world()
-            )
-        r.finalize_query()
+            r.query = r.query.filter(filter_readable(publisher))
         r.template = "world/article_search.html"
+        if r.args["q"]:
+            # Ranked hits from both articles and topics, replacing the normal article list
+            search_world = request.args.get("world", None)
+            r.search = search_publisher(
+                publisher,
+                r.args["q"],
+                r.query,
+                language=g.lang,
+                world=resolve_publisher_world(g.pub_host, search_world)[1] if search_world else None,
+                kind=request.args.get("kind", None),
+                # All anonymous users can read the same articles, so they share cached results
+                cache_key=g.user.id if g.user else "anonymous",
+            )
+            r.query = r.query.none()
+        else:
+            r.finalize_query()
         return r
 
+    @route("/suggest", route_base="/")
+    def suggest(self):
+        """Returns topics with a name starting with q as JSON, for autocomplete. Optionally limited to a world."""
+        publisher, world = resolve_publisher_world(g.pub_host, request.args.get("world", None))
+        r = ListResponse(ArticlesView, [("articles", Article.objects(publisher=publisher)), ("publisher", publisher)])
+        r.auth_or_abort(res=publisher)
+        topic_path = f"{publisher.slug}/{world.slug}" if world else publisher.slug
+        limit = max(1, min(request.args.get("limit", 10, type=int), 50))  # MongoDB treats 0 as no limit
+        return jsonify(suggestions=suggest_topics(request.args.get("q", ""), topic_path, limit))
+
     @route("/mentions", route_base="/")
     def mentions(self):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = WorldMeta(publisher)
+        publisher, world = resolve_publisher_world(g.pub_host, "meta")
         articles = Article.objects(publisher=publisher)
         set_lang_options(publisher)
         r = ListResponse(ArticlesView, [("articles", articles), ("world", world), ("publisher", publisher)])
         r.set_theme("publisher", publisher.theme)
         r.auth_or_abort(res=publisher)
         if not (g.user and g.user.admin):
-            r.query = r.query.filter(
-                filter_published()
-                | filter_authorized()
-                | filter_authorized_by_publisher(publisher)
-                | filter_authorized_by_world()
-            )
+            r.query = r.query.filter(filter_readable(publisher))
         r.finalize_query()
         r.template = "world/article_search.html"
         return r
 
     @route("/articles/")  # Needed to give explicit route to index page, as route base shows world_item
     def index(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher, world = resolve_publisher_world(g.pub_host, world_)
         set_lang_options(world, publisher)
 
         if world_ == "meta":
@@ -528,25 +614,15 @@ class ArticlesView(ResourceView):
         r.set_theme("world", world.theme)
         r.auth_or_abort(res=(world if world_ != "meta" else publisher))
         if not (g.user and g.user.admin):
-            r.query = r.query.filter(
-                filter_published()
-                | filter_authorized()
-                | filter_authorized_by_publisher(publisher)
-                | filter_authorized_by_world(world)
-            )  # If world is meta will count as None
+            r.query = r.query.filter(filter_readable(publisher, world))  # If world is meta will count as None
         if not r.args["order_by"]:
             r.args["order_by"] = ["-created_date"]
         r.finalize_query()  # order by creator.realname
         return r
 
     def topics(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).comment("Current publisher").first_or_404()
-        if world_ != "meta":
-            world = World.objects(slug=world_).comment("Current world").first_or_404()
-            topic_path = f"{publisher.slug}/{world.slug}"
-        else:
-            world = WorldMeta(publisher)
-            topic_path = f"{publisher.slug}"
+        publisher, world = resolve_publisher_world(g.pub_host, world_)
+        topic_path = f"{publisher.slug}/{world.slug}" if world_ != "meta" else f"{publisher.slug}"
 
         set_lang_options(world, publisher)
 
@@ -564,9 +640,17 @@ class ArticlesView(ResourceView):
         r.set_theme("world", world.theme)
         r.auth_or_abort(res=(world if world_ != "meta" else publisher))
         r.args["per_page"] = 90
-        if r.args["view"] == "index" and "names__0__name__istartswith" not in r.args["fields"]:
-            # Set default index letter to A
-            r.args["fields"]["names__0__name__istartswith"] = "A"
+        if r.args["view"] == "index":
+            # Filter and sort on the normalized name_key, which unlike a case insensitive regex can use an index
+            initial = r.args["fields"].get("name_key__startswith", None)
+            if initial == "#":
+                # Everything that has no letter button, e.g. digits, symbols, æ, ø and other alphabets
+                del r.args["fields"]["name_key__startswith"]
+                r.query = r.query.filter(__raw__={"name_key": {"$regex": "^[^a-zåäö]"}})
+            elif not initial:
+                r.args["fields"]["name_key__startswith"] = "a"  # Set default index letter to A
+            if not r.args["order_by"]:
+                r.args["order_by"] = ["name_key"]
 
         r.finalize_query(select_related=False)
         #     topic_names = {
@@ -588,8 +672,7 @@ class ArticlesView(ResourceView):
         return r
 
     def blog(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher, world = resolve_publisher_world(g.pub_host, world_)
         set_lang_options(world, publisher)
 
         if world_ == "meta":
@@ -603,12 +686,7 @@ class ArticlesView(ResourceView):
         r.template = "world/article_blog.html"
         r.auth_or_abort(res=(world if world_ != "meta" else publisher))
         if not (g.user and g.user.admin):
-            r.query = r.query.filter(
-                filter_published()
-                | filter_authorized()
-                | filter_authorized_by_publisher(publisher)
-                | filter_authorized_by_world(world)
-            )  # If world is meta will count as None
+            r.query = r.query.filter(filter_readable(publisher, world))  # If world is meta will count as None
         r.args["per_page"] = 5
         r.args["view"] = "list"
         r.query = r.query.filter(type="blogpost").order_by("-created_date")
@@ -617,20 +695,14 @@ class ArticlesView(ResourceView):
         return r
 
     def random(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        # world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher, world = resolve_publisher_world(g.pub_host, world_)
         # articles = Article.objects(
         #     world=if_not_meta(world),
         #     publisher=publisher,
         #     status=PublishStatus.published,
         #     created_date__lte=datetime.utcnow(),
         # )
-        if world_ != "meta":
-            world = World.objects(slug=world_).comment("Current world").first_or_404()
-            topic_path = f"{publisher.slug}/{world.slug}"
-        else:
-            world = WorldMeta(publisher)
-            topic_path = f"{publisher.slug}"
+        topic_path = f"{publisher.slug}/{world.slug}" if world_ != "meta" else f"{publisher.slug}"
 
         # Calling len or length on a listfield in Mongoengine unexpectedly starts de-referencing,
         # so changing the query to not have it, which should include all actions in the template
@@ -644,13 +716,11 @@ class ArticlesView(ResourceView):
             return redirect(url_for("world.ArticlesView:index", pub_host=publisher.slug, world_=world.slug))
 
     def feed(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+        publisher, world = resolve_publisher_world(g.pub_host, world_)
         query = filter_published()
         if world_ == "meta":
-            world = WorldMeta(publisher)
             query = Q(publisher=publisher) & query
         else:
-            world = World.objects(slug=world_).first_or_404()
             query = Q(world=world) & query
 
         feed = AtomFeed(_("Recent Articles in ") + world.title, feed_url=request.url, url=request.url_root)
@@ -671,11 +741,20 @@ class ArticlesView(ResourceView):
                 )
         return feed.get_response()
 
-    def get(self, world_, id):
+    def before_get(self, world_, id):
+        g.page_cache_key = page_cache_key(world_, id) if id != "post" else None
+        if g.page_cache_key:
+            return cached_page_response(g.page_cache_key)
 
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
+    def after_request(self, name, response):
+        response = super(ArticlesView, self).after_request(name, response)
+        if name == "get" and g.get("page_cache_key", None):
+            response = cache_page_response(g.page_cache_key, response)
+        return response
 
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+    def get(self, world_, id):
+
+        publisher, world = resolve_publisher_world(g.pub_host, world_)
 
         set_lang_options(world, publisher)
 
@@ -710,15 +789,8 @@ class ArticlesView(ResourceView):
                 if topic_theme := topic.find_occurrences(kind="lore.pub/t/theme", first=True):
                     article.theme = topic_theme.content
 
-                # Executing this will cache all topics, hopefully in just one call? TODO check
-                # cache = {t.pk: t for t in topic.query_all_referenced_topics()}
-                topic_names = {
-                    t.pk: t
-                    for t in topic.query_all_referenced_topics()
-                    .no_dereference()
-                    .only("names", "kind")
-                    .comment("Names of referenced topics")
-                }
+                # All topics referenced by this topic, loaded in one query
+                topic_names = topic.load_neighbourhood(fields=("names", "kind"))
             elif not article and not topic:
                 if "redirected" not in request.url:
                     return redirect(
@@ -748,8 +820,7 @@ class ArticlesView(ResourceView):
         return r
 
     def post(self, world_):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher, world = resolve_publisher_world(g.pub_host, world_)
         set_lang_options(world, publisher)
 
         r = ItemResponse(ArticlesView, [("article", None), ("world", world), ("publisher", publisher)], method="post")
@@ -777,8 +848,7 @@ class ArticlesView(ResourceView):
         )
 
     def patch(self, world_, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher, world = resolve_publisher_world(g.pub_host, world_)
         article = Article.objects(slug=id).first_or_404()
         set_lang_options(world, publisher)
 
@@ -805,8 +875,7 @@ class ArticlesView(ResourceView):
         )
 
     def delete(self, world_, id):
-        publisher = Publisher.objects(slug=g.pub_host).first_or_404()
-        world = World.objects(slug=world_).first_or_404() if world_ != "meta" else WorldMeta(publisher)
+        publisher, world = resolve_publisher_world(g.pub_host, world_)
         article = Article.objects(slug=id).first_or_404()
         set_lang_options(world, publisher)
 
@@ -873,6 +942,10 @@ PublishersView.register_with_access(world_app, "publisher")
 WorldsView.register_with_access(world_app, "world")
 ArticlesView.register_with_access(world_app, "article")
 
+for _model in (Article, Topic, World, Publisher):
+    signals.post_save.connect(invalidate_page_cache, sender=_model)
+    signals.post_delete.connect(invalidate_page_cache, sender=_model)
+
 
 # ArticleRelationsView.register_with_access(world_app, 'articlerelations')
 
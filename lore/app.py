@@ -31,7 +31,6 @@ from flask.config import Config
 import markdown
 from mongoengine.connection import ConnectionFailure
 from werkzeug.middleware.proxy_fix import ProxyFix
-from werkzeug.routing import Map
 import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 
@@ -170,7 +169,7 @@ def configure_extensions(app):
     app.default_host = app.config["DEFAULT_HOST"]
     app.url_rule_class.allow_domains = True
     app.url_rule_class.default_host = app.config["DEFAULT_HOST"]
-    app.url_map = Map(host_matching=True)
+    app.url_map = extensions.LoreMap(host_matching=True, match_cache_size=app.config.get("ROUTE_CACHE_SIZE", 0))
     app.url_map.converters["not"] = extensions.NotAnyConverter
 
     # Re-add the static rule
@@ -232,7 +231,7 @@ def configure_extensions(app):
         extensions.AutolinkedImage(),
     ]
 
-    app.md = markdown.Markdown(extensions=md_extensions)
+    app.md = extensions.MarkdownRenderer(extensions=md_extensions)
 
     app.jinja_env.filters["markdown"] = extensions.build_md_filter(extensions=md_extensions)
     app.jinja_env.filters["md2plain"] = extensions.build_md_filter(output_format="plain", stripTopLevelTags=False)
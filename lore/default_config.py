@@ -44,6 +44,25 @@ class Config(object):
     URL_PREFIX = None  # Set to /something to add that as URL prefix globally for the app
     CLOUDINARY_DOMAIN = None
     SENTRY_SAMPLE_RATE = 0.2
+    PUBLISHER_CACHE_TTL = 300  # Seconds to keep publishers and worlds in the process local registry, 0 to disable
+    PUBLISHER_CACHE_SIZE = 1000  # Max number of publishers and worlds (including missing ones) in the registry
+    # Seconds to keep each user's editor and reader access between requests, 0 to compute it once per request.
+    # Access revoked in another process, or with QuerySet.update(), remains for up to this long.
+    ACCESS_SCOPE_CACHE_TTL = 0
+    PAGE_CACHE_TTL = 600  # Seconds to cache rendered article pages for anonymous visitors, 0 to disable
+    PAGE_CACHE_SIZE = 1000  # Max number of rendered pages to keep in the cache
+    FILTER_OPTIONS_CACHE_TTL = 30  # Seconds to cache filter options for list pages, 0 to disable
+    ROUTE_CACHE_SIZE = 5000  # Max number of matched (host, path, method) to remember, 0 to disable
+    SEARCH_CACHE_TTL = 60  # Seconds to cache search results per user and query, 0 to disable
+    SEARCH_CACHE_SIZE = 500  # Max number of search results to keep in the cache
+    EVENT_QUEUE_SIZE = 10000  # Max number of logged events waiting to be written in the background, 0 to write directly
+    EVENT_BATCH_SIZE = 100  # Max number of events to write at a time
+    EVENT_FLUSH_INTERVAL = 1.0  # Seconds to wait for more events before writing a batch
+    MARKDOWN_CACHE_SIZE = 2000  # Max number of rendered Markdown texts to keep in memory, 0 to disable
+    MARKDOWN_PERSIST_MIN_LENGTH = 0  # Also store rendered Markdown in the database for texts this long, 0 to disable
+    # Repos fetched by the git webhook, as owner/name or owner/name/branch_x, to import as markdown topics. Maps
+    # to arguments for import_markdown_topics, e.g. {"helmgast/wiki": {"default_bases": ["helmgast.se/eon"]}}
+    TOPIC_IMPORT_REPOS = {}
 
 
 class SecretConfig(object):
@@ -1,5 +1,9 @@
 import re
+import threading
 import types
+from collections import Counter
+from hashlib import sha1
+from timeit import default_timer as timer
 from operator import attrgetter
 
 from datetime import datetime
@@ -20,9 +24,10 @@ from jinja2 import Undefined, evalcontextfilter
 import markdown
 from markdown.treeprocessors import Treeprocessor
 from markupsafe import Markup
+from cachetools import LRUCache
 from mongoengine import Document, QuerySet
 from speaklater import _LazyString
-from werkzeug.routing import Rule, BaseConverter
+from werkzeug.routing import Map, MapAdapter, Rule, BaseConverter
 from werkzeug.urls import url_decode
 
 toolbar = DebugToolbarExtension()
@@ -181,6 +186,53 @@ class LoreRule(Rule):
     #     return tup
 
 
+class LoreMapAdapter(MapAdapter):
+    def match(self, path_info=None, method=None, return_rule=False, query_args=None):
+        """Matches like MapAdapter, but first looks in the map's cache of earlier matches for the same host, path and
+        method. Only successful matches are cached, so redirects and errors always go through the rules."""
+        cache = self.map.match_cache
+        if cache is None:
+            return super().match(path_info, method, return_rule, query_args)
+        key = (self.server_name, self.subdomain, path_info or self.path_info, (method or self.default_method).upper())
+        with self.map.match_cache_lock:
+            hit = cache.get(key, None)
+        if hit is None:
+            self.map.match_stats["miss"] += 1
+            start = timer()
+            hit = super().match(path_info, method, return_rule=True, query_args=query_args)
+            self.map.match_stats["miss_time"] += timer() - start
+            with self.map.match_cache_lock:
+                cache[key] = hit
+        else:
+            self.map.match_stats["hit"] += 1
+        rule, args = hit
+        # Copy the arguments, as they become view_args that url_value_preprocessors pop from
+        return (rule if return_rule else rule.endpoint), dict(args)
+
+
+class LoreMap(Map):
+    """URL map that caches matched routes in an LRU cache, as we have many rules due to blueprints registered
+    once per language, and werkzeug tries each rule in order until one matches."""
+
+    def __init__(self, *args, match_cache_size=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.match_cache = LRUCache(maxsize=match_cache_size) if match_cache_size else None
+        self.match_cache_lock = threading.Lock()
+        self.match_stats = Counter()
+
+    def add(self, rulefactory):
+        super().add(rulefactory)
+        if self.match_cache is not None:
+            with self.match_cache_lock:
+                self.match_cache.clear()
+
+    def bind(self, *args, **kwargs):
+        a = super().bind(*args, **kwargs)
+        return LoreMapAdapter(
+            self, a.server_name, a.script_name, a.subdomain, a.url_scheme, a.path_info, a.default_method, a.query_args
+        )
+
+
 def db_config_string(app):
     # Clean to remove password
     return re.sub(r":([^/]+?)@", ":<REMOVED_PASSWORD>@", app.config["MONGODB_HOST"])
@@ -362,18 +414,96 @@ def unmark_element(element, stream=None):
     return stream.getvalue()
 
 
+# Cache of rendered Markdown shared by all renderers in this process. Texts are hashed, so any change gives a new key.
+_markdown_cache = None
+_markdown_cache_lock = threading.Lock()
+
+
+def get_markdown_cache():
+    global _markdown_cache
+    if _markdown_cache is None:
+        _markdown_cache = LRUCache(maxsize=current_app.config.get("MARKDOWN_CACHE_SIZE", 2000))
+    return _markdown_cache
+
+
+class MarkdownRenderer:
+    """Converts Markdown with a fixed set of options. Results are kept in an LRU cache keyed by content hash,
+    extensions and output format, and texts of at least MARKDOWN_PERSIST_MIN_LENGTH are also stored as
+    RenderedMarkdown. Unlike a markdown.Markdown instance, it's safe to share between threads, as each thread
+    gets its own Markdown instance that is built once and reset after each conversion."""
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self._local = threading.local()
+        configs = kwargs.get("extension_configs", {})
+        extension_keys = [self.extension_key(e, configs) for e in kwargs.get("extensions", [])]
+        self.options_key = (
+            f"{','.join(extension_keys)}:{kwargs.get('output_format', 'xhtml')}:{kwargs.get('stripTopLevelTags', True)}"
+        )
+
+    @staticmethod
+    def extension_key(extension, extension_configs):
+        """Returns the name of an extension, with its config if it has any, so that differently configured
+        renderers don't share cached results."""
+        if isinstance(extension, str):
+            name, config = extension, extension_configs.get(extension, {})
+        else:
+            name, config = type(extension).__name__, extension.getConfigs()
+        return f"{name}{sorted(config.items())}" if config else name
+
+    def build(self):
+        md = markdown.Markdown(**self.kwargs)
+        if self.kwargs.get("stripTopLevelTags") is False:
+            md.stripTopLevelTags = False  # This is not read by Markdown __init__ so set manually
+        return md
+
+    def render(self, text):
+        # Markdown instances are not thread safe, so keep one per thread instead of building one per call
+        md = getattr(self._local, "md", None)
+        if md is None:
+            md = self._local.md = self.build()
+        try:
+            return md.convert(text)
+        finally:
+            md.reset()  # Clears state like references and stashed HTML before the next text
+
+    def convert(self, text):
+        if not current_app or not current_app.config.get("MARKDOWN_CACHE_SIZE", 0):
+            return self.render(text)
+        key = f"{sha1(text.encode('utf-8')).hexdigest()}:{self.options_key}"
+        with _markdown_cache_lock:
+            html = get_markdown_cache().get(key, None)
+        if html is not None:
+            return html
+
+        from lore.model.misc import RenderedMarkdown  # lore.model imports this module
+
+        min_length = current_app.config.get("MARKDOWN_PERSIST_MIN_LENGTH", 0)
+        persist = min_length and len(text) >= min_length
+        if persist:
+            stored = RenderedMarkdown._get_collection().find_one({"_id": key}, {"html": 1})
+            html = stored["html"] if stored else None
+        if html is None:
+            html = self.render(text)
+            if persist:
+                RenderedMarkdown._get_collection().replace_one(
+                    {"_id": key}, {"html": html, "created_at": datetime.utcnow()}, upsert=True
+                )
+        with _markdown_cache_lock:
+            get_markdown_cache()[key] = html
+        return html
+
+
 def build_md_filter(**kwargs):
+    renderer = MarkdownRenderer(**kwargs)
+
     @evalcontextfilter
     def markdown_filter(eval_ctx, stream):
         if not stream:
             return Markup("")
         else:
-            # We are creating a Markdown instance for each call, as it is not thread safe
-            md = markdown.Markdown(**kwargs)
-            if kwargs.get("stripTopLevelTags") is False:
-                md.stripTopLevelTags = False # This is not read by Markdown __init__ so set manually
             markup = jinja2.escape(stream) if eval_ctx.autoescape else stream
-            return Markup(md.convert(markup))
+            return Markup(renderer.convert(str(markup)))
 
     return markdown_filter
 
@@ -29,6 +29,7 @@ from mongoengine import (
     ListField,
     FileField,
     IntField,
+    DictField,
     NULLIFY,
     DENY,
     CASCADE,
@@ -52,6 +53,15 @@ except ImportError:
 
 logger = current_app.logger if current_app else logging.getLogger(__name__)
 
+# Where to put a fingerprint in a PDF, see lore.api.pdf. rb = bytes regex
+pdf_id = re.compile(rb"trailer\s+<<.*?ID\[<(.{12})")  # may be multiline
+doc_id = re.compile(rb"<xmpMM:DocumentID>xmp.did:(.{12})")  # wouldn't be multiline
+font_id = re.compile(rb"/FontFamily\(([^)]{12})")  # wouldn't be multiline
+fingerprint_patterns = {"pdf_id": pdf_id, "doc_id": doc_id, "font_id": font_id}
+
+window_size = 512  # size in bytes of the sliding window
+chunk_size = 255 * 1024  # same as the default GridFS chunk size
+
 FileAccessType = Choices(
     public=_("Public use"),  # Accessed by anyone
     hidden=_("Hidden"),  # Not shown in public listings but publicly accessed at hashed URL
@@ -74,6 +84,44 @@ allowed_mimetypes = {
 }
 
 
+def iter_chunks(file_object, start=0, stop=None):
+    """Iterates over the file from byte start to stop in chunks. GridFS files are read one stored chunk at a
+    time, without copying them into a new buffer."""
+    file_object.seek(start)
+    read = getattr(file_object, "readchunk", None) or (lambda: file_object.read(chunk_size))
+    pos = start
+    for chunk in iter(read, b""):
+        if stop is not None and pos + len(chunk) >= stop:
+            if stop > pos:
+                yield chunk[: stop - pos]
+            return
+        yield chunk
+        pos += len(chunk)
+
+
+def find_fingerprint_offsets(file_object):
+    """Scans a PDF for the places to put a fingerprint and returns a dict of name to the absolute byte
+    offset of the 12 bytes to replace. Only the first match of each pattern is used, and the scan stops as
+    soon as all have been found. As we store the result on the FileAsset, this is only done once per file."""
+    offsets = {}
+    base, tail = 0, b""  # base is the absolute offset of the start of the buffer
+    for chunk in iter_chunks(file_object):
+        buf = tail + chunk
+        for name, pattern in fingerprint_patterns.items():
+            if name not in offsets:
+                m = pattern.search(buf)
+                if m:
+                    offsets[name] = base + m.start(1)
+        if len(offsets) == len(fingerprint_patterns):
+            break
+        # Keep an overlap between reads so that we find matches that cross a chunk boundary. Matches are
+        # short (the old sliding window was 1 KB) so this is enough.
+        keep = min(len(buf), window_size * 2)
+        base += len(buf) - keep
+        tail = buf[-keep:]
+    return offsets
+
+
 def guess_content_type(filename):
     name, ext = os.path.splitext(filename)
     if ext:
@@ -310,6 +358,8 @@ class FileAsset(Document):
     width = IntField()
     height = IntField()
     md5 = StringField()
+    # Byte offsets in a PDF where to put user fingerprints, None if not yet scanned
+    fingerprint_offsets = DictField(default=None)
 
     # Optional data about source
     source_file_url = URLField(verbose_name=_("Source File URL"))
@@ -470,6 +520,11 @@ class FileAsset(Document):
 
         if self.tmp_file_obj:
             # We have received a file obj
+            if self.content_type == "application/pdf":
+                self.fingerprint_offsets = find_fingerprint_offsets(self.tmp_file_obj)
+                self.tmp_file_obj.seek(0)
+            else:
+                self.fingerprint_offsets = None
             self.file_data.replace(self.tmp_file_obj, content_type=self.content_type, filename=self.source_filename)
             self.tmp_file_obj = None
 
@@ -499,6 +554,13 @@ class FileAsset(Document):
     def file_data_exists(self):
         return self.file_data and self.file_data.grid_id is not None
 
+    def get_fingerprint_offsets(self):
+        # Files uploaded before we stored offsets get scanned on first download
+        if self.fingerprint_offsets is None and self.file_data_exists():
+            self.fingerprint_offsets = find_fingerprint_offsets(self.file_data.get())
+            self.update(set__fingerprint_offsets=self.fingerprint_offsets)
+        return self.fingerprint_offsets
+
     def get_mimetype(self):
         return mimetypes.guess_type(self.source_filename)[0]
 
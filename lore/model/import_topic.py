@@ -1,14 +1,24 @@
 from lore.model.asset import get_google_urls
+import pathlib
 import re
+from datetime import datetime
+from functools import partial
+from hashlib import sha1
 from typing import Any, Dict, List
 from urllib.parse import urlparse
+
+from mongoengine import DateTimeField, Document, FloatField, IntField, ListField, StringField
+from pymongo import DeleteOne, UpdateOne
+
 from lore.model.shop import parse_datetime
 from lore.model.topic import (
     LORE_BASE,
     Occurrence,
+    Topic,
     TopicFactory,
     PATH_OK,
 )
+from tools.batch import Batch, BulkCommitter, Column
 from tools.unicode_slugify import capitalize, slugify
 
 
@@ -36,7 +46,7 @@ def listify(obj, skip_falsy=True):
 # TODO Whether to upload files from an upload dir
 # TODO What the full path should be for files
 # TODO Summarize stats
-def job_import_topic(job, data):
+def import_topic(job, data):
     factory: TopicFactory = job.context["topic_factory"]
     topic_default_scopes = set(factory.default_scopes)
 
@@ -205,6 +215,201 @@ def job_import_topic(job, data):
     return t
 
 
+def job_import_topic(job, data):
+    t = import_topic(job, data)
+    if bulk_committer := job.context.get("bulk_committer", None):
+        # Save the topics this job touched when the batch commits, which it does in chunks while running
+        job.committer = partial(bulk_committer.add_all, job.context["topic_factory"].pop_touched())
+    return t
+
+
+class ImportedFile(Document):
+    """A file that topics have been imported from, so that a re-import knows what has changed since."""
+
+    meta = {"indexes": [{"fields": ["source", "path"], "unique": True}]}
+
+    source = StringField(required=True)  # The folder that was imported
+    path = StringField(required=True)  # Relative to source
+    hash = StringField()
+    mtime = FloatField()
+    size = IntField()
+    topic_ids = ListField(StringField())  # Topics this file produced
+    touched_ids = ListField(StringField())  # All topics this file added to, e.g. through associations
+    imported_at = DateTimeField(default=datetime.utcnow)
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return sha1(f.read()).hexdigest()
+
+
+class ImportManifest:
+    """Keeps track of the files imported from a source folder and the topics each produced, so that a re-import
+    only has to parse and apply files that were added, changed or deleted since the last commit.
+    """
+
+    def __init__(self, source):
+        self.source = str(source)
+        self.entries = {f.path: f for f in ImportedFile.objects(source=self.source)}
+        self.changed = {}  # Path to (hash, mtime, size) of added or changed files
+        self.refreshed = {}  # Same but for files with changed mtime and same content
+        self.deleted = set()
+        self.imported = {}  # Path to (topic ids, touched ids), for changed files that have been imported
+
+    def scan(self, pattern="**/*.md", full=False):
+        """Compares the files in source with the manifest. Files with the same mtime and size as last import are
+        assumed unchanged, otherwise the content hash decides. If full, all files count as changed."""
+        root = pathlib.Path(self.source)
+        self.changed, self.refreshed, found = {}, {}, set()
+        for file in sorted(root.glob(pattern)):
+            path = file.relative_to(root).as_posix()
+            found.add(path)
+            stat = file.stat()
+            entry = self.entries.get(path, None)
+            if not full and entry and entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+                continue
+            hash = file_hash(file)
+            if full or not entry or entry.hash != hash:
+                self.changed[path] = (hash, stat.st_mtime, stat.st_size)
+            else:
+                self.refreshed[path] = (hash, stat.st_mtime, stat.st_size)
+        self.deleted = set(self.entries.keys()) - found
+        return self.changed
+
+    def add_imported(self, path, topic_ids, touched_ids):
+        self.imported[path] = (topic_ids, touched_ids)
+
+    def stale_topic_ids(self):
+        """Topics produced by deleted or re-imported files last time, that no file produces or adds to anymore.
+        Topics that a file only added to, such as the other end of an association, are never stale, as they may
+        have been created outside of the import."""
+        old, current = set(), set()
+        for path, entry in self.entries.items():
+            if path in self.deleted or path in self.imported:
+                old.update(entry.topic_ids)
+            else:
+                current.update(entry.topic_ids, entry.touched_ids)
+        for topic_ids, touched_ids in self.imported.values():
+            current.update(topic_ids, touched_ids)
+        return old - current
+
+    def save(self):
+        ops = [DeleteOne({"source": self.source, "path": path}) for path in self.deleted]
+        now = datetime.utcnow()
+        for path, (topic_ids, touched_ids) in self.imported.items():
+            hash, mtime, size = self.changed[path]
+            ops.append(
+                UpdateOne(
+                    {"source": self.source, "path": path},
+                    {
+                        "$set": {
+                            "hash": hash,
+                            "mtime": mtime,
+                            "size": size,
+                            "topic_ids": topic_ids,
+                            "touched_ids": touched_ids,
+                            "imported_at": now,
+                        }
+                    },
+                    upsert=True,
+                )
+            )
+        for path, (hash, mtime, size) in self.refreshed.items():
+            ops.append(UpdateOne({"source": self.source, "path": path}, {"$set": {"mtime": mtime, "size": size}}))
+        if ops:
+            ImportedFile._get_collection().bulk_write(ops, ordered=False)
+
+
+def job_import_markdown_file(job, data):
+    """Imports a markdown file like job_import_topic, and records what it produced in the manifest when the
+    batch commits. Expects data to have the path of the file relative to the source as source_path."""
+    t = import_topic(job, data)
+    if bulk_committer := job.context.get("bulk_committer", None):
+        touched = job.context["topic_factory"].pop_touched()
+        manifest = job.context.get("manifest", None)
+
+        def committer():
+            bulk_committer.add_all(touched)
+            if manifest is not None:
+                manifest.add_imported(data.source_path, [t.pk], sorted(x.pk for x in touched))
+
+        job.committer = committer
+    return t
+
+
+def import_markdown_topics(
+    path,
+    commit=False,
+    match="",
+    full=False,
+    default_bases=None,
+    default_scopes=None,
+    default_associations=None,
+    chunk_size=500,
+    **kwargs,
+):
+    """Imports topics from the markdown files under path. Only files that were added or changed since the last
+    committed import are parsed, unless full, and topics from files that have been deleted are removed.
+    Returns the batch.
+    """
+    import frontmatter
+
+    columns = [
+        Column("ID", "id", "id"),
+        Column("TITLE", "title", "name"),
+        Column("CREATED", "created_at", "created_at"),
+    ]
+    manifest = ImportManifest(pathlib.Path(path).resolve())
+    changed = manifest.scan(full=full)
+
+    # Preloading lets the factory resolve ids from memory instead of one query per base and id
+    factory = TopicFactory(default_bases, default_scopes, default_associations, preload=True)
+    factory.prefetch(pathlib.PurePath(p).stem for p in changed)
+    committer = BulkCommitter(Topic, chunk_size=chunk_size) if commit else None
+
+    # Jobs share the factory and its half-built topics, so they can't run in parallel
+    kwargs.pop("workers", None)
+    b = Batch(
+        f"Import markdown files from path {path}",
+        table_columns=columns,
+        dry_run=not commit,
+        topic_factory=factory,
+        bulk_committer=committer,
+        manifest=manifest,
+        commit_every=chunk_size,
+        **kwargs,
+    )
+
+    def doc_generator():
+        for source_path in changed:
+            doc = frontmatter.load(pathlib.Path(manifest.source, source_path))
+            doc.source_path = source_path
+            if "id" not in doc.keys():
+                doc["id"] = pathlib.PurePath(source_path).stem
+            if not match or match in doc["id"]:
+                yield doc
+
+    b.process(doc_generator(), job_import_markdown_file)
+    if commit:
+        b.commit()
+        committer.add_all(factory.pop_touched())
+        committer.flush()
+        stale = list(manifest.stale_topic_ids())
+        if stale:
+            Topic.objects(id__in=stale).delete()
+            # Remove associations from the remaining topics to the removed ones
+            Topic._get_collection().update_many(
+                {"associations.t2": {"$in": stale}}, {"$pull": {"associations": {"t2": {"$in": stale}}}}
+            )
+        manifest.save()
+
+    print(b.summary_str())
+    print(f"Files: {len(changed)} added or changed, {len(manifest.deleted)} deleted, of {len(manifest.entries)} before")
+    if commit:
+        print(f"Saved topics: {dict(committer.stats)}, removed {len(stale)} topics no longer in any file")
+    return b
+
+
 topic_sheets_header = re.compile(r"^(?P<name>.*?)(?P<scope>\[[^]]+\])?\s*(?P<type>[#@&=])(?P<id>\w*)\s*$")
 cell_lists_w_comma = re.compile(r"\s*[/|,\n]\s*")
 cell_lists_wo_comma = re.compile(r"\s*[\n|]\s*")
@@ -16,19 +16,21 @@ from collections import namedtuple, OrderedDict
 from datetime import timedelta, date
 from urllib.parse import urlparse
 import hashlib
+import threading
 import dateutil
 
 
 import flask_mongoengine
 from babel import Locale
-from bson import ObjectId
+from bson import ObjectId, json_util
+from cachetools import TTLCache
 from dateutil.relativedelta import *
 from flask import current_app
 from flask import g, request, url_for
 from flask.json import load
 from flask_babel import lazy_gettext as _, get_locale, format_date, format_timedelta
 from jinja2 import TemplateNotFound
-from mongoengine import EmbeddedDocument, StringField, ReferenceField
+from mongoengine import DateTimeField, EmbeddedDocument, StringField, ReferenceField
 from mongoengine.base.fields import BaseField
 from mongoengine.queryset import Q
 from mongoengine.queryset.transform import STRING_OPERATORS
@@ -368,6 +370,14 @@ def reference_options(field_name, model, id_attr="slug", name_attr="title", extr
     if extra_options is None:
         extra_options = []
 
+    def options_from_values(ids, query):
+        field = query._document._fields[field_name]
+        document_type = getattr(field, "field", field).document_type  # Also support ListField(ReferenceField)
+        return [
+            FilterOption(kwargs={field_name: getattr(o, id_attr, str(o))}, label=getattr(o, name_attr, str(o)))
+            for o in document_type.objects(id__in=ids)
+        ] + extra_options
+
     def return_function(query=None):
         rv = []
         if query is None:
@@ -382,6 +392,8 @@ def reference_options(field_name, model, id_attr="slug", name_attr="title", extr
             logger.warning(f"Errors in reference option for field_name='{field_name}' and model='{model}'", exc_info=e)
         return rv
 
+    return_function.facet_field = field_name
+    return_function.options_from_values = options_from_values
     return return_function
 
 
@@ -467,6 +479,9 @@ from7to365 = [timedelta(days=7), timedelta(days=30), timedelta(days=90), timedel
 
 
 def distinct_options(field_name, model):
+    def options_from_values(values, query):
+        return [FilterOption(kwargs={field_name: v}, label=v) for v in values]
+
     def return_function(query):
         rv = []
         if query is None:
@@ -477,9 +492,69 @@ def distinct_options(field_name, model):
             logger.warning(f"Errors in reference option for field_name='{field_name}' and model='{model}'", e)
         return rv
 
+    return_function.facet_field = field_name
+    return_function.options_from_values = options_from_values
     return return_function
 
 
+# Short lived cache of filter options, keyed on model, fields and the filter of the query
+_filter_options_cache = None
+_filter_options_lock = threading.Lock()
+
+
+def facet_filter_options(query, option_functions):
+    """Populates filter options for several fields with one $facet aggregation, instead of one distinct query each.
+    Only works for option functions that are marked with facet_field, e.g. from reference_options and
+    distinct_options.
+
+    Arguments:
+        query {QuerySet} -- the filtered query to find distinct values in
+        option_functions {dict} -- filter option functions indexed by field name
+
+    Returns:
+        dict -- list of FilterOption indexed by field name
+    """
+    global _filter_options_cache
+    if not option_functions:
+        return {}
+    key = (
+        query._document.__name__,
+        tuple(sorted(option_functions.keys())),
+        json_util.dumps(query._query, sort_keys=True),
+    )
+    ttl = current_app.config.get("FILTER_OPTIONS_CACHE_TTL", 0) if current_app else 0
+    if ttl > 0:
+        with _filter_options_lock:
+            if _filter_options_cache is None:
+                _filter_options_cache = TTLCache(maxsize=512, ttl=ttl)
+            hit = _filter_options_cache.get(key, None)
+        if hit is not None:
+            return hit
+
+    facets = {}
+    for field_name, func in option_functions.items():
+        db_field = query._document._fields[func.facet_field].db_field
+        # Unwind makes list fields give each item as a value, same as distinct() does, and drops missing values
+        facets[field_name] = [{"$unwind": f"${db_field}"}, {"$group": {"_id": f"${db_field}"}}]
+    pipeline = [{"$match": query._query}] if query._query else []
+    pipeline.append({"$facet": facets})
+
+    rv = {}
+    try:
+        result = next(query._collection.aggregate(pipeline), {})
+        for field_name, func in option_functions.items():
+            values = [v["_id"] for v in result.get(field_name, []) if v["_id"] is not None]
+            rv[field_name] = func.options_from_values(values, query)
+    except Exception as e:
+        # Fall back to one distinct query per field
+        logger.warning(f"Errors in facet filter options for fields {list(option_functions.keys())}", exc_info=e)
+        return {field_name: func(query) for field_name, func in option_functions.items()}
+    if ttl > 0:
+        with _filter_options_lock:
+            _filter_options_cache[key] = rv
+    return rv
+
+
 class Address(EmbeddedDocument):
     name = StringField(max_length=60, verbose_name=_("Name"))
     street = StringField(max_length=60, verbose_name=_("Street"))
@@ -511,6 +586,17 @@ class StringGenerator(Document):
         return self.name
 
 
+class RenderedMarkdown(Document):
+    """Markdown rendered by MarkdownRenderer, for texts long enough to be worth persisting between processes and
+    restarts. Keyed on content hash and options, so edited texts just get a new entry and old ones expire."""
+
+    meta = {"indexes": [{"fields": ["created_at"], "expireAfterSeconds": 30 * 24 * 3600}]}
+
+    id = StringField(primary_key=True)
+    html = StringField()
+    created_at = DateTimeField(default=datetime.datetime.utcnow)
+
+
 def current_url(merge=False, toggle=False, **kwargs):
     """Gives a modified version of current URL in request
 
@@ -0,0 +1,213 @@
+import logging
+import re
+import threading
+from collections import Counter
+
+from cachetools import TTLCache
+from flask import current_app, url_for
+from markupsafe import Markup, escape
+
+from lore.model.topic import Topic
+from lore.model.world import Article, World
+
+logger = current_app.logger if current_app else logging.getLogger(__name__)
+
+# Languages we have stemming for in the text indexes, MongoDB accepts these ISO codes as $language
+search_languages = frozenset(["sv", "en"])
+
+# Fields to fetch for each hit, the rest of the document stays in the database
+article_hit_fields = {"title": 1, "slug": 1, "world": 1, "type": 1, "description": 1, "content": 1}
+topic_hit_fields = {"names.name": 1, "kind": 1, "occurrences.content": 1}
+
+markdown_chars = re.compile(r"[#*_>`|~]+|!?\[([^\]]*)\]\([^)]*\)|<[^>]+>")
+
+
+class SearchResults(object):
+    """Ranked hits from Articles and Topics, with counts of all matches by world and kind. Hits are plain dicts with
+    title, url, score, snippet, world and kind, so they can be cached and shared between requests."""
+
+    def __init__(self, q):
+        self.q = q
+        self.hits = []
+        self.total = 0
+        self.worlds = Counter()
+        self.kinds = Counter()
+
+    def add(self, hits, total, worlds, kinds):
+        self.hits.extend(hits)
+        self.total += total
+        self.worlds.update(worlds)
+        self.kinds.update(kinds)
+
+    def sort(self, limit):
+        self.hits.sort(key=lambda hit: hit["score"], reverse=True)
+        del self.hits[limit:]
+
+
+def search_terms(q):
+    """Returns the words to highlight from a search string, skipping negated words"""
+    return [t.strip('"').lower() for t in q.split() if t.strip('"') and not t.startswith("-")]
+
+
+def highlight_snippet(text, terms, width=200):
+    """Returns an escaped excerpt of about width characters around the first matching term, with all terms
+    wrapped in <mark>. Terms match as prefixes of words, with the last few characters cut off, as a rough
+    approximation of the stemming the text index does."""
+    if not text:
+        return Markup("")
+    text = " ".join(markdown_chars.sub(r"\1", text).split())
+    stems = sorted({t[: max(4, len(t) - 2)] for t in terms if t}, key=len, reverse=True)
+    if not stems:
+        return escape(text[:width])
+    matcher = re.compile(r"\b(%s)\w*" % "|".join(map(re.escape, stems)), re.IGNORECASE)
+    match = matcher.search(text)
+    start = 0
+    if match and match.start() > width // 3:
+        start = text.rfind(" ", 0, match.start() - width // 3) + 1
+    end = len(text) if len(text) <= start + width else text.rfind(" ", start, start + width)
+    end = end if end > start else start + width
+    excerpt = text[start:end]
+    rv = Markup("… " if start > 0 else "")
+    pos = 0
+    for m in matcher.finditer(excerpt):
+        rv += escape(excerpt[pos : m.start()]) + Markup("<mark>%s</mark>") % m.group(0)
+        pos = m.end()
+    rv += escape(excerpt[pos:])
+    return rv + Markup(" …") if end < len(text) else rv
+
+
+def text_pipeline(fields, facets, match=None, limit=20):
+    """Returns an aggregation that ranks the text matches and counts them by facet in one go. The match (e.g. a
+    selected world) narrows the hits and total, but not the facet counts, so other choices remain visible."""
+    narrowed = [{"$match": match}] if match else []
+    return [
+        {"$addFields": {"score": {"$meta": "textScore"}}},
+        {
+            "$facet": {
+                "hits": narrowed
+                + [{"$sort": {"score": -1}}, {"$limit": limit}, {"$project": dict(fields, score=1)}],
+                "total": narrowed + [{"$count": "count"}],
+                **{name: [{"$sortByCount": expr}] for name, expr in facets.items()},
+            }
+        },
+    ]
+
+
+def facet_counts(facet_result):
+    # Keeps the None group, e.g. articles without world, which are shown under the meta world
+    return {doc["_id"]: doc["count"] for doc in facet_result}
+
+
+def search_articles(query, q, terms, language=None, world=None, kind=None, limit=20):
+    match = {}
+    if world:
+        match["world"] = getattr(world, "id", None)  # WorldMeta has no id, and matches articles without world
+    if kind:
+        match["type"] = kind
+    facets = {"worlds": "$world", "kinds": "$type"}
+    rv = next(query.search_text(q, language).aggregate(text_pipeline(article_hit_fields, facets, match, limit)))
+    world_counts = facet_counts(rv["worlds"])
+    slugs = {w.id: w.slug for w in World.objects(id__in=list(world_counts)).only("slug")} if world_counts else {}
+    hits = []
+    for doc in rv["hits"]:
+        world_slug = slugs.get(doc.get("world", None), "meta")
+        hits.append(
+            {
+                "title": doc.get("title", ""),
+                "url": url_for("world.ArticlesView:get", world_=world_slug, id=doc.get("slug", None)),
+                "score": doc["score"],
+                "snippet": highlight_snippet(doc.get("description", None) or doc.get("content", None), terms),
+                "world": world_slug,
+                "kind": doc.get("type", None),
+            }
+        )
+    worlds = Counter()
+    for world_id, count in world_counts.items():
+        worlds[slugs.get(world_id, "meta")] += count
+    total = rv["total"][0]["count"] if rv["total"] else 0
+    return hits, total, worlds, facet_counts(rv["kinds"])
+
+
+def search_topics(topic_path, q, terms, language=None, world=None, kind=None, limit=20):
+    match = {}
+    if world:
+        match["_id"] = {"$regex": "^%s/" % re.escape(f"{topic_path}/{world.slug}")}
+    if kind:
+        match["kind"] = kind
+    # Topic ids are publisher/world/topic, so the world is the second part of the id
+    facets = {"worlds": {"$arrayElemAt": [{"$split": ["$_id", "/"]}, 1]}, "kinds": "$kind"}
+    query = Topic.objects(id__startswith=f"{topic_path}/").search_text(q, language)
+    rv = next(query.aggregate(text_pipeline(topic_hit_fields, facets, match, limit)))
+    hits = []
+    for doc in rv["hits"]:
+        score = doc.pop("score")
+        topic = Topic._from_son(doc)
+        hits.append(
+            {
+                "title": topic.name,
+                "url": topic.as_article_url(),
+                "score": score,
+                "snippet": highlight_snippet(" ".join(o.content or "" for o in topic.occurrences), terms),
+                "world": topic.id.split("/")[1] if topic.id.count("/") > 1 else "meta",
+                "kind": doc.get("kind", None),
+            }
+        )
+    worlds = Counter()
+    for world_slug, count in facet_counts(rv["worlds"]).items():
+        worlds[world_slug or "meta"] += count
+    total = rv["total"][0]["count"] if rv["total"] else 0
+    return hits, total, worlds, facet_counts(rv["kinds"])
+
+
+# Short lived cache of search results, keyed on everything that changes the result, including who is asking, as
+# the articles are filtered on what the user can read. Not invalidated on saves, so the TTL should be short.
+_search_cache = None
+_search_cache_lock = threading.Lock()
+
+
+def get_search_cache():
+    global _search_cache
+    if _search_cache is None:
+        _search_cache = TTLCache(
+            maxsize=current_app.config.get("SEARCH_CACHE_SIZE", 500), ttl=current_app.config.get("SEARCH_CACHE_TTL", 60)
+        )
+    return _search_cache
+
+
+def search_publisher(publisher, q, articles, language=None, world=None, kind=None, limit=20, cache_key=None):
+    """Searches the Articles in the queryset articles (already filtered on what the user can read) and the Topics
+    of the publisher, with one aggregation per collection. Results are cached if a cache_key, identifying the
+    articles filter, is given."""
+    language = language if language in search_languages else None
+    if cache_key is not None and current_app.config.get("SEARCH_CACHE_TTL", 0):
+        key = (cache_key, publisher.id, q, language, world.slug if world else None, kind, limit)
+        with _search_cache_lock:
+            rv = get_search_cache().get(key, None)
+        if rv is None:
+            rv = search_publisher(publisher, q, articles, language, world, kind, limit)
+            with _search_cache_lock:
+                get_search_cache()[key] = rv
+        return rv
+
+    terms = search_terms(q)
+    rv = SearchResults(q)
+    rv.add(*search_articles(articles, q, terms, language, world, kind, limit))
+    rv.add(*search_topics(publisher.slug, q, terms, language, world, kind, limit))
+    rv.sort(limit)
+    return rv
+
+
+def migrate_text_indexes():
+    """Drops text indexes that aren't the ones declared on Article and Topic, e.g. the earlier unweighted ones, as a
+    collection can only have one text index, and then creates the declared ones. Returns the dropped index names."""
+    dropped = []
+    for model in (Article, Topic):
+        specs = model._meta["index_specs"]
+        text_index_names = {i.get("name", None) for i in specs if "text" in dict(i["fields"]).values()}
+        collection = model._get_collection()
+        for index in list(collection.list_indexes()):
+            if "text" in index["key"].values() and index["name"] not in text_index_names:
+                collection.drop_index(index["name"])
+                dropped.append(f"{collection.name}.{index['name']}")
+        model.ensure_indexes()
+    return dropped
@@ -23,6 +23,7 @@ from mongoengine import (
     ReferenceField,
     StringField,
     URLField,
+    signals,
 )
 from mongoengine.errors import DoesNotExist, ValidationError
 from mongoengine.fields import DictField
@@ -198,7 +199,7 @@ class Product(Document):
         super(Product, self).delete()
 
     def is_owned_by_current_user(self):
-        return g.user and self in products_owned_by_user(g.user)
+        return is_entitled(g.user, products=self.id)
 
     def __str__(self):
         """A string representation suitable for display to end users. Call with !s after variable in f-strings."""
@@ -435,23 +436,107 @@ Order.updated.filter_options = datetime_delta_options(
 )
 
 
+class Entitlement(Document):
+    """A materialized view of what a user owns, i.e. the products of all paid or shipped orders and the
+    downloadable assets of those products. Kept up to date when orders are saved, and can be fully rebuilt
+    with the `rebuild-entitlements` command."""
+
+    meta = {"indexes": ["products", "assets"]}
+
+    user = ReferenceField(User, unique=True, reverse_delete_rule=CASCADE, verbose_name=_("User"))
+    products = ListField(ReferenceField(Product), verbose_name=_("Products"))
+    assets = ListField(ReferenceField(FileAsset), verbose_name=_("Assets"))
+    updated = DateTimeField(default=datetime.utcnow, verbose_name=_("Updated"))
+
+    def __repr__(self):
+        return (
+            f"{self.__class__}('{self.pk!r}', '{self.user!r}', "
+            f"{len(self.products)} products, {len(self.assets)} assets)"
+        )
+
+
+def rebuild_entitlements(user):
+    """Recalculates the entitlement of a user from its orders and returns it."""
+    product_ids = set()
+    orders = Order.objects(user=user, status__in=[OrderStatus.paid, OrderStatus.shipped]).only("order_lines")
+    for order in orders.as_pymongo():
+        for order_line in order.get("order_lines", []):
+            if order_line.get("product"):
+                product_ids.add(order_line["product"])
+    asset_ids = set()
+    for product in Product.objects(id__in=list(product_ids)).only("downloads").as_pymongo():
+        asset_ids.update(product.get("downloads", []))
+
+    # Upsert so we never have more than one entitlement per user, also if two orders are saved concurrently
+    Entitlement.objects(user=user).update_one(
+        upsert=True,
+        set__products=sorted(product_ids),
+        set__assets=sorted(asset_ids),
+        set__updated=datetime.utcnow(),
+    )
+    return Entitlement.objects(user=user).first()
+
+
+def get_entitlement(user):
+    if not user:
+        return None
+    return Entitlement.objects(user=user).first() or rebuild_entitlements(user)
+
+
+def is_entitled(user, **query):
+    """Checks if the user's entitlement matches query, e.g. assets=asset_id, which is a single indexed lookup.
+    Users without an entitlement yet (e.g. no rebuild has been run since they ordered) get one built first."""
+    if not user:
+        return False
+    if Entitlement.objects(user=user, **query).count(with_limit_and_skip=True):
+        return True
+    if Entitlement.objects(user=user).count(with_limit_and_skip=True):
+        return False
+    rebuild_entitlements(user)
+    return Entitlement.objects(user=user, **query).count(with_limit_and_skip=True) > 0
+
+
 def products_owned_by_user(user):
-    products = set()
-    if user:
-        orders = Order.objects(user=user, status__in=[OrderStatus.paid, OrderStatus.shipped]).only("order_lines")
-        for order in orders:
-            for order_line in order.order_lines:
-                if order_line.product:
-                    products.add(order_line.product)
-    return products
+    entitlement = get_entitlement(user)
+    # Dereferences all products in one query, and skips any that have been deleted
+    return {p for p in entitlement.products if isinstance(p, Product)} if entitlement else set()
 
 
 def user_has_asset(user, asset):
-    products = products_owned_by_user(user)
-    for p in products:
-        if p.downloads and asset in p.downloads:
-            return True
-    return False
+    return bool(asset) and is_entitled(user, assets=asset.id)
+
+
+def has_changed(document, field):
+    """True if field was changed in the save being signalled, also in place, e.g. order_lines.0.product"""
+    # Only _get_changed_fields() collects the changes inside embedded documents
+    return any(f == field or f.startswith(f"{field}.") for f in document._get_changed_fields())
+
+
+def update_entitlements_on_order(sender, document, created=False, **kwargs):
+    # Only orders that are, or just stopped being, paid or shipped change what a user owns
+    if document.user and (
+        (created and document.is_paid_or_shipped())
+        or has_changed(document, "status")
+        or (document.is_paid_or_shipped() and has_changed(document, "order_lines"))
+    ):
+        rebuild_entitlements(document.user)
+
+
+def update_entitlements_on_order_delete(sender, document, **kwargs):
+    if document.user and document.is_paid_or_shipped():
+        rebuild_entitlements(document.user)
+
+
+def update_entitlements_on_product(sender, document, created=False, **kwargs):
+    if not created and has_changed(document, "downloads"):
+        for entitlement in Entitlement.objects(products=document.id).only("user").no_dereference():
+            rebuild_entitlements(entitlement._data["user"])
+
+
+# Note that QuerySet.update() does not send signals, so orders changed that way needs a `rebuild-entitlements`
+signals.post_save.connect(update_entitlements_on_order, sender=Order)
+signals.post_delete.connect(update_entitlements_on_order_delete, sender=Order)
+signals.post_save.connect(update_entitlements_on_product, sender=Product)
 
 
 def parse_price(p_string):
@@ -912,7 +997,8 @@ def import_order(data, job=None, commit=False, create=True, if_newer=True):
             ev.metric = order.total_price_sek()
             ev.created = order.created
             ev.save()
-            order.user.save()  # Recalculates XP
+            order.user.recalculate_xp()  # As the event may be new or have a new metric
+            order.user.save()
 
     return order
 
@@ -1,6 +1,7 @@
 import json
 import logging
 import re
+import unicodedata
 from datetime import datetime, timedelta
 from typing import List, Union, Any
 from os.path import join
@@ -19,6 +20,8 @@ from mongoengine import (
     StringField,
 )
 from mongoengine.base import LazyReference
+from pymongo import UpdateOne
+from pymongo.errors import OperationFailure
 from mongoengine.queryset.queryset import QuerySet
 
 from lore.model.misc import (
@@ -49,6 +52,24 @@ def clean_scopes(scopes, remove_scope_set=set()):
     return scopes
 
 
+# Letters that are letters of their own in Swedish, and not a with accents, so they keep their own initial in name keys
+own_letters = frozenset("åäöæø")
+
+
+def name_key(name):
+    """Returns a normalized key of a name for prefix matching and sorting: casefolded, without accents (except on
+    own_letters) and with whitespace collapsed. E.g. "  Élan  Ödegård" becomes "elan ödegård"."""
+    if not name:
+        return ""
+    chars = []
+    for c in unicodedata.normalize("NFC", name.casefold()):
+        if c in own_letters:
+            chars.append(c)
+        else:
+            chars.extend(d for d in unicodedata.normalize("NFKD", c) if not unicodedata.combining(d))
+    return " ".join("".join(chars).split())
+
+
 def scopes_to_str(scopes):
     return ",".join(map(get_id, scopes))
 
@@ -57,7 +78,19 @@ LORE_BASE = "lore.pub/t/"
 LANG_SCOPES = set([f"{LORE_BASE}sv", f"{LORE_BASE}en"])
 
 
-class Name(EmbeddedDocument):
+class Characteristic(EmbeddedDocument):
+    """A name, occurrence or association of a Topic"""
+
+    meta = {"abstract": True}
+
+    def _mark_as_changed(self, key):
+        # Changing an item in place, e.g. its name, kind or scopes, makes the indexes of its topic stale
+        super()._mark_as_changed(key)
+        if self._instance is not None:
+            self._instance.invalidate_indexes()
+
+
+class Name(Characteristic):
     name = RegexQueriableStringField()
     scopes = ListField(LazyReferenceField("Topic"))  # Expected to always be sorted
 
@@ -65,7 +98,7 @@ class Name(EmbeddedDocument):
         return self.name if not self.scopes else f"{self.name} ({scopes_to_str(self.scopes)})"
 
 
-class Occurrence(EmbeddedDocument):
+class Occurrence(Characteristic):
     uri = StringField()
     content = StringField()  # Could be any inline data?
     kind = LazyReferenceField("Topic")
@@ -96,7 +129,7 @@ class Occurrence(EmbeddedDocument):
         return out
 
 
-class Association(EmbeddedDocument):
+class Association(Characteristic):
     r1 = LazyReferenceField("Topic")  # E.g. Employs
     kind = LazyReferenceField("Topic")  # E.g. Employment
     r2 = LazyReferenceField("Topic")  # E.g. employed by
@@ -131,6 +164,53 @@ class Association(EmbeddedDocument):
 unset = "UNSET"
 
 
+def lazy_ref_id(ref):
+    """Returns the id of a LazyReference, or None"""
+    return ref.id if ref else None
+
+
+class ListIndex:
+    """In-memory index over one of the lists of names, occurrences or associations on a Topic.
+    Each item is stored with its position and its scopes as a frozenset, and grouped by the values
+    that the functions in keys give for it. Lookups on a key return items in list order.
+    """
+
+    def __init__(self, keys, items=()):
+        self.keys = keys
+        self.entries = []
+        self.by = {k: {} for k in keys}
+        self.memo = {}  # Anything derived from the whole list, e.g. groupings
+        for i, item in enumerate(items):
+            self.add(i, item)
+
+    def add(self, i, item):
+        entry = (i, item, frozenset(map(get_id, item.scopes)))
+        self.entries.append(entry)
+        for key, key_func in self.keys.items():
+            self.by[key].setdefault(key_func(item), []).append(entry)
+        self.memo.clear()
+
+    def candidates(self, **query):
+        """Returns the entries matching the first key in query that has a value, or all entries. The caller
+        has to check the rest of the query on the returned entries."""
+        for key, value in query.items():
+            if value != unset:
+                return self.by[key].get(value, [])
+        return self.entries
+
+
+# Keys to index each list of characteristics on, in order of how selective they usually are
+index_keys = {
+    "names": {"name": lambda x: x.name, "lower_name": lambda x: x.name.lower() if x.name else x.name},
+    "occurrences": {"kind": lambda x: lazy_ref_id(x.kind)},
+    "associations": {
+        "t2": lambda x: lazy_ref_id(x.t2),
+        "r1": lambda x: lazy_ref_id(x.r1),
+        "kind": lambda x: lazy_ref_id(x.kind),
+    },
+}
+
+
 # Queries
 # Find from publisher: find({_id:/^lore.pub/})
 # Topics with name in English: find({"names.scopes": "lore.pub/t/en"})  - picks documents where en is in scopes
@@ -145,7 +225,16 @@ unset = "UNSET"
 
 class Topic(Document):
     meta = {
-        "indexes": ["kind", "names.name", {"fields": ["$names.name", "$occurrences.content"]}],
+        "indexes": [
+            "kind",
+            "names.name",
+            "name_key",
+            {
+                "fields": ["$names.name", "$occurrences.content"],
+                "weights": {"names.name": 10, "occurrences.content": 1},
+                "name": "topic_text",
+            },
+        ],
         # 'auto_create_index': True
     }
 
@@ -153,6 +242,7 @@ class Topic(Document):
     kind = LazyReferenceField("Topic", verbose_name=_("Type"))
     created_at = DateTimeField(default=datetime.utcnow, verbose_name=_("Created"))
     updated_at = DateTimeField(default=datetime.utcnow)
+    name_key = StringField()  # name_key() of the first name, kept in sync by clean(), for prefix search and sorting
 
     names = EmbeddedDocumentListField(Name, verbose_name=_("Name"))
     occurrences = EmbeddedDocumentListField(Occurrence)
@@ -160,6 +250,34 @@ class Topic(Document):
 
     def clean(self):
         self.updated_at = datetime.utcnow()
+        self.name_key = name_key(self.names[0].name) if self.names else None
+
+    def _mark_as_changed(self, key):
+        # Any change to a list of characteristics makes its index stale
+        if key and getattr(self, "_indexes", None):
+            self._indexes.pop(key.split(".", 1)[0], None)
+        super()._mark_as_changed(key)
+
+    def get_index(self, field: str) -> ListIndex:
+        """Returns an index of the names, occurrences or associations of this topic, built on first use and
+        dropped when the list or any item in it changes."""
+        if getattr(self, "_indexes", None) is None:
+            self._indexes = {}
+        index = self._indexes.get(field, None)
+        if index is None:
+            index = self._indexes[field] = ListIndex(index_keys[field], getattr(self, field))
+        return index
+
+    def invalidate_indexes(self):
+        self._indexes = None
+
+    def append_indexed(self, field: str, item):
+        """Appends item to the list field and adds it to the existing index, instead of rebuilding it."""
+        index = self.get_index(field)
+        items = getattr(self, field)
+        items.append(item)  # Marks the field as changed, which drops the index
+        index.add(len(items) - 1, item)
+        self._indexes[field] = index
 
     @property  # For convenience
     def name(self):
@@ -252,12 +370,15 @@ class Topic(Document):
         if scopes != unset:
             scopes = set(map(get_id, scopes))
 
+        index = self.get_index("names")
+        if name != unset and case_insensitive:
+            candidates = index.candidates(lower_name=name.lower())
+        else:
+            candidates = index.candidates(name=name)
         # Scopes match if provided scopes is a subset of the name's scopes
         found = []
-        for i, x in enumerate(self.names):
-            if (name == unset or name == x.name or (case_insensitive and name.lower() == x.name.lower())) and (
-                scopes == unset or scopes <= set(map(get_id, x.scopes))
-            ):
+        for i, x, x_scopes in candidates:
+            if scopes == unset or scopes <= x_scopes:
                 found.append((i, x)) if indices else found.append(x)
                 if first:  # Return early for speed
                     return found[0]
@@ -277,14 +398,15 @@ class Topic(Document):
         """
         if scopes != unset:
             scopes = set(map(get_id, scopes))
+        if kind != unset:
+            kind = get_id(kind)
 
         found = []
-        for i, x in enumerate(self.occurrences):
+        for i, x, x_scopes in self.get_index("occurrences").candidates(kind=kind):
             if (
                 (uri == unset or uri == x.uri)
                 and (content == unset or content == x.content)
-                and (kind == unset or get_id(kind) == get_id(x.kind))
-                and (scopes == unset or scopes <= set(map(get_id, x.scopes)))
+                and (scopes == unset or scopes <= x_scopes)
             ):
                 found.append((i, x)) if indices else found.append(x)
                 if first:  # Return early for speed
@@ -308,13 +430,13 @@ class Topic(Document):
             scopes = set(map(get_id, scopes))
 
         found = []
-        for i, x in enumerate(self.associations):
+        for i, x, x_scopes in self.get_index("associations").candidates(t2=t2, r1=r1, kind=kind):
             if (
-                (r1 == unset or r1 == x.r1.id)
-                and (kind == unset or kind == x.kind.id)
-                and (r2 == unset or r2 == x.r2.id)
-                and (t2 == unset or t2 == x.t2.id)
-                and (scopes == unset or scopes <= set(map(get_id, x.scopes)))
+                (r1 == unset or r1 == lazy_ref_id(x.r1))
+                and (kind == unset or kind == lazy_ref_id(x.kind))
+                and (r2 == unset or r2 == lazy_ref_id(x.r2))
+                and (t2 == unset or t2 == lazy_ref_id(x.t2))
+                and (scopes == unset or scopes <= x_scopes)
             ):
                 found.append((i, x)) if indices else found.append(x)
                 if first:  # Return early for speed
@@ -322,6 +444,12 @@ class Topic(Document):
         return found if not first else None
 
     def occurrences_grouped(self):
+        index = self.get_index("occurrences")
+        if "grouped" not in index.memo:
+            index.memo["grouped"] = self._group_occurrences(index)
+        return index.memo["grouped"]
+
+    def _group_occurrences(self, index):
         groups = {
             "wide_image": [],
             "heading_image": [],
@@ -332,7 +460,7 @@ class Topic(Document):
             "stat": [],
             "rest": [],
         }
-        for occ in self.occurrences:
+        for _i, occ, _scopes in index.entries:
             if occ.kind.pk == f"{LORE_BASE}wide_image":
                 groups["wide_image"].append(occ)
             if occ.kind.pk == f"{LORE_BASE}heading_image":
@@ -355,8 +483,9 @@ class Topic(Document):
 
     def associations_by_r1(self, topic_dict=None):
         out = {}
-        for a in self.associations:
-            out.setdefault(a.r1 or "none", []).append(a)
+        for entries in self.get_index("associations").by["r1"].values():
+            # Key on the reference of the first association, as all in the group refer to the same r1
+            out[entries[0][1].r1 or "none"] = [a for _i, a, _scopes in entries]
         if topic_dict:  # TODO, we need this to cheaply look up names, but it's not very clean to pass it in here
             for ass in out.values():
                 ass.sort(key=lambda a: topic_dict.get(a.t2.pk).name if a.t2.pk in topic_dict else a.t2.pk)
@@ -373,6 +502,8 @@ class Topic(Document):
     # 		{"source":0,"target":2,"weight":3}
     # 	]
     def associations_as_graph(self, topic_dict=None):
+        if topic_dict is None:
+            topic_dict = self.load_neighbourhood()
         nodes = []
         links = []
         nodes.append({"id": self.pk, "name": self.name})
@@ -383,7 +514,7 @@ class Topic(Document):
                 links.append({"source": 0, "target": i + 1})
         return {"nodes": nodes, "links": links}
 
-    def query_all_referenced_topics(self) -> QuerySet:
+    def referenced_topic_ids(self) -> set:
         topics_to_get = {self.kind.pk} if self.kind else set()
         for name in self.names:
             topics_to_get.update([t.pk for t in name.scopes])
@@ -401,8 +532,54 @@ class Topic(Document):
                 topics_to_get.add(ass.t2.pk)
             if ass.kind.pk:
                 topics_to_get.add(ass.kind.pk)
+        return topics_to_get
 
-        return Topic.objects(id__in=topics_to_get)
+    def query_all_referenced_topics(self) -> QuerySet:
+        return Topic.objects(id__in=self.referenced_topic_ids())
+
+    def load_neighbourhood(self, depth=0, fields=("names", "kind")) -> dict:
+        """Loads all topics referenced by this topic, and the topics associated with those up to depth steps
+        away, in one $graphLookup query. Returns a dict of id to Topic, with only the given fields loaded.
+        """
+        start_ids = sorted(self.referenced_topic_ids())
+        if not start_ids:
+            return {}
+        fields = list(fields)
+        pipeline = [
+            {"$match": {"_id": self.pk}},
+            {
+                "$graphLookup": {
+                    "from": Topic._get_collection_name(),
+                    "startWith": {"$literal": start_ids},
+                    "connectFromField": "associations.t2",
+                    "connectToField": "_id",
+                    "maxDepth": depth,
+                    "as": "neighbourhood",
+                }
+            },
+            {"$unwind": "$neighbourhood"},
+            {"$replaceRoot": {"newRoot": "$neighbourhood"}},
+            {"$project": {f: 1 for f in fields}},
+        ]
+        try:
+            docs = list(Topic._get_collection().aggregate(pipeline, comment="Topic neighbourhood"))
+        except (OperationFailure, NotImplementedError) as e:
+            # Databases without $graphLookup, we walk the graph instead with one query per level
+            logger.warning(f"Falling back to one query per level to load neighbourhood of {self.pk}: {e}")
+            docs, seen, to_get = [], set(), set(start_ids)
+            for _level in range(depth + 1):
+                seen.update(to_get)
+                level_docs = list(
+                    Topic.objects(id__in=list(to_get)).only(*fields, "associations.t2").as_pymongo()
+                )
+                docs.extend(level_docs)
+                to_get = {a["t2"] for d in level_docs for a in d.get("associations", []) if "t2" in a} - seen
+                if "associations" not in fields:
+                    for d in level_docs:
+                        d.pop("associations", None)
+                if not to_get:
+                    break
+        return {d["_id"]: Topic._from_son(d, only_fields=fields) for d in docs}
 
     def add_name(self, name: str, scopes=None, index=-1):
         """ Add a new name unless equal to existing name and scopes in list.
@@ -425,7 +602,7 @@ class Topic(Document):
             if index > -1:
                 self.names.insert(index, Name(name=name, scopes=scopes))
             else:
-                self.names.append(Name(name=name, scopes=scopes))
+                self.append_indexed("names", Name(name=name, scopes=scopes))
 
     def add_occurrence(self, uri=None, content=None, kind=None, scopes=None):
         """ Add a new occurrence unless identical with existing.
@@ -442,7 +619,7 @@ class Topic(Document):
         # If two occurrences have same uri/description/kind but different scopes, are they different?
         # Or should we just add the scope to existing?
         if not self.find_occurrences(uri, content, kind, scopes, first=True):
-            self.occurrences.append(Occurrence(uri=uri, content=content, kind=kind, scopes=scopes))
+            self.append_indexed("occurrences", Occurrence(uri=uri, content=content, kind=kind, scopes=scopes))
 
     def add_association(
         self,
@@ -460,14 +637,14 @@ class Topic(Document):
 
         found = self.find_associations(r1=r1, kind=kind, r2=r2, t2=t2 if isinstance(t2, str) else t2.id, first=True)
         if not found:
-            self.associations.append(Association(t2=t2, kind=kind, r1=r1, r2=r2, scopes=scopes,))
+            self.append_indexed("associations", Association(t2=t2, kind=kind, r1=r1, r2=r2, scopes=scopes,))
         if two_way:
             # Fetch reference if we got an id. Otherwise, we assume we have a Topic object already (supporting use without a database)
             if isinstance(t2, str):
                 t2 = Topic.objects(id=t2).get()
             # On other topic, "this" and "other" will be reversed.
             if not t2.find_associations(r1=r2, kind=kind, r2=r1, t2=self.id, first=True):
-                t2.associations.append(Association(t2=self, kind=kind, r1=r2, r2=r1, scopes=scopes,))
+                t2.append_indexed("associations", Association(t2=self, kind=kind, r1=r2, r2=r1, scopes=scopes,))
 
     def __str__(self):
         return f"{self.name} ({self.id}, {self.created_at})"
@@ -481,6 +658,44 @@ Topic.created_at.filter_options = datetime_delta_options(
 )
 # Topic.kind.filter_options = distinct_options("kind", Topic)
 
+
+def suggest_topics(prefix, topic_path, limit=10):
+    """Returns up to limit topics under topic_path (e.g. publisher/world) whose first name starts with prefix, as
+    dicts for autocomplete widgets. Case and accents are ignored by matching on name_key, with an anchored regex
+    that is answered from the name_key index."""
+    key = name_key(prefix)
+    if not key:
+        return []
+    topics = Topic.objects(name_key__startswith=key, id__startswith=f"{topic_path}/").order_by("name_key")
+    rv = []
+    for doc in topics.only("names").limit(limit).as_pymongo():
+        rv.append(
+            {
+                "value": doc["_id"],
+                "text": doc["names"][0]["name"],
+                "url": Topic(id=doc["_id"]).as_article_url(),
+            }
+        )
+    return rv
+
+
+def update_name_keys(chunk_size=1000):
+    """Sets name_key on topics that lack it or have an outdated one, e.g. if saved before it existed or written
+    without clean(). Returns the number of updated topics."""
+    collection = Topic._get_collection()
+    operations, count = [], 0
+    for doc in collection.find({}, {"names.name": 1, "name_key": 1}):
+        names = doc.get("names", None)
+        key = name_key(names[0].get("name", None)) if names else None
+        if doc.get("name_key", None) != key:
+            operations.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"name_key": key}}))
+        if len(operations) >= chunk_size:
+            count += collection.bulk_write(operations, ordered=False).modified_count
+            operations = []
+    if operations:
+        count += collection.bulk_write(operations, ordered=False).modified_count
+    return count
+
 # instance( this_topic : r1, t2 : r2 ) / scope,scope2 or instance( this_topic, t2 )
 # https://regex101.com/r/VvDDdW/1/
 ltm_association_pattern = r"(.+?)\( ?(.+?)(?: ?: ?(.+?))?, ?(.+?)(?: ?: ?(.+?))? ?\)(?: ?\/ (.+))?"  # 6 capture groups
@@ -506,9 +721,14 @@ class TopicFactory:
         default_scopes: List[str] = None,
         default_associations: List[str] = None,
         topic_dict=None,
+        preload: bool = False,
     ):
         self.default_bases = default_bases or []
         self.topic_dict = topic_dict if topic_dict is not None else {}
+        self.touched = set()  # Ids of topics handed out by make_topic, that may have been changed
+        self.known_ids = None  # If preloaded, all ids under default_bases, so we don't need to query for misses
+        if preload:
+            self.preload_ids()
         self.default_scopes = [self.basify(s) for s in (default_scopes or [])]
         self.default_associations = []
         # If we have default associations, parse a string like this
@@ -559,17 +779,60 @@ class TopicFactory:
             return str(id)  # Already a full ID
         else:
             joined = ""
-            user = "@" in id
-            for base in self.default_bases:
-                # if @ in id, it's a user, so id@base.com . Otherwise base.com/id
-                joined = id + base.split("/", 1)[0] if user else join(base, id)
-                if self.fetch_topic(joined) is not None:
+            # if @ in id, it's a user, so id@base.com . Otherwise base.com/id
+            for joined in self.candidate_ids(id):
+                if (self.known_ids is not None and joined in self.known_ids) or self.fetch_topic(joined) is not None:
                     break
             return joined  # Will intentionally be the last one if none of the bases existed
 
+    def pop_touched(self) -> List[Topic]:
+        """Returns the topics touched since last call, e.g. to save them."""
+        touched, self.touched = self.touched, set()
+        return [self.topic_dict[id] for id in touched if self.topic_dict.get(id)]
+
+    def candidate_ids(self, id: str) -> List[str]:
+        """All ids that basify may return for id, in order of the bases."""
+        if not self.default_bases or domain_id.match(id) or user_id.match(id):
+            return [str(id)]
+        if "@" in id:
+            return [id + base.split("/", 1)[0] for base in self.default_bases]
+        return [join(base, id) for base in self.default_bases]
+
+    def is_under_bases(self, id: str) -> bool:
+        return any(
+            id.startswith(join(base, "")) or id.endswith("@" + base.split("/", 1)[0]) for base in self.default_bases
+        )
+
+    def preload_ids(self):
+        """Loads the ids of all topics under default_bases with one query, so that basify and fetch_topic
+        can answer misses from memory."""
+        patterns = []
+        for base in self.default_bases:
+            patterns.append({"_id": {"$regex": f"^{re.escape(join(base, ''))}"}})
+            patterns.append({"_id": {"$regex": f"@{re.escape(base.split('/', 1)[0])}$"}})
+        if patterns:
+            cursor = Topic._get_collection().find({"$or": patterns}, {"_id": 1})
+            self.known_ids = {doc["_id"] for doc in cursor}
+
+    def prefetch(self, ids, chunk_size=1000):
+        """Loads all topics that ids could basify to, with one query per chunk_size candidates. Candidates
+        that don't exist are cached as misses, so later calls to basify and fetch_topic need no queries."""
+        to_fetch = []
+        for id in ids:
+            if id:
+                to_fetch.extend(c for c in self.candidate_ids(slugify(id, ok=PATH_OK)) if c not in self.topic_dict)
+        to_fetch = list(dict.fromkeys(to_fetch))  # Remove duplicates but keep order
+        for i in range(0, len(to_fetch), chunk_size):
+            chunk = to_fetch[i : i + chunk_size]
+            found = {t.pk: t for t in Topic.objects(id__in=chunk)}
+            for id in chunk:
+                self.topic_dict[id] = found.get(id, None)
+
     def fetch_topic(self, id: str) -> Topic:
         if id in self.topic_dict:
             return self.topic_dict[id]
+        elif self.known_ids is not None and id not in self.known_ids and self.is_under_bases(id):
+            return None  # We know it's not in the database
         else:
             t = Topic.objects(id=id).first()
             # Even if t is None, cache it, as it will save a roundtrip to DB
@@ -607,6 +870,7 @@ class TopicFactory:
             topic = Topic(id=based_id)
             # TODO save it?
             self.topic_dict[based_id] = topic
+        self.touched.add(based_id)
 
         if based_id.startswith(LORE_BASE) and not creating:
             # Don't modify LORE_BASE topics, they should always exist in correct format from before
@@ -7,11 +7,16 @@
 
   :copyright: (c) 2014 by Helmgast AB
 """
+from collections import Counter
 from datetime import datetime
 from hashlib import md5
 
+import atexit
 import math
+import queue
 import re
+import threading
+import time
 
 from flask import flash, request
 
@@ -41,13 +46,14 @@ from mongoengine import (
     EmailField,
     EmbeddedDocumentField,
     FloatField,
-    ValidationError,
     DoesNotExist,
     NULLIFY,
     DENY,
     CASCADE,
     Q,
 )
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 
 import logging
 from flask import current_app
@@ -162,6 +168,7 @@ class User(Document, BaseUser):
 
         changed_orders = Order.objects(user=remove_user).update(multi=True, user=self)
         changed_events = Event.objects(user=remove_user).update(multi=True, user=self)
+        self.recalculate_xp()
         # TODO also move FileAssets and Articles
         if remove_user.description and not self.description:
             self.description = remove_user.description
@@ -182,17 +189,10 @@ class User(Document, BaseUser):
         return msg
         # keep_user will be saved when we return out of this func
 
-    def clean(self):
-        # if self.username and self.location and self.description and self.images:
-        #     # Profile is completed
-        #     self.log(action='completed_profile', resource=self)  # metric is 1
-        try:
-            self.recalculate_xp()
-        except ValidationError as ve:
-            # May come if we try to count objects referring to this user, while the user hasn't been created yet
-            pass
+    # XP is kept up to date with $inc as events are logged, see EventWriter
 
     def recalculate_xp(self):
+        """Sets xp to the sum of all events, e.g. after events have been changed. Returns True if it changed."""
         xp = Event.objects(user=self).sum("xp")
         if xp != self.xp:
             self.xp = xp
@@ -224,11 +224,13 @@ class User(Document, BaseUser):
         return "%s (%s)" % (self.username, self.realname)
 
     def log(self, action, resource, message="", metric=1.0, created=None):
+        """Logs an event by this user. It is written in the background with other events, which also awards
+        its XP, so the returned event has no xp yet."""
         ev = Event(user=self, action=action, resource=resource, message=message, metric=metric)
         if created is not None:
             ev.created = created
-        ev.save()
-        return ev.xp
+        write_event(ev)
+        return ev
 
     def identities_by_email(self):
         """Returns a dict with emails as keys and values as a list of providers linked to that email.
@@ -345,8 +347,11 @@ class Event(Document):
 
     @staticmethod
     def calculate_xp(event):
-        if event.action in xp_actions:
-            count = len(Event.objects(user=event.user, action=event.action)) + 1
+        if event.action in xp_actions and event.user:
+            if event.pk:
+                # Already counted when first saved, so only the metric can have changed the XP
+                return xp_actions[event.action]["func"](event.metric) if event.xp else 0
+            count = EventCounter.increment(event.user, event.action)
             if is_power(count, xp_actions[event.action]["base"]):
                 xp = xp_actions[event.action]["func"](event.metric)
                 if xp and request:  # If request context, otherwise don't show flash
@@ -363,6 +368,144 @@ class Event(Document):
         return 0
 
 
+class EventCounter(Document):
+    """Number of events per user and action, so that XP throttling doesn't need to count all previous events"""
+
+    meta = {"indexes": [{"fields": ["user", "action"], "unique": True}]}
+    user = ReferenceField(User, reverse_delete_rule=CASCADE)
+    action = StringField(max_length=62)
+    count = IntField(default=0)
+
+    @staticmethod
+    def increment(user, action):
+        """Atomically counts one more event of action by user, and returns the new count"""
+        counter = EventCounter._get_collection().find_one_and_update(
+            {"user": user.id, "action": action},
+            {"$inc": {"count": 1}},
+            projection={"count": True},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return counter["count"]
+
+
+def rebuild_event_counters():
+    """Recounts EventCounters and the XP of all users from the stored events, e.g. for events logged before the
+    counters existed. Returns the number of counters."""
+    counters = Event.objects(user__ne=None).aggregate(
+        [{"$group": {"_id": {"user": "$user", "action": "$action"}, "count": {"$sum": 1}, "xp": {"$sum": "$xp"}}}]
+    )
+    xp_by_user = Counter()
+    operations = []
+    for counter in counters:
+        key = counter["_id"]
+        operations.append(UpdateOne(key, {"$set": {"count": counter["count"]}}, upsert=True))
+        xp_by_user[key["user"]] += counter["xp"]
+    if operations:
+        EventCounter._get_collection().bulk_write(operations, ordered=False)
+        User._get_collection().bulk_write(
+            [UpdateOne({"_id": user_id}, {"$set": {"xp": xp}}) for user_id, xp in xp_by_user.items()], ordered=False
+        )
+    return len(operations)
+
+
+class EventWriter(object):
+    """Writes logged events from a background thread in batches, counting them and awarding XP with $inc, so
+    that logging doesn't add database round trips to the request. Events still queued when the process exits
+    are lost, except on a normal exit when the queue is flushed."""
+
+    def __init__(self, batch_size=100, flush_interval=1.0, max_queued=10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(max_queued)
+        self.thread = None
+        self.lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def put(self, event):
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self.run, name="EventWriter", daemon=True)
+                    self.thread.start()
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            logger.warning("Event queue is full, writing event in request")
+            self.write([event])
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.exception(f"Failed to write {len(batch)} events: {e}")
+            finally:
+                for event in batch:
+                    self.queue.task_done()
+
+    def flush(self):
+        """Blocks until all queued events are written"""
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    @staticmethod
+    def write(events):
+        xp_by_user = Counter()
+        for event in events:
+            event.xp = Event.calculate_xp(event)
+            if event.xp:
+                xp_by_user[event.user.id] += event.xp
+        try:
+            Event._get_collection().insert_many([event.to_mongo() for event in events], ordered=False)
+        except BulkWriteError as e:
+            # E.g. same user, action and time from a double submit. The other events in the batch are still written.
+            for error in e.details.get("writeErrors", []):
+                event = events[error["index"]]
+                logger.warning(f"Failed to write event {event.action} by {event.user}: {error.get('errmsg', None)}")
+                if event.xp:
+                    xp_by_user[event.user.id] -= event.xp
+                if event.user and event.action in xp_actions:
+                    EventCounter.objects(user=event.user, action=event.action).update_one(dec__count=1)
+        for user_id, xp in xp_by_user.items():
+            if xp:
+                User.objects(id=user_id).update_one(inc__xp=xp)
+
+
+_event_writer = None
+_event_writer_lock = threading.Lock()
+
+
+def get_event_writer():
+    global _event_writer
+    if _event_writer is None:
+        with _event_writer_lock:
+            if _event_writer is None:
+                _event_writer = EventWriter(
+                    batch_size=current_app.config.get("EVENT_BATCH_SIZE", 100),
+                    flush_interval=current_app.config.get("EVENT_FLUSH_INTERVAL", 1.0),
+                    max_queued=current_app.config.get("EVENT_QUEUE_SIZE", 10000),
+                )
+    return _event_writer
+
+
+def write_event(event):
+    """Queues event for the background EventWriter, or writes it directly if there is no app or queue configured.
+    The event is validated first, so an invalid event still raises ValidationError in the caller."""
+    event.validate(clean=False)  # clean() would count the event, which the writer does when writing it
+    if current_app and current_app.config.get("EVENT_QUEUE_SIZE", 0) > 0:
+        get_event_writer().put(event)
+    else:
+        EventWriter.write([event])
+
+
 # When we add an Event, we check below formulas for XP per metric.
 # However, we need to throttle new XP, which we do by counting number of same action from same user before
 # We do this with an exponential period, which means we award XP with an ever-growing interval. Different XP actions
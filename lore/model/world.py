@@ -10,9 +10,11 @@
 
 import logging
 import re
+import threading
 from datetime import datetime, timedelta
 
-from flask import current_app, g, url_for
+from cachetools import TTLCache
+from flask import abort, current_app, g, has_app_context, url_for
 from flask_babel import lazy_gettext as _
 from mongoengine import (
     DENY,
@@ -29,6 +31,7 @@ from mongoengine import (
     ReferenceField,
     StringField,
     URLField,
+    signals,
 )
 from mongoengine.fields import MapField
 from mongoengine.queryset import Q
@@ -146,14 +149,21 @@ Publisher.register_delete_rule(User, "publishers_newsletters", NULLIFY)
 def filter_authorized_by_publisher(publisher=None):
     if not g.user:
         return Q(id=EMPTY_ID)
-    if not publisher:
-        # Check all publishers
-        return Q(publisher__in=Publisher.objects(Q(editors__all=[g.user]) | Q(readers__all=[g.user])))
-    elif g.user in publisher.editors or g.user in publisher.readers:
-        # Save some time and only check given publisher
-        return Q(publisher__in=[publisher])
-    else:
+    publisher_ids = get_access_scope().readable_publishers
+    if publisher:
+        # Only check given publisher
+        publisher_ids = publisher_ids & {publisher.id}
+    return Q(publisher__in=list(publisher_ids)) if publisher_ids else Q(id=EMPTY_ID)
+
+
+def filter_authorized_by_world(world=None):
+    if not g.user:
         return Q(id=EMPTY_ID)
+    world_ids = get_access_scope().readable_worlds
+    if world:  # WorldMeta is falsy, so counts as all worlds
+        # Only check given world
+        world_ids = world_ids & {world.id}
+    return Q(world__in=list(world_ids)) if world_ids else Q(id=EMPTY_ID)
 
 
 class World(Document):
@@ -302,6 +312,144 @@ class WorldMeta(object):
         return Article.objects(publisher=self.publisher, world=None).order_by("-created_date")
 
 
+# Process local registry of Publisher and World documents, keyed on (model name, slug). They are looked up on every
+# request but rarely change. Saves and deletes in this process clear the registry, other processes rely on the TTL.
+# Note that QuerySet.update() does not send signals, so such changes will also only be seen after the TTL.
+# The registry keeps the raw documents and each lookup gets its own instance, so that a request changing a
+# publisher or world can't affect other requests.
+_registry = None
+# Access scopes keyed on user id, invalidated together with the registry. As for the registry, changes in other
+# processes are only seen after the TTL, which here means a revoked editor or reader keeps access for that long.
+_access_scopes = None
+_registry_lock = threading.Lock()
+
+
+def get_registry_caches():
+    """Returns the registry and access scope caches, each None if disabled. Call with _registry_lock held."""
+    global _registry, _access_scopes
+    if not current_app:
+        return None, None
+    size = current_app.config.get("PUBLISHER_CACHE_SIZE", 1000)
+    if _registry is None and current_app.config.get("PUBLISHER_CACHE_TTL", 0) > 0:
+        _registry = TTLCache(maxsize=size, ttl=current_app.config["PUBLISHER_CACHE_TTL"])
+    if _access_scopes is None and current_app.config.get("ACCESS_SCOPE_CACHE_TTL", 0) > 0:
+        _access_scopes = TTLCache(maxsize=size, ttl=current_app.config["ACCESS_SCOPE_CACHE_TTL"])
+    return _registry, _access_scopes
+
+
+def _registry_lookup(model, slug):
+    key = (model.__name__, slug)
+    with _registry_lock:
+        registry = get_registry_caches()[0]
+        son = registry.get(key, False) if registry is not None else False
+    if son is False:
+        son = model.objects(slug=slug).as_pymongo().first()
+        if registry is not None:
+            with _registry_lock:
+                registry[key] = son  # Also caches misses, to avoid a roundtrip for each bad URL
+    return model._from_son(son) if son is not None else None
+
+
+def invalidate_registry(sender=None, document=None, **kwargs):
+    with _registry_lock:
+        for cache in (_registry, _access_scopes):
+            if cache is not None:
+                cache.clear()
+    if has_app_context():
+        g.pop("access_scope", None)
+
+
+def resolve_publisher_world(pub_host, world_slug=None, or_404=True):
+    """Returns a (publisher, world) tuple using the process local registry. World is None if no world_slug is given,
+    and WorldMeta if it is "meta". Aborts with 404 if either is missing, unless or_404 is False, in which case
+    missing documents are returned as None.
+    """
+    publisher = _registry_lookup(Publisher, pub_host)
+    if not publisher and or_404:
+        abort(404)
+    if not world_slug:
+        world = None
+    elif world_slug == "meta":
+        world = WorldMeta(publisher) if publisher else None
+    else:
+        world = _registry_lookup(World, world_slug)
+        if not world and or_404:
+            abort(404)
+    return publisher, world
+
+
+def ref_id(doc, field):
+    """Returns the id of a reference field, without dereferencing it if it isn't already"""
+    ref = doc._data.get(field, None)
+    return getattr(ref, "id", None)
+
+
+def ref_ids(doc, field):
+    """Returns the set of ids in a list of reference fields, without dereferencing it if it isn't already"""
+    return {getattr(ref, "id", ref) for ref in doc._data.get(field, None) or []}
+
+
+class AccessScope:
+    """The ids of the publishers and worlds a user is editor or reader of. Lets us filter articles on a couple of
+    id lists, and answer access checks for articles, without dereferencing or querying publishers and worlds."""
+
+    def __init__(self, user):
+        self.user_id = user.id
+        self.editor_publishers, self.reader_publishers = self.member_ids(Publisher, user)
+        self.editor_worlds, self.reader_worlds = self.member_ids(World, user)
+
+    @staticmethod
+    def member_ids(model, user):
+        editor_of, reader_of = set(), set()
+        for doc in model.objects(Q(editors=user) | Q(readers=user)).only("editors", "readers").as_pymongo():
+            if user.id in doc.get("editors", []):
+                editor_of.add(doc["_id"])
+            if user.id in doc.get("readers", []):
+                reader_of.add(doc["_id"])
+        return editor_of, reader_of
+
+    @property
+    def readable_publishers(self):
+        return self.editor_publishers | self.reader_publishers
+
+    @property
+    def readable_worlds(self):
+        return self.editor_worlds | self.reader_worlds
+
+    def is_editor(self, publisher_id=None, world_id=None):
+        return publisher_id in self.editor_publishers or world_id in self.editor_worlds
+
+    def is_reader(self, publisher_id=None, world_id=None):
+        return publisher_id in self.reader_publishers or world_id in self.reader_worlds
+
+
+def get_access_scope(user=None):
+    """Returns the AccessScope of user, default the current user, computing it at most once per request, or once
+    per ACCESS_SCOPE_CACHE_TTL if set."""
+    user = user or g.user
+    if not user:
+        return None
+    scope = g.get("access_scope", None) if has_app_context() else None
+    if scope is not None and scope.user_id == user.id:
+        return scope
+    with _registry_lock:
+        access_scopes = get_registry_caches()[1]
+        scope = access_scopes.get(user.id, None) if access_scopes is not None else None
+    if scope is None:
+        scope = AccessScope(user)
+        if access_scopes is not None:
+            with _registry_lock:
+                access_scopes[user.id] = scope
+    if has_app_context() and user == g.get("user", None):
+        g.access_scope = scope
+    return scope
+
+
+for _model in (Publisher, World):
+    signals.post_save.connect(invalidate_registry, sender=_model)
+    signals.post_delete.connect(invalidate_registry, sender=_model)
+
+
 class RelationType(Document):
     name = StringField()  # human friendly name
 
@@ -450,7 +598,15 @@ class RemoteImage:
 
 class Article(Document):
     meta = {
-        "indexes": ["slug", {"fields": ["$title", "$content", "$tags"]}],
+        "indexes": [
+            "slug",
+            # Text index for search, stemmed by the language of each article (the default language_override field)
+            {
+                "fields": ["$title", "$description", "$content", "$tags"],
+                "weights": {"title": 10, "tags": 5, "description": 3, "content": 1},
+                "name": "article_text",
+            },
+        ],
         # 'auto_create_index': True
     }
     slug = StringField(unique=True, required=False, max_length=62)
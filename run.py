@@ -6,7 +6,7 @@ import sys
 import click
 
 from lore.app import create_app
-from tools.batch import Batch, Column, LogLevel, bulk_update
+from tools.batch import LogLevel, bulk_update
 
 
 # from https://blog.theodo.com/2020/05/debug-flask-vscode/
@@ -43,9 +43,12 @@ def initdb():
 @app.cli.command()
 @click.option("-u", "--url", required=False, help="Test an URL for which route it picks")
 @click.option("-m", "--method", required=False, default="GET", help="Method to test")
-def show_routes(url, method):
+@click.option("--stats", is_flag=True, help="Show rule counts and the cost of matching instead of the routes")
+def show_routes(url, method, stats):
     from urllib.parse import urlparse
 
+    if stats:
+        return show_route_stats(method)
     rows = [
         (str(i), rule.__repr__().replace("LoreRule ", ""), str(rule.match_compare_key()))
         for i, rule in enumerate(sorted(app.url_map.iter_rules(), key=lambda rule: rule.match_compare_key()))
@@ -65,6 +68,41 @@ def show_routes(url, method):
         print(test + "  ".join((val.ljust(width) for val, width in zip(row, widths))))
 
 
+def show_route_stats(method, repeat=100):
+    from collections import Counter
+    from timeit import timeit
+    from werkzeug.exceptions import HTTPException
+    from werkzeug.routing import MapAdapter
+
+    rules = list(app.url_map.iter_rules())
+    print(f"{len(rules)} rules for {len(set(rule.endpoint for rule in rules))} endpoints")
+    for host, count in Counter(rule.host or "(any)" for rule in rules).most_common():
+        print(f"  {count:5} rules with host {host}")
+
+    # Time matching the path of each rule without arguments, through the rules and from the cache
+    adapter = app.url_map.bind(app.config["DEFAULT_HOST"])
+    samples = []
+    for rule in rules:
+        if rule.arguments <= {"pub_host"} and (not rule.methods or method in rule.methods):
+            adapter.server_name = app.config["DEFAULT_HOST"] if "<" in rule.host else rule.host
+            try:
+                adapter.match(rule.rule, method)
+                samples.append((adapter.server_name, rule.rule))
+            except HTTPException:
+                pass  # E.g. redirects, or an earlier rule that matches with another method
+    uncached, cached = 0, 0
+    for host, path in samples:
+        adapter.server_name = host
+        uncached += timeit(lambda: MapAdapter.match(adapter, path, method), number=repeat) / repeat
+        cached += timeit(lambda: adapter.match(path, method), number=repeat) / repeat
+    if samples:
+        print(f"Matching {len(samples)} paths, average through rules: {uncached / len(samples) * 1e6:.0f} us", end="")
+        if app.url_map.match_cache is not None:
+            print(f", from cache: {cached / len(samples) * 1e6:.0f} us", end="")
+        print()
+    print(f"Match cache: {dict(app.url_map.match_stats)}")
+
+
 # @app.cli.command()
 # @click.option('--host', '-h', default='127.0.0.1',
 #               help='The interface to bind to.')
@@ -282,6 +320,52 @@ def merge_users(ctx, main_user, merge_in):
     print(rv)
 
 
+@app.cli.command()
+@click.option("-u", "--user", "user_id", required=False, help="Only rebuild for this user id")
+def rebuild_entitlements(user_id=None):  # Run as rebuild-entitlements
+    from lore.model.shop import Entitlement, Order, OrderStatus, rebuild_entitlements
+    from lore import extensions
+
+    extensions.db.init_app(app)
+    if user_id:
+        user_ids = [user_id]
+    else:
+        # Users with paid orders, plus users that have an entitlement that may no longer be valid
+        user_ids = set(Order.objects(status__in=[OrderStatus.paid, OrderStatus.shipped]).no_dereference().distinct("user"))
+        user_ids.update(Entitlement.objects().no_dereference().distinct("user"))
+    with click.progressbar(user_ids, label="Rebuilding entitlements") as bar:
+        for uid in bar:
+            rebuild_entitlements(getattr(uid, "id", uid))
+    print(f"Rebuilt entitlements for {len(user_ids)} users")
+
+
+@app.cli.command()
+def rebuild_event_counters():  # Run as rebuild-event-counters
+    from lore.model.user import rebuild_event_counters
+    from lore import extensions
+
+    extensions.db.init_app(app)
+    print(f"Rebuilt {rebuild_event_counters()} event counters and the XP of their users")
+
+
+@app.cli.command()
+def migrate_text_indexes():  # Run as migrate-text-indexes
+    from lore.model.search import migrate_text_indexes
+    from lore import extensions
+
+    extensions.db.init_app(app)
+    print(f"Dropped text indexes: {', '.join(migrate_text_indexes()) or 'none'}")
+
+
+@app.cli.command()
+def update_topic_name_keys():  # Run as update-topic-name-keys
+    from lore.model.topic import update_name_keys
+    from lore import extensions
+
+    extensions.db.init_app(app)
+    print(f"Updated name_key of {update_name_keys()} topics")
+
+
 @app.cli.command()
 @click.argument("url_or_id", required=True)
 @click.argument("model", required=True)
@@ -318,6 +402,8 @@ def merge_users(ctx, main_user, merge_in):
     default=[],
     help="Comma separated list of association statements as per LTM. 'This topic' part will be ignored.",
 )
+@click.option("--workers", default=0, type=int, help="Run jobs in parallel in this many threads")
+@click.option("--commit-every", default=0, type=int, help="Save imported topics in chunks of this size while running")
 def import_sheet(url_or_id, model, **kwargs):
     from tools.import_sheets import import_data
     from mongoengine.connection import get_db
@@ -336,6 +422,7 @@ def import_sheet(url_or_id, model, **kwargs):
 )
 @click.option("--log-level", default="INFO")
 @click.option("-l", "--limit", default=10, type=int, help="Maximum amounts of items to import")
+@click.option("--workers", default=0, type=int, help="Run jobs in parallel in this many threads")
 def import_gdrive(folder_id, **kwargs):
 
     from tools.import_gdrive import import_all_gridfs
@@ -365,6 +452,7 @@ def check_gdrive(google_id, **kwargs):
 @click.option("--vatrate", required=False, help="VAT Rate to apply to all orders")
 @click.option("--title", required=False, help="Overall import title")
 @click.option("--sourceurl", required=False, help="Source URL to add to all orders")
+@click.option("--workers", default=0, type=int, help="Run jobs in parallel in this many threads")
 def import_textalk(model, **kwargs):
     from tools.import_textalk import import_articles, import_orders
     from mongoengine.connection import get_db
@@ -400,6 +488,8 @@ def setup_topics():
 @click.option("--ignore-dates", is_flag=True, help="Ignores dates from YAML in import Markdown")
 @click.option("-l", "--limit", default=0, help="Only process this many jobs")
 @click.option("-m", "--match", default="", help="Only process jobs with this match string in id")
+@click.option("--chunk-size", default=500, type=int, help="Save topics in chunks of this size")
+@click.option("--full", is_flag=True, help="Import all files, not just those changed since the last import")
 @click.option("--github-wiki", default="", help="The path to a github wiki where this is sourced")
 @click.option(
     "-b",
@@ -423,52 +513,11 @@ def setup_topics():
     help="Comma separated list of association statements as per LTM. 'This topic' part will be ignored.",
 )
 def import_markdown_topics(path, **kwargs):
-    from lore.model.topic import LORE_BASE, Topic, TopicFactory
-    from lore.model.import_topic import job_import_topic
-    from mongoengine.connection import get_db
+    from lore.model.import_topic import import_markdown_topics
     from lore import extensions
-    import pathlib
-    import frontmatter
 
     extensions.db.init_app(app)
-    db = get_db()
-
-    columns = [
-        Column("ID", "id", "id"),
-        Column("TITLE", "title", "name"),
-        Column("CREATED", "created_at", "created_at"),
-    ]
-
-    # Adds list of scopes to all characteristics, e.g. "community-content" or a specific author.
-    commit = kwargs.pop("commit", False)
-    match = kwargs.pop("match")
-    default_bases = kwargs.pop("default_bases")
-    default_scopes = kwargs.pop("default_scopes")
-    default_associations = kwargs.pop("default_associations")
-    factory = TopicFactory(default_bases, default_scopes, default_associations)
-
-    b = Batch(
-        f"Import markdown files from path {path}",
-        table_columns=columns,
-        dry_run=not commit,
-        topic_factory=factory,
-        **kwargs,
-    )
-
-    def doc_generator(markdown_files_path, match):
-        p = pathlib.Path(markdown_files_path)
-        for file in p.glob("**/*.md"):
-            doc = frontmatter.load(file)
-            if "id" not in doc.keys():
-                doc["id"] = file.stem
-            if not match or match in doc["id"]:
-                yield doc
-
-    b.process(doc_generator(path, match), job_import_topic)
-    if commit:
-        bulk_update(Topic, factory.topic_dict.values())
-
-    print(b.summary_str())
+    import_markdown_topics(path, **kwargs)
 
 
 @app.cli.command()
@@ -479,9 +528,13 @@ def import_markdown_topics(path, **kwargs):
 @click.option("--log-level", default="WARN")
 @click.option("--bugreport", is_flag=True)
 @click.option("--no-metadata", is_flag=True)
-def wikitext_to_markdown(wiki_xml_file, output_folder, filter, dry_run, log_level, bugreport, no_metadata):
+@click.option("--workers", default=0, type=int, help="Run jobs in parallel in this many threads")
+@click.option("--processes", is_flag=True, help="Run the workers as processes, as conversion is mostly CPU bound")
+def wikitext_to_markdown(
+    wiki_xml_file, output_folder, filter, dry_run, log_level, bugreport, no_metadata, workers, processes
+):
     from tools.batch import Batch, Column
-    from tools.import_mediawiki import wikitext_generator, job_wikitext_to_markdown
+    from tools.import_mediawiki import wikitext_generator, unique_pages, job_wikitext_to_markdown
 
     # from mongoengine.connection import get_db
     # from lore import extensions
@@ -501,10 +554,13 @@ def wikitext_to_markdown(wiki_xml_file, output_folder, filter, dry_run, log_leve
         bugreport=bugreport,
         no_metadata=no_metadata,
         filter=filter,
-        all_pages={},
         out_folder=out_folder,
+        workers=workers,
+        executor="process" if processes else None,
+        unit="pages",
     )
-    b.process(wikitext_generator(wiki_xml_file), job_wikitext_to_markdown)
+    # Page ids are decided while reading, so jobs don't need to share state and can run in any order
+    b.process(unique_pages(wikitext_generator(wiki_xml_file), bugreport=bugreport), job_wikitext_to_markdown)
     print(b.summary_str())
 
 
@@ -583,6 +639,8 @@ def file_upload(file, title, desc, access):
 @click.option("--user", help="User ID to fingerprint with", required=True)
 def pdf_fingerprint(input, output, user):
     """Will manually fingerprint a PDF file."""
+    from lore.api.pdf import fingerprint_pdf
+
     print("Fingerprinting user %s from file %s into file %s" % (user, input, output))
     with open(output, "wb") as f:
         with open(input, "rb") as f2:
@@ -594,6 +652,8 @@ def pdf_fingerprint(input, output, user):
 @click.option("--input", help="PDF file to check for fingerprints")
 def pdf_check(input):
     """Will scan a PDF for matching fingerprints"""
+    from lore.api.pdf import fingerprint_from_user, get_fingerprints
+
     fps = get_fingerprints(input)
     from lore.model.user import User
 
@@ -608,3 +668,58 @@ def pdf_check(input):
                 print("User %s matches fingerprint %s in document %s" % (user, fp, input))
                 exit(1)
     print("No match for any user in document %s" % (input))
+
+
+@app.cli.command()
+@click.option("--input", help="Markdown file to benchmark with, otherwise a short generated text is used")
+@click.option("-n", "--repeat", default=1000, type=int, help="Number of conversions per path")
+def md_benchmark(input, repeat):  # Run as md-benchmark
+    """Compares converting Markdown with a new Markdown instance per call, with the per thread instance of app.md."""
+    import markdown
+    from timeit import timeit
+
+    if input:
+        with open(input, "r") as f:
+            text = f.read()
+    else:
+        text = "# Title\n\nSome *text* with a [link](https://lore.pub).\n\n- gallery-center\n- ![Image](image.png)\n"
+    renderer = app.md
+    renderer.render(text)  # Builds the instance for this thread
+    fresh = timeit(lambda: renderer.build().convert(text), number=repeat) / repeat
+    pooled = timeit(lambda: renderer.render(text), number=repeat) / repeat
+    print(f"Converting {len(text)} chars with {markdown.__name__} {markdown.__version__}")
+    print(f"New instance: {fresh * 1e6:.0f} us, reused instance: {pooled * 1e6:.0f} us ({fresh / pooled:.1f}x)")
+
+
+@app.cli.command()
+@click.option("--input", help="PDF file to benchmark with, otherwise a generated file is used")
+@click.option("-s", "--size", default=200, type=int, help="Size in MB of generated file")
+@click.option("-n", "--repeat", default=3, type=int, help="Number of runs per path")
+def pdf_benchmark(input, size, repeat):  # Run as pdf-benchmark
+    """Compares fingerprinting a PDF by scanning it, with using precomputed offsets."""
+    import io
+    from timeit import timeit
+    from lore.api.pdf import fingerprint_pdf
+    from lore.model.asset import find_fingerprint_offsets
+
+    if input:
+        with open(input, "rb") as f:
+            data = f.read()
+    else:
+        # Ids placed like in a typical PDF: fonts and XMP early, the trailer at the end
+        filler = b"0 0 obj <</Length 20>> stream\nxxxxxxxxxxxxxxxxxxxx\nendstream endobj\n" * (size * 1024 * 16)
+        data = (
+            b"%PDF-1.6\n<</FontFamily(Goudy Old Style)>>\n<xmpMM:DocumentID>xmp.did:E9E3ECA55654E311B947ECCF20247A3D"
+            + filler
+            + b"trailer\n<</Size 5226/ID[<DE237A7714166B438254F2E7CAEACB2B><0A856D2F0DE97146B3FC7DBBA75F5CEB>]>>\n%%EOF"
+        )
+    offsets = find_fingerprint_offsets(io.BytesIO(data))
+    print(f"Benchmarking {len(data) / 1024 / 1024:.1f} MB, found offsets {offsets}")
+
+    def consume(stream):
+        for _buf in stream:
+            pass
+
+    scan = timeit(lambda: consume(fingerprint_pdf(io.BytesIO(data), "user")), number=repeat) / repeat
+    indexed = timeit(lambda: consume(fingerprint_pdf(io.BytesIO(data), "user", offsets)), number=repeat) / repeat
+    print(f"Scanning: {scan * 1000:.1f} ms, with offsets: {indexed * 1000:.1f} ms ({scan / indexed:.1f}x)")
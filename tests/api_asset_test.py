@@ -0,0 +1,64 @@
+from datetime import datetime
+from io import BytesIO
+
+import pytest
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+
+class GridOutMock(BytesIO):
+    # Enough of GridOut for send_gridfs_file, with 16 byte chunks
+    length, upload_date, md5, content_type, name = 100, datetime(2020, 1, 1), "abc", "application/pdf", "test.pdf"
+
+    def readchunk(self):
+        return self.read(16 - self.tell() % 16)
+
+
+def test_send_gridfs_file_ranges(app_client):
+    from lore.api.asset import send_gridfs_file
+    from lore.api.pdf import fingerprint_from_user
+
+    data = bytes(range(100))
+
+    def get(**headers):
+        with app_client.application.test_request_context(headers=headers):
+            rv = send_gridfs_file(GridOutMock(data))
+            return rv.status_code, rv.headers, b"".join(rv.response)
+
+    status, headers, body = get()
+    assert (status, body, headers["Accept-Ranges"]) == (200, data, "bytes")
+
+    # A single range within and across GridFS chunks
+    status, headers, body = get(Range="bytes=10-40")
+    assert (status, body, headers["Content-Range"]) == (206, data[10:41], "bytes 10-40/100")
+    assert headers["Content-Length"] == "31"
+    assert get(Range="bytes=-5")[2] == data[-5:]
+    assert get(Range="bytes=95-200")[2] == data[95:]
+
+    status, headers, body = get(Range="bytes=0-1,50-52")
+    assert status == 206 and headers["Content-Type"].startswith("multipart/byteranges")
+    assert b"Content-Range: bytes 0-1/100\r\n\r\n" + data[0:2] in body
+    assert b"Content-Range: bytes 50-52/100\r\n\r\n" + data[50:53] in body
+    assert int(headers["Content-Length"]) == len(body)
+
+    with pytest.raises(RequestedRangeNotSatisfiable):
+        get(Range="bytes=100-")
+    # Send whole file if the client has an old version
+    assert get(Range="bytes=0-1", **{"If-Range": '"oldetag"'})[0] == 200
+
+    # Fingerprints are applied also when only part of them is within the range
+    with app_client.application.test_request_context(headers={"Range": "bytes=15-25"}):
+        rv = send_gridfs_file(GridOutMock(data), fingerprint_user_id="user", fingerprint_offsets={"pdf_id": 20})
+        assert b"".join(rv.response) == data[15:20] + fingerprint_from_user("user")[:6]
+
+
+def test_fingerprint_pdf():
+    from lore.api.pdf import fingerprint_from_user, fingerprint_pdf
+
+    data = b"%PDF <</FontFamily(Goudy Old Style)>> <xmpMM:DocumentID>xmp.did:E9E3ECA55654E311B947ECCF20247A3D "
+    data += b"trailer\n<</Size 5226/ID[<DE237A7714166B438254F2E7CAEACB2B>]>>\n%%EOF"
+    offsets = {"font_id": 19, "doc_id": 64, "pdf_id": 122}
+
+    uid = fingerprint_from_user("user")
+    expected = data.replace(b"Goudy Old St", uid).replace(b"E9E3ECA55654", uid).replace(b"DE237A771416", uid)
+    assert b"".join(fingerprint_pdf(GridOutMock(data), "user", offsets)) == expected
+    assert b"".join(fingerprint_pdf(GridOutMock(data), "user")) == expected
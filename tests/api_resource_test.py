@@ -96,3 +96,142 @@ def test_set_form_fields_errors():
     general_errors = set_form_fields_errors(errors, order_form)
     assert order_form.errors == {"shipping_address": {"city": ["invalid"]}}
     assert general_errors == ["title/en/: invalid"]
+
+
+@pytest.fixture()
+def shortcuts_view(app_client, mongomock):
+    from lore.api.resource import FilterableFields, ResourceAccessPolicy, ResourceView
+    from lore.model.world import Shortcut
+
+    class ShortcutsCursorView(ResourceView):
+        access_policy = ResourceAccessPolicy()
+        model = Shortcut
+        list_template = "world/shortcut_list.html"
+        filterable_fields = FilterableFields(Shortcut, ["slug", "hits"])
+        cursor_pagination = True
+
+    for i in range(5):
+        Shortcut(slug=f"short{i}", hits=i % 2).save()
+    return ShortcutsCursorView
+
+
+def test_cursor_pagination(app_client, shortcuts_view):
+    from lore.api.resource import ListResponse
+    from lore.model.world import Shortcut
+
+    ShortcutsCursorView = shortcuts_view
+
+    slugs, after = [], ""
+    for page in range(3):
+        with app_client.application.test_request_context(f"/?per_page=2&order_by=-hits&after={after}"):
+            r = ListResponse(ShortcutsCursorView, [("shortcuts", Shortcut.objects())])
+            r.finalize_query()
+            slugs.append([s.slug for s in r.query])
+            after = r.pagination.next_after
+            assert r.pagination.has_next == (page < 2)
+            assert r.pagination.count == 5
+
+    # Sorted on hits, then on id in same direction, e.g. latest created first
+    assert slugs == [["short3", "short1"], ["short4", "short2"], ["short0"]]
+
+
+def test_cursor_pagination_nulls(app_client, shortcuts_view):
+    from lore.api.resource import ListResponse
+    from lore.model.world import Shortcut
+
+    Shortcut.objects(slug__in=["short1", "short2"]).update(unset__hits=True)
+
+    def page_through(order_by, facet=False):
+        slugs, after = [], ""
+        for page in range(4):
+            with app_client.application.test_request_context(f"/?per_page=2&order_by={order_by}&after={after}"):
+                r = ListResponse(shortcuts_view, [("shortcuts", Shortcut.objects())])
+                r.finalize_query(facet=facet)
+                slugs += [s.slug for s in r.query]
+                after = r.pagination.next_after
+                if not r.pagination.has_next:
+                    return slugs
+
+    # Missing hits sort first ascending and last descending, and each step of the cursor still reaches them
+    assert page_through("hits") == ["short1", "short2", "short0", "short4", "short3"]
+    assert page_through("-hits") == ["short3", "short4", "short0", "short2", "short1"]
+    assert page_through("-hits", facet=True) == ["short3", "short4", "short0", "short2", "short1"]
+
+
+def test_facet_pagination(app_client, shortcuts_view):
+    from lore.api.resource import ListResponse
+    from lore.model.world import Shortcut
+
+    summary = {"total_hits": {"$sum": "$hits"}}
+    with app_client.application.test_request_context("/?per_page=2&order_by=-hits"):
+        r = ListResponse(shortcuts_view, [("shortcuts", Shortcut.objects(slug__ne="short4"))])
+        r.finalize_query(summary=summary)
+        assert [s.slug for s in r.query] == ["short3", "short1"]
+        assert r.pagination.count == 4
+        assert r.summary == {"total_hits": 2}
+        after = r.pagination.next_after
+
+    with app_client.application.test_request_context(f"/?per_page=2&order_by=-hits&after={after}"):
+        r = ListResponse(shortcuts_view, [("shortcuts", Shortcut.objects(slug__ne="short4"))])
+        r.finalize_query(summary=summary)
+        assert [s.slug for s in r.query] == ["short2", "short0"]
+        assert not r.pagination.has_next
+
+    shortcuts_view.cursor_pagination = False
+    with app_client.application.test_request_context("/?per_page=2&page=2&order_by=hits"):
+        r = ListResponse(shortcuts_view, [("shortcuts", Shortcut.objects())])
+        r.finalize_query(facet=True)
+        assert [s.slug for s in r.query] == ["short4", "short1"]
+        assert r.pagination.pages == 3
+        assert r.summary is None
+
+
+def test_prefetch(app_client, mongomock):
+    from lore.api.resource import prefetch
+    from lore.model.shop import Order, OrderLine, Product
+    from lore.model.user import User
+    from lore.model.world import Publisher
+
+    with app_client.application.test_request_context():
+        u1 = User(email="test@test.com").save()
+        pub = Publisher(slug="helmgast.se", title="Helmgast AB").save()
+        p1 = Product(product_number="EON-808", title_i18n={"en": "Strid"}, publisher=pub, type="book").save()
+        p2 = Product(product_number="EON-809", title_i18n={"en": "Drakar"}, publisher=pub, type="book").save()
+        Order(
+            user=u1, publisher=pub, external_key="o1", order_lines=[OrderLine(product=p1), OrderLine(product=p2)]
+        ).save()
+        Order(user=u1, external_key="o2", order_lines=[OrderLine(product=p2), OrderLine(title="Gift")]).save()
+
+        orders = prefetch(Order.objects(), "user", "publisher", "order_lines.product")
+        assert len(orders) == 2
+        # References are replaced by documents, e.g. won't be dereferenced on access
+        assert orders[0]._data["user"] == u1 and isinstance(orders[0]._data["user"], User)
+        assert isinstance(orders[0]._data["publisher"], Publisher)
+        assert orders[1]._data["publisher"] is None
+        assert [ol._data["product"] for ol in orders[0].order_lines] == [p1, p2]
+        assert isinstance(orders[1].order_lines[0]._data["product"], Product)
+        assert not orders[0]._get_changed_fields()
+
+
+def test_authorize_memo(app_client, mongomock):
+    from flask import g
+    from lore.model.user import User
+    from lore.model.world import Publisher
+    from lore.api.world import PublisherAccessPolicy
+
+    policy = PublisherAccessPolicy()
+    with app_client.application.test_request_context():
+        hg = Publisher(slug="helmgast.se", title="Helmgast AB").save()
+        user = User(email="editor@helmgast.se").save()
+        hg.editors = [user]
+        hg.save()
+        g.user = user
+        auth = policy.authorize("edit", res=hg)
+        assert auth and policy.authorize("patch", res=hg) is auth  # Memoized for the rest of the request
+        assert policy.authorize("edit", res=hg) is auth
+
+        # Unsaved changes are not memoized, and saving drops the memo
+        hg.editors = []
+        assert not policy.authorize("edit", res=hg)
+        hg.save()
+        assert not policy.authorize("edit", res=hg)
@@ -19,3 +19,33 @@ def basic_app_data(app_client, mongomock):
 
 # def test_publishers_view(app_client, basic_app_data):
 #     pass
+
+
+def test_page_cache(app_client):
+    from flask import Response, g
+    from lore.api.world import cache_page_response, cached_page_response, invalidate_page_cache, page_cache_key
+
+    app = app_client.application
+    with app.test_request_context("/neotech/mr-neo", headers={"Accept": "text/html"}):
+        app.preprocess_request()
+        g.user = None
+        key = page_cache_key("neotech", "mr-neo")
+        assert key is not None
+        assert cached_page_response(key) is None
+
+        rv = cache_page_response(key, Response("<p>Mr Neo</p>", mimetype="text/html"))
+        etag = rv.get_etag()[0]
+        assert etag
+        assert cached_page_response(key).get_data() == b"<p>Mr Neo</p>"
+
+    with app.test_request_context("/neotech/mr-neo", headers={"Accept": "text/html", "If-None-Match": etag}):
+        assert cached_page_response(key).status_code == 304
+
+    with app.test_request_context("/neotech/mr-neo?intent=patch"):
+        app.preprocess_request()
+        g.user = None
+        assert page_cache_key("neotech", "mr-neo") is None
+
+    invalidate_page_cache()
+    with app.test_request_context("/neotech/mr-neo"):
+        assert cached_page_response(key) is None
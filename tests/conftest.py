@@ -19,7 +19,10 @@ def app_client(scope="session") -> FlaskClient:
     # WTF_CSRF_CHECK_DEFAULT turn off all CSRF, test that in specific case only
     from lore.app import create_app
 
-    app = create_app(TESTING=True, PRESERVE_CONTEXT_ON_EXCEPTION=False, WTF_CSRF_CHECK_DEFAULT=False)
+    # EVENT_QUEUE_SIZE=0 writes logged events directly, so tests see them without waiting for the background writer
+    app = create_app(
+        TESTING=True, PRESERVE_CONTEXT_ON_EXCEPTION=False, WTF_CSRF_CHECK_DEFAULT=False, EVENT_QUEUE_SIZE=0
+    )
     with app.test_client(use_cookies=False) as client:
         yield client
 
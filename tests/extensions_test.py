@@ -0,0 +1,38 @@
+def test_markdown_renderer(app_client, mongomock):
+    from lore.extensions import MarkdownRenderer, get_markdown_cache
+    from lore.model.misc import RenderedMarkdown
+
+    renderer = MarkdownRenderer(extensions=["tables"])
+    plain = MarkdownRenderer(output_format="plain", stripTopLevelTags=False)
+    with app_client.application.app_context():
+        get_markdown_cache().clear()
+        assert renderer.convert("# Title") == "<h1>Title</h1>"
+        assert plain.convert("# Title") == "Title"
+        assert len(get_markdown_cache()) == 2
+        # The per thread instance is reset between texts, so references don't leak from one text to the next
+        assert renderer.render("[a]: https://lore.pub\n\n[A][a]") == '<p><a href="https://lore.pub">A</a></p>'
+        assert renderer.render("[A][a]") == "<p>[A][a]</p>"
+        renderer.render = None  # Cache hits don't render
+        assert renderer.convert("# Title") == "<h1>Title</h1>"
+
+        app_client.application.config["MARKDOWN_PERSIST_MIN_LENGTH"] = 5
+        assert plain.convert("Some *long* text") == "Some long text"
+        assert RenderedMarkdown.objects().first().html == "Some long text"
+        get_markdown_cache().clear()
+        plain.render = None  # Found in database
+        assert plain.convert("Some *long* text") == "Some long text"
+
+
+def test_markdown_renderer_options_key():
+    from markdown.extensions.toc import TocExtension
+    from lore.extensions import MarkdownRenderer
+
+    assert MarkdownRenderer(extensions=["tables"]).options_key == "tables:xhtml:True"
+    toc_keys = {
+        MarkdownRenderer(extensions=[TocExtension(anchorlink=True)]).options_key,
+        MarkdownRenderer(extensions=[TocExtension(anchorlink=False)]).options_key,
+        MarkdownRenderer(extensions=["toc"], extension_configs={"toc": {"anchorlink": True}}).options_key,
+        MarkdownRenderer(extensions=["toc"]).options_key,
+    }
+    assert len(toc_keys) == 4
+
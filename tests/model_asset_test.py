@@ -68,3 +68,18 @@ from lore.model.asset import sniff_remote_file, FileAsset
 #         responses.GET, 'https://server.com/testfile.png',
 #         body='{}', status=200,
 #         content_type='image/png')
+
+
+def test_find_fingerprint_offsets():
+    from io import BytesIO
+    from lore.model.asset import find_fingerprint_offsets, iter_chunks
+
+    class ChunkedFile(BytesIO):
+        # Mimics GridFS with small chunks, so that ids cross chunk boundaries
+        def readchunk(self):
+            return self.read(10)
+
+    data = b"%PDF <</FontFamily(Goudy Old Style)>> <xmpMM:DocumentID>xmp.did:E9E3ECA55654E311B947ECCF20247A3D "
+    data += b"trailer\n<</Size 5226/ID[<DE237A7714166B438254F2E7CAEACB2B>]>>\n%%EOF"
+    assert find_fingerprint_offsets(ChunkedFile(data)) == {"font_id": 19, "doc_id": 64, "pdf_id": 122}
+    assert b"".join(iter_chunks(ChunkedFile(data), 15, 25)) == data[15:25]
@@ -73,3 +73,22 @@ def test_current_url(app_client):
 
 
 # TEST current_url for no request and no request.endpoint
+
+
+def test_facet_filter_options(app_client, mongomock):
+    from lore.model.misc import facet_filter_options
+    from lore.model.world import Article, Publisher, World
+
+    with app_client.application.test_request_context():
+        hg = Publisher(slug="helmgast.se", title="Helmgast AB").save()
+        neo = World(slug="neotech", title_i18n={"sv": "Neotech"}, publisher=hg).save()
+        Article(title="First", world=neo, publisher=hg, tags=["a", "b"]).save()
+        Article(title="Second", publisher=hg, tags=["b", "c"]).save()
+
+        query = Article.objects(title__ne="Third")
+        options = facet_filter_options(
+            query, {"world": Article.world.filter_options, "tags": Article.tags.filter_options}
+        )
+        assert sorted(o.label for o in options["tags"]) == ["a", "b", "c"]
+        # Same as from distinct query
+        assert options["world"] == Article.world.filter_options(query)
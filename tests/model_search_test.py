@@ -0,0 +1,33 @@
+def test_search_snippet():
+    from lore.model.search import highlight_snippet, search_terms, text_pipeline
+
+    terms = search_terms('dragons "Mundana" -orcs')
+    assert terms == ["dragons", "mundana"]
+    text = "Lorem ipsum " * 30 + "The **dragon** of [Mundana](/mundana) & <b>Trakor</b>. " + "Dolor sit " * 30
+    snippet = highlight_snippet(text, terms, width=80)
+    assert snippet.startswith("… ") and snippet.endswith(" …")
+    assert "<mark>dragon</mark> of <mark>Mundana</mark> &amp; Trakor." in snippet
+    assert highlight_snippet("Short text", terms) == "Short text"
+
+    # Facets count all matches, while the match only narrows hits and total
+    facet = text_pipeline({"title": 1}, {"kinds": "$type"}, {"type": "blogpost"})[1]["$facet"]
+    assert facet["hits"][0] == facet["total"][0] == {"$match": {"type": "blogpost"}}
+    assert facet["kinds"] == [{"$sortByCount": "$type"}]
+
+
+def test_migrate_text_indexes(app_client, mongomock):
+    from lore.model.search import migrate_text_indexes
+    from lore.model.topic import Topic
+
+    collection = Topic._get_collection()
+    collection.create_index([("names.name", "text"), ("occurrences.content", "text")])
+    assert migrate_text_indexes() == ["topic.names.name_text_occurrences.content_text"]
+    assert "topic_text" in collection.index_information()
+    assert migrate_text_indexes() == []
+
+
+def test_facet_counts():
+    from lore.model.search import facet_counts
+
+    # Articles without world are counted too, and shown under the meta world
+    assert facet_counts([{"_id": "eon", "count": 3}, {"_id": None, "count": 2}]) == {"eon": 3, None: 2}
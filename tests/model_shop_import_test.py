@@ -387,6 +387,41 @@ def test_orderline(mongomock, app_client, db_loaded_product_data):
     print(o_json, o_str)
 
 
+def test_entitlements(mongomock, app_client, db_loaded_product_data):
+    from lore.model.asset import FileAsset
+    from lore.model.shop import Entitlement, products_owned_by_user, user_has_asset
+
+    asset = FileAsset(slug="rockets.pdf", source_filename="rockets.pdf", content_type="application/pdf")
+    asset.save()
+    product = db_loaded_product_data["kdl-132"]
+    product.downloads = [asset]
+    product.save()
+    user = User(email="buyer@test.com")
+    user.save()
+
+    order = Order(external_key="entitled", user=user, status=OrderStatus.cart)
+    order.order_lines = [OrderLine(product=product)]
+    order.save()
+    assert not user_has_asset(user, asset)
+    assert Entitlement.objects(user=user).first().products == []
+
+    order.status = OrderStatus.paid
+    order.save()
+    assert user_has_asset(user, asset)
+    assert products_owned_by_user(user) == {product}
+
+    # Changing the product of a line in place also updates what the user owns
+    order.order_lines[0].product = db_loaded_product_data["eon-808"]
+    order.save()
+    assert not user_has_asset(user, asset)
+    order.order_lines[0].product = product
+    order.save()
+    assert user_has_asset(user, asset)
+
+    order.delete()
+    assert not user_has_asset(user, asset)
+
+
 mock_urls = {
     "google_png": responses.Response(
         method="GET",
@@ -4,7 +4,7 @@ import json
 
 from tools.batch import Batch, Job, bulk_update
 from lore.model.topic import LORE_BASE, Topic, TopicFactory, create_basic_topics
-from lore.model.import_topic import job_import_sheettopic, job_import_topic
+from lore.model.import_topic import ImportedFile, import_markdown_topics, job_import_sheettopic, job_import_topic
 
 
 def dict_except(doc, *not_keys):
@@ -30,6 +30,7 @@ def expected_topic_dicts():
         "t1": {
             "_id": "t1",
             "kind": "t2",
+            "name_key": "english t1",
             "names": [
                 {"name": "English t1", "scopes": [f"{LORE_BASE}en"]},
                 {"name": "Svensk t1", "scopes": [f"{LORE_BASE}sv"]},
@@ -42,6 +43,7 @@ def expected_topic_dicts():
         "t2": {
             "_id": "t2",
             "kind": "other_t",
+            "name_key": "topic",
             "names": [{"name": "Topic", "scopes": []}],
             "occurrences": [
                 {"content": "A topic desc", "kind": f"{LORE_BASE}description", "scopes": [f"{LORE_BASE}en"]}
@@ -296,3 +298,138 @@ Some test text here, and a link to [Malkom Trevenas]
             }
         ],
     }
+
+
+def test_load_neighbourhood(app_client, topic_db_import):
+    t1 = topic_db_import["t1"]
+    neighbourhood = t1.load_neighbourhood()
+    assert set(neighbourhood) == t1.referenced_topic_ids() & set(topic_db_import)
+    assert neighbourhood["t2"].name == "Topic"
+    # One step further along associations also finds t1, as the association is two-way
+    assert "t1" in t1.load_neighbourhood(depth=1)
+    with app_client.application.test_request_context():
+        assert t1.associations_as_graph(neighbourhood)["nodes"][1]["name"] == "Topic"
+
+
+def test_bulk_committer(topic_db_import):
+    from unittest.mock import patch
+    from pymongo.errors import BulkWriteError
+    from tools.batch import BulkCommitter
+
+    committer = BulkCommitter(Topic, chunk_size=2, log=lambda s: None)
+    topics = list(Topic.objects())
+    topics[0].add_name("A new name")
+    committer.add_all(topics)
+    committer.add(Topic(id="t-new", names=[{"name": "New"}]))
+    committer.flush()
+    assert committer.stats["modified"] == 1 and committer.stats["inserted"] == 1
+    assert committer.stats["unchanged"] == len(topics) - 1
+    assert Topic.objects(id=topics[0].id).first().find_names("A new name")
+    assert Topic.objects(id="t-new").first().name == "New"
+
+    # A failed write is retried in full by the next flush
+    def failing_bulk_write(*args, **kwargs):
+        raise BulkWriteError({"writeErrors": []})
+
+    topic = Topic.objects(id="t-new").first()
+    topic.add_name("Newer")
+    collection = Topic._get_collection()
+    with patch.object(type(collection), "bulk_write", failing_bulk_write), pytest.raises(BulkWriteError):
+        committer.add(topic)
+        committer.flush()
+    committer.add(topic)
+    committer.flush()
+    assert Topic.objects(id="t-new").first().find_names("Newer")
+
+
+def test_factory_preload(app_client, mongomock):
+    for id in ["lore.pub/t/t1", "me.pub/t2", "bob@me.pub"]:
+        Topic(id=id).save()
+    factory = TopicFactory(default_bases=["lore.pub/t", "me.pub"], preload=True)
+    assert factory.known_ids == {"lore.pub/t/t1", "me.pub/t2", "bob@me.pub"}
+    factory.prefetch(["t1", "t3"])
+    assert factory.topic_dict["lore.pub/t/t1"].pk == "lore.pub/t/t1"
+    assert factory.topic_dict["me.pub/t3"] is None
+
+    # Basify is answered from memory, so works even if the database is gone
+    Topic.drop_collection()
+    assert factory.basify("t1") == "lore.pub/t/t1"
+    assert factory.basify("t2") == "me.pub/t2"
+    assert factory.basify("bob@") == "bob@me.pub"
+    assert factory.basify("t4") == "me.pub/t4"
+
+
+def test_topic_indexes():
+    t1, t2 = Topic(id="t1"), Topic(id="t2")
+    t1.add_name("Name", [f"{LORE_BASE}en"])
+    t1.add_name("Name", [f"{LORE_BASE}en"])  # Same name and scopes, so not added
+    t1.add_occurrence(content="Some text", kind=f"{LORE_BASE}description")
+    for i in range(3):
+        t1.add_association(t2, "k", "r1", "r2", two_way=True)  # Only added once
+    assert len(t1.names) == 1 and len(t1.associations) == 1 and len(t2.associations) == 1
+    assert t1.find_names("NAME", scopes=[f"{LORE_BASE}en"], case_insensitive=True)
+    assert t1.find_associations(t2="t2", kind="k", first=True) is t1.associations[0]
+    assert t2.find_associations(r1="r2", first=True).t2.pk == "t1"
+    assert t1.occurrences_grouped()["description"] == t1.find_occurrences(kind=f"{LORE_BASE}description")
+    assert list(t1.associations_by_r1().keys())[0].pk == "r1"
+
+    # Changing the lists directly drops the index
+    t1.names.pop(0)
+    t1.occurrences = []
+    assert not t1.find_names("Name")
+    assert not t1.find_occurrences(kind=f"{LORE_BASE}description")
+    assert t1.occurrences_grouped()["description"] == []
+
+    # And so does changing an item in place
+    t2.add_name("Old name")
+    assert t2.find_names("Old name")
+    t2.names[0].name = "New name"
+    t2.names[0].scopes.append(f"{LORE_BASE}sv")
+    assert not t2.find_names("Old name") and t2.find_names("New name", scopes=[f"{LORE_BASE}sv"])
+    t1.associations[0].kind = Topic(id="k2")
+    assert not t1.find_associations(kind="k") and t1.find_associations(kind="k2")
+
+
+def test_incremental_markdown_import(app_client, mongomock, tmp_path):
+    (tmp_path / "a.md").write_text("---\ntitle: A\n---\nText about A")
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "b.md").write_text("---\ntitle: B\nlinks:\n  mention: A\n---\nText about B")
+    batch = import_markdown_topics(tmp_path, commit=True, default_bases=["lore.pub/t"])
+    assert len(batch.jobs) == 2
+    assert Topic.objects(id="lore.pub/t/b").first().name == "B"
+    assert {f.path for f in ImportedFile.objects()} == {"a.md", "sub/b.md"}
+
+    assert len(import_markdown_topics(tmp_path, commit=True, default_bases=["lore.pub/t"]).jobs) == 0
+
+    (tmp_path / "a.md").write_text("---\ntitle: A new name\n---\nText about A")
+    (tmp_path / "sub" / "b.md").unlink()
+    batch = import_markdown_topics(tmp_path, commit=True, default_bases=["lore.pub/t"])
+    assert len(batch.jobs) == 1
+    assert Topic.objects(id="lore.pub/t/a").first().find_names("A new name")
+    assert Topic.objects(id="lore.pub/t/b").first() is None
+    assert not Topic.objects(id="lore.pub/t/a").first().associations
+    assert [f.path for f in ImportedFile.objects()] == ["a.md"]
+
+    # A topic that another file still adds to is kept
+    (tmp_path / "c.md").write_text("---\ntitle: C\nlinks:\n  mention: A\n---\nText about C")
+    import_markdown_topics(tmp_path, commit=True, default_bases=["lore.pub/t"])
+    (tmp_path / "a.md").unlink()
+    import_markdown_topics(tmp_path, commit=True, default_bases=["lore.pub/t"])
+    assert Topic.objects(id="lore.pub/t/a").first().find_associations(t2="lore.pub/t/c")
+
+
+def test_suggest_topics(app_client, mongomock):
+    from lore.model.topic import Name, name_key, suggest_topics, update_name_keys
+
+    assert name_key("  Élan  Ödegård") == "elan ödegård"
+    with app_client.application.test_request_context():
+        for id, name in [("eon/ereb", "Ereb Altor"), ("eon/elan", "Élan"), ("eon/odin", "Ödin"), ("kult/eden", "Eden")]:
+            Topic(id=f"helmgast.se/{id}", names=[Name(name=name)]).save()
+        assert [t["text"] for t in suggest_topics("e", "helmgast.se/eon")] == ["Élan", "Ereb Altor"]
+        assert [t["value"] for t in suggest_topics("ELA", "helmgast.se")] == ["helmgast.se/eon/elan"]
+        assert suggest_topics("o", "helmgast.se") == [] and len(suggest_topics("ö", "helmgast.se")) == 1
+
+        # Topics written without clean() get their key from update_name_keys
+        Topic.objects(id="helmgast.se/kult/eden").update(unset__name_key=True)
+        assert update_name_keys() == 1
+        assert len(suggest_topics("ed", "helmgast.se")) == 1
@@ -70,3 +70,63 @@ def test_merge_users(mongomock, app_client, db_loaded_user_data):
     assert len(events) == 1
     # log item for U2 was changed to U1
     assert events[0].user == db_loaded_user_data["u1"]
+
+
+def test_event_xp(mongomock, app_client, db_loaded_user_data):
+    from lore.model.user import EventCounter, EventWriter, rebuild_event_counters
+
+    u1 = db_loaded_user_data["u1"]
+    with app_client.application.test_request_context():
+        # Written directly in tests, posts award XP on the 1st, 2nd and 4th time
+        for i in range(4):
+            u1.log("post", None, created=datetime(2020, 1, 1, 0, 0, i))
+        assert EventCounter.objects(user=u1, action="post").get().count == 4
+        assert User.objects(id=u1.id).get().xp == 30
+
+        writer = EventWriter(batch_size=2, flush_interval=0.01)
+        for i in range(3):
+            writer.put(Event(user=u1, action="purchase", metric=100, created=datetime(2020, 1, 2, 0, 0, i)))
+        writer.put(Event(user=u1, action="purchase", metric=100, created=datetime(2020, 1, 2)))  # Duplicate
+        writer.flush()
+        assert Event.objects(user=u1, action="purchase").count() == 3
+        assert User.objects(id=u1.id).get().xp == 330  # The duplicate is neither written nor counted
+        assert EventCounter.objects(user=u1, action="purchase").get().count == 3
+
+        # Events without user, e.g. logged by a script, are written but give no XP
+        writer.put(Event(action="purchase", metric=100))
+        writer.flush()
+        assert Event.objects(user=None).count() == 1
+
+        EventCounter.drop_collection()
+        User.objects(id=u1.id).update_one(set__xp=0)
+        assert rebuild_event_counters() == 3  # Counters of u1 post and purchase, and the test event of u2
+        assert EventCounter.objects(user=u1, action="purchase").get().count == 3
+        assert User.objects(id=u1.id).get().xp == 330
+
+
+def test_event_validation(mongomock, app_client, db_loaded_user_data):
+    from mongoengine import ValidationError
+
+    with app_client.application.test_request_context():
+        with pytest.raises(ValidationError):
+            db_loaded_user_data["u1"].log("post", None, message="x" * 501)
+        assert Event.objects(user=db_loaded_user_data["u1"]).count() == 0
+
+
+def test_event_background_writer(mongomock, app_client, db_loaded_user_data, monkeypatch):
+    import lore.model.user
+    from lore.model.user import EventCounter, get_event_writer
+
+    # The shared app fixture writes events directly, so turn the queue on for this test only
+    monkeypatch.setitem(app_client.application.config, "EVENT_QUEUE_SIZE", 100)
+    monkeypatch.setattr(lore.model.user, "_event_writer", None)
+    u1 = db_loaded_user_data["u1"]
+    with app_client.application.test_request_context():
+        for i in range(3):
+            u1.log("post", None, created=datetime(2020, 1, 1, 0, 0, i))
+        writer = get_event_writer()
+        assert writer.thread.is_alive()
+        writer.flush()
+    assert Event.objects(user=u1, action="post").count() == 3
+    assert EventCounter.objects(user=u1, action="post").get().count == 3
+    assert User.objects(id=u1.id).get().xp == 20  # Posts award XP on the 1st and 2nd time, but not the 3rd
@@ -0,0 +1,86 @@
+import pytest
+from werkzeug.exceptions import NotFound
+
+from lore.model.world import Publisher, World, WorldMeta, resolve_publisher_world
+
+
+@pytest.fixture()
+def publisher_world_data(app_client, mongomock):
+    with app_client.application.test_request_context():
+        hg = Publisher(slug="helmgast.se", title="Helmgast AB").save()
+        neo = World(slug="neotech", title_i18n={"sv": "Neotech"}, publisher=hg).save()
+    return {"hg": hg, "neo": neo}
+
+
+def test_resolve_publisher_world(app_client, publisher_world_data):
+    with app_client.application.test_request_context():
+        publisher, world = resolve_publisher_world("helmgast.se", "neotech")
+        assert publisher == publisher_world_data["hg"]
+        assert world == publisher_world_data["neo"]
+
+        publisher, world = resolve_publisher_world("helmgast.se", "meta")
+        assert isinstance(world, WorldMeta)
+        assert world.publisher == publisher
+
+        assert resolve_publisher_world("helmgast.se")[1] is None
+        assert resolve_publisher_world("nonexisting.com", or_404=False) == (None, None)
+        with pytest.raises(NotFound):
+            resolve_publisher_world("helmgast.se", "nonexisting")
+
+
+def test_resolve_publisher_world_cache(app_client, publisher_world_data):
+    with app_client.application.test_request_context():
+        publisher, world = resolve_publisher_world("helmgast.se", "neotech")
+        # Served from registry, e.g. without seeing changes that don't send signals
+        Publisher.objects(slug="helmgast.se").update(set__title="Updated")
+        assert resolve_publisher_world("helmgast.se", "neotech") == (publisher, world)
+        assert resolve_publisher_world("helmgast.se")[0].title == publisher.title
+
+        # Each lookup gets its own instance
+        publisher.title = "Changed"
+        publisher.editors.append(None)
+        assert resolve_publisher_world("helmgast.se")[0] is not publisher
+        assert resolve_publisher_world("helmgast.se")[0].title != "Changed"
+        assert resolve_publisher_world("helmgast.se")[0].editors == []
+
+        # Saving should invalidate the registry
+        publisher_world_data["hg"].title = "Helmgast"
+        publisher_world_data["hg"].save()
+        assert resolve_publisher_world("helmgast.se")[0].title == "Helmgast"
+
+
+def test_access_scope(app_client, publisher_world_data):
+    from flask import g
+    from lore.model.user import User
+    from lore.model.world import Article, get_access_scope
+    from lore.api.world import filter_readable
+
+    hg, neo = publisher_world_data["hg"], publisher_world_data["neo"]
+    with app_client.application.test_request_context():
+        user = User(email="editor@helmgast.se").save()
+        other = Publisher(slug="other.com", title="Other").save()
+        hg.editors = [user]
+        hg.save()
+        neo.readers = [user]
+        neo.save()
+        Article(title="Draft", publisher=other, world=neo, status="draft").save()
+        Article(title="Hidden", publisher=other, status="draft").save()
+
+        g.user = user
+        scope = get_access_scope()
+        assert scope.editor_publishers == {hg.id} and scope.reader_worlds == {neo.id}
+        assert get_access_scope(user) is scope  # Once per request
+        assert scope.is_reader(other.id, neo.id) and not scope.is_editor(other.id, neo.id)
+        assert [a.title for a in Article.objects(filter_readable(other))] == ["Draft"]
+        lost = World(slug="lost", title_i18n={"sv": "Lost"}, publisher=other).save()
+        assert not Article.objects(filter_readable(other, lost))
+
+        # Changing editors or readers invalidates the scope
+        hg.editors = []
+        hg.save()
+        assert get_access_scope().editor_publishers == set()
+
+    # By default the scope is only kept for the request, so changes without signals are seen by the next one
+    Publisher.objects(id=hg.id).update(set__editors=[user])
+    with app_client.application.test_request_context():
+        assert get_access_scope(user).editor_publishers == {hg.id}
@@ -240,3 +240,15 @@ def test_all_routes(app_client, db_basic_data):
 
     frt = FlaskRouteTester(app_client, all_args, {})
     frt.test_routes(get_expected_response, lambda r: "debug" not in r.endpoint and "logout" not in r.endpoint)
+
+
+def test_route_match_cache(app_client):
+    url_map = app_client.application.url_map
+    adapter = url_map.bind("helmgast.se")
+    first = adapter.match("/shop/", "GET")
+    first[1]["lang"] = "changed"  # Like url_value_preprocessors do with view_args
+    hits = url_map.match_stats["hit"]
+    assert adapter.match("/shop/", "GET") == first[:1] + ({**first[1], "lang": "sv"},)
+    assert url_map.match_stats["hit"] == hits + 1
+    adapter.server_name = "lore.pub"
+    assert adapter.match("/shop/", "GET", return_rule=True)[0].endpoint == first[0]
@@ -0,0 +1,33 @@
+import pytest
+
+from tools.batch import Batch, JobSuccess
+
+
+def double_job(job, data):
+    if data == 3:
+        raise ValueError("Three is not allowed")
+    job.committer = lambda: committed.append(data * 2)
+    return {"value": data * 2}
+
+
+committed = []
+
+
+@pytest.mark.parametrize("workers", [0, 4])
+def test_batch_process(workers):
+    committed.clear()
+    read = []
+
+    def generator():
+        for i in range(10):
+            read.append(i)
+            # The generator is never read further ahead than the allowed jobs in flight
+            assert len(read) - len(batch.jobs) <= batch.max_in_flight + 1
+            yield i
+
+    batch = Batch("Test", workers=workers, dry_run=False, commit_every=4)
+    batch.process(generator(), double_job)
+    assert len(batch.jobs) == 10
+    assert sorted(committed) == [i * 2 for i in range(10) if i != 3]
+    assert [job.i for job in batch.jobs if job.success == JobSuccess.FAIL] == [3]
+    assert all(job.data is None and job.result is None for job in batch.jobs)
@@ -0,0 +1,63 @@
+import io
+
+import panflute as pf
+import pytest
+
+from tools.batch import Batch, Job
+from tools.import_mediawiki import action_clean, unique_pages, wikitext_generator
+
+
+@pytest.mark.parametrize("version", ["0.3", "0.10"])
+def test_wikitext_generator(version):
+    xml = f"""<mediawiki xmlns="http://www.mediawiki.org/xml/export-{version}/" version="{version}">
+      <siteinfo><sitename>Test</sitename></siteinfo>
+      <page><title>A page</title><revision><timestamp>2020-01-01T00:00:00Z</timestamp>
+      <contributor><username>Bob</username></contributor><text>Some [[Fil:x.png]] text</text></revision></page>
+      <page><title>Empty</title><revision><text /></revision></page>
+    </mediawiki>"""
+    pages = list(wikitext_generator(io.BytesIO(xml.encode())))
+    assert len(pages) == 2
+    assert pages[0] == {
+        "title": "A page",
+        "created_at": "2020-01-01T00:00:00Z",
+        "author": "Bob",
+        "text": "Some [[Image:x.png]] text",
+    }
+    assert pages[1]["text"] == "" and pages[1]["author"] == ""
+
+
+def test_unique_pages():
+    pages = [
+        {"title": "A page", "text": "Text"},
+        {"title": "A page?", "text": "#REDIRECT [[A page]]"},
+        {"title": "A page!", "text": "Other text"},
+        {"title": "Mall:Test", "text": "Template"},
+    ]
+    all_pages = {}
+    pages = list(unique_pages(pages, all_pages))
+    assert [p.get("skip", None) for p in pages] == [
+        None,
+        "",
+        "Skipping page 'A page!' as it has same id (A page) as 'A page' and none are redirects",
+        "Skipping page as title includes a Mediawiki namespace",
+    ]
+    assert all_pages == {"A page": ("A page", False)}
+
+
+def test_action_clean():
+    doc = pf.Doc(
+        pf.Header(pf.Strong(pf.Str("Title")), level=1),
+        pf.Para(
+            pf.Link(url="Kategori:Things"),
+            pf.Link(pf.Str("Other"), url="Other_page", title="wikilink"),
+            pf.Link(pf.Str("Secret"), url="Special:Secret"),
+        ),
+    )
+    doc.links, doc.is_redirect, doc.headers = {}, False, {1: 2}
+    pf.run_filter(action_clean, doc=doc, job=Job(0, Batch("Test")))
+    assert doc.content[0].level == 2 and pf.stringify(doc.content[0]) == "Title"
+    para = doc.content[1].content
+    assert len(para) == 2  # Category link removed itself
+    assert isinstance(para[1], pf.Strikeout)
+    assert para[0].url == "Other_page" and para[0].title == ""
+    assert doc.links == {"category": {"Things"}, "mention": {"Other page"}}
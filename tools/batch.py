@@ -2,10 +2,17 @@ from enum import Enum, IntEnum
 from timeit import default_timer as timer
 import traceback
 from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from dataclasses import dataclass
+from functools import partial
+from hashlib import md5
 from unicodedata import normalize
 import json
 
+from bson import json_util
+from mongoengine import ValidationError
+from pymongo import UpdateOne
+
 
 def pretty_dict(dct):
     if isinstance(dct, dict):
@@ -136,6 +143,11 @@ class Job:
     def __str__(self):
         return self.get_str()
 
+    def compact(self):
+        """Drops the data and result of a finished job, keeping what's needed for the summary"""
+        self.data, self.result = None, None
+        return self
+
     def get_log(self, level):
         return [msg for lvl, msg in self.log if lvl == level]
 
@@ -175,6 +187,117 @@ def bulk_update(doc_class, docs):
         return None
 
 
+def run_job(job, job_func, data, **kwargs):
+    try:
+        job.data = data
+        job.result = job_func(job, data, **kwargs)
+    except Exception as e:
+        # err_msg = f"Error in job with data='{data}'\n"
+        if job.is_debug:
+            job.error(traceback.format_exc())
+        else:
+            job.error(e)
+    return job
+
+
+def run_job_in_app_context(app, job, job_func, data, **kwargs):
+    # Threads don't inherit the Flask app context, which many jobs need, e.g. for current_app
+    with app.app_context():
+        return run_job(job, job_func, data, **kwargs)
+
+
+def run_job_in_process(job, job_func, data, **kwargs):
+    # The job is pickled back to the main process. Changes to the context are not sent back, and the
+    # committer and result must be picklable.
+    job = run_job(job, job_func, data, **kwargs)
+    job.batch = None
+    return job
+
+
+def field_hashes(son):
+    # Sorted keys and millisecond dates, so that the stored form of a document hashes the same as the new one
+    return {k: md5(json_util.dumps(v, sort_keys=True).encode()).digest() for k, v in son.items()}
+
+
+class BulkCommitter:
+    def __init__(self, doc_class, chunk_size=500, ignore_fields=("updated_at",), log=print):
+        """Writes documents with bulk_write, in chunks of chunk_size. Each document is compared against a hash of
+        each top-level field in its stored form, and only changed fields are $set. Unchanged documents are
+        skipped. Fields that are missing from the new document are not removed from the stored.
+
+        ignore_fields -- fields that always change, e.g. by clean(), so are only written if something else changed
+        """
+        self.doc_class = doc_class
+        self.chunk_size = chunk_size
+        self.ignore_fields = set(ignore_fields)
+        self.log = log
+        self.pending = {}
+        self.hashes = {}  # Hashes of the stored form of documents, by id
+        self.stats = Counter()
+        self.chunks = 0
+
+    def add(self, doc):
+        if doc:
+            self.pending[doc.pk] = doc
+            if len(self.pending) >= self.chunk_size:
+                self.flush()
+
+    def add_all(self, docs):
+        for doc in docs:
+            self.add(doc)
+
+    def flush(self):
+        if not self.pending:
+            return None
+        docs, self.pending = list(self.pending.values()), {}
+        collection = self.doc_class._get_collection()
+        not_hashed = [doc.pk for doc in docs if doc.pk not in self.hashes]
+        if not_hashed:
+            for stored in collection.find({"_id": {"$in": not_hashed}}):
+                self.hashes[stored["_id"]] = field_hashes(stored)
+
+        stats = Counter()
+        bulk_operations = []
+        written_hashes = {}
+        for doc in docs:
+            try:
+                doc.validate()  # Also runs clean()
+            except ValidationError as ve:
+                self.log(ve)
+                stats["invalid"] += 1
+                continue
+            son = doc.to_mongo().to_dict()
+            new_hashes = field_hashes(son)
+            old_hashes = self.hashes.get(doc.pk)
+            if old_hashes is None:
+                bulk_operations.append(UpdateOne({"_id": doc.pk}, {"$set": son}, upsert=True))
+            else:
+                changed = {
+                    k: v for k, v in son.items() if k not in self.ignore_fields and new_hashes[k] != old_hashes.get(k)
+                }
+                if not changed:
+                    stats["unchanged"] += 1
+                    continue
+                changed.update({k: son[k] for k in self.ignore_fields if k in son})
+                bulk_operations.append(UpdateOne({"_id": doc.pk}, {"$set": changed}))
+                stats["fields"] += len(changed)
+            written_hashes[doc.pk] = new_hashes
+
+        if bulk_operations:
+            result = collection.bulk_write(bulk_operations, ordered=False)
+            stats["inserted"] += result.upserted_count
+            stats["modified"] += result.modified_count
+        # Only once written, so that documents in a failed write are compared against what is actually stored
+        self.hashes.update(written_hashes)
+        self.chunks += 1
+        self.stats.update(stats)
+        self.log(
+            f"Chunk {self.chunks}: {stats['inserted']} inserted, {stats['modified']} modified "
+            f"({stats['fields']} fields), {stats['unchanged']} unchanged, {stats['invalid']} invalid"
+        )
+        return stats
+
+
 class Batch:
     def __init__(
         self,
@@ -185,16 +308,39 @@ class Batch:
         table_columns=None,
         no_metadata=False,
         limit=0,
+        workers=0,
+        executor=None,
+        max_in_flight=0,
+        commit_every=0,
+        unit="jobs",
         **kwargs,
     ):
+        """Runs a job function on each item from a generator and prints the result.
+
+        workers -- if more than 0, runs jobs in parallel with a pool of this many workers
+        executor -- "serial", "thread" (default if workers) or "process", or a concurrent.futures.Executor.
+            Process pools require job function, data, context and results to be picklable, and context changes
+            made by a job are not seen by other jobs.
+        max_in_flight -- max jobs submitted but not finished, defaults to twice the workers. The generator is only
+            read when there is room, so it's never read far ahead of the workers.
+        commit_every -- if not a dry run, run job committers in chunks of this many finished jobs while
+            processing, instead of only when calling commit()
+        unit -- what a job processes, e.g. pages, when reporting throughput in the summary
+        """
         self.name = name
         self.log_level = log_level if isinstance(log_level, LogLevel) else LogLevel[log_level]
         self.context = kwargs
         self.jobs = []
+        self.committers = []
         self.is_bugreport = bugreport
         self.is_debug = self.log_level is LogLevel.DEBUG or bugreport
         self.is_dry_run = dry_run
         self.limit = int(limit)
+        self.workers = int(workers or 0)
+        self.executor = executor or ("thread" if self.workers > 0 else "serial")
+        self.max_in_flight = int(max_in_flight) or max(self.workers, 1) * 2
+        self.commit_every = int(commit_every)
+        self.unit = unit
 
         if table_columns is not None and (
             not isinstance(table_columns, list) or len(table_columns) == 0 or not isinstance(table_columns[0], Column)
@@ -203,6 +349,14 @@ class Batch:
         self.table_columns = table_columns
         self.no_metadata = no_metadata
 
+    def __getstate__(self):
+        # Jobs sent to a process pool bring a copy of the batch, but not what has been processed so far
+        state = self.__dict__.copy()
+        state["jobs"], state["committers"] = [], []
+        if isinstance(self.executor, Executor):
+            state["executor"] = None
+        return state
+
     def process(self, generator, job_func, *args, **kwargs):
         self.start = timer()
         intro = ""
@@ -229,33 +383,74 @@ class Batch:
             intro += f"{self.name}{' DRY RUN' if self.is_dry_run else ''}{' DEBUG' if self.is_debug else ''}\n"
         print(intro)
 
-        for i, data in enumerate(generator):
-            if self.limit > 0 and i > self.limit:
-                break
-            job = Job(i, self)
-            self.jobs.append(job)
-            try:
-                job.data = data
-                job.result = job_func(job, data, **kwargs)
-            except Exception as e:
-                # err_msg = f"Error in job with data='{data}'\n"
-                if self.is_debug:
-                    job.error(traceback.format_exc())
-                else:
-                    job.error(e)
+        def jobs_and_data():
+            for i, data in enumerate(generator):
+                if self.limit > 0 and i > self.limit:
+                    break
+                yield Job(i, self), data
 
-            if job.success is not JobSuccess.SKIP:
-                if self.table_columns:
-                    print(job.get_row(self.table_columns))
-                else:
-                    print(job.get_str(self.log_level))
+        if self.executor == "serial":
+            for job, data in jobs_and_data():
+                self.finish_job(run_job(job, job_func, data, **kwargs))
+        else:
+            self.process_parallel(jobs_and_data(), job_func, **kwargs)
+
+        if self.commit_every and not self.is_dry_run:
+            self.commit()
         self.end = timer()
         self.elapsed = self.end - self.start
 
+    def process_parallel(self, jobs_and_data, job_func, **kwargs):
+        if isinstance(self.executor, Executor):
+            pool, own_pool = self.executor, False
+        elif self.executor == "thread":
+            pool, own_pool = ThreadPoolExecutor(self.workers or None), True
+        elif self.executor == "process":
+            pool, own_pool = ProcessPoolExecutor(self.workers or None), True
+        else:
+            raise ValueError(f"Unknown executor {self.executor}")
+
+        if isinstance(pool, ProcessPoolExecutor):
+            runner = run_job_in_process
+        else:
+            from flask import current_app, has_app_context
+
+            runner = run_job
+            if has_app_context():
+                runner = partial(run_job_in_app_context, current_app._get_current_object())
+
+        try:
+            in_flight = set()
+            for job, data in jobs_and_data:
+                in_flight.add(pool.submit(runner, job, job_func, data, **kwargs))
+                if len(in_flight) >= self.max_in_flight:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        self.finish_job(future.result())
+            for future in wait(in_flight).done:
+                self.finish_job(future.result())
+        finally:
+            if own_pool:
+                pool.shutdown()
+
+    def finish_job(self, job):
+        job.batch = self
+        if job.success is not JobSuccess.SKIP:
+            if self.table_columns:
+                print(job.get_row(self.table_columns))
+            else:
+                print(job.get_str(self.log_level))
+        if job.committer:
+            self.committers.append(job.committer)
+            job.committer = None
+            if self.commit_every and not self.is_dry_run and len(self.committers) >= self.commit_every:
+                self.commit()
+        self.jobs.append(job.compact())
+
     def commit(self):
-        for job in self.jobs:
-            if job.committer:
-                job.committer()
+        committers, self.committers = self.committers, []
+        for committer in committers:
+            committer()
 
     def cur_job(self):
         return self.jobs[-1] if len(self.jobs) else None
@@ -271,6 +466,7 @@ class Batch:
             f"SKIP    {counts[JobSuccess.SKIP]} job(s)\n"
             f"---------------------\n"
             f"TOTAL   {len(self.jobs)} job(s)\n"
-            f"Elapsed time: {self.elapsed:.2f}s"
+            f"Elapsed time: {self.elapsed:.2f}s "
+            f"({len(self.jobs) / self.elapsed if self.elapsed else 0:.1f} {self.unit}/s)"
         )
         return rv
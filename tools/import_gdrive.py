@@ -6,6 +6,7 @@ from datetime import timezone
 from unicodedata import normalize
 from distutils.util import strtobool
 import csv
+import threading
 import pprint
 
 # TODO
@@ -111,6 +112,7 @@ def import_all_gridfs(folder_id, limit, commit, log_level, build=False, **kwargs
         gdrive_index_by_md5=gdrive_index_by_md5,
         gdrive_index_by_name=gdrive_index_by_name,
         sum_size=0,
+        sum_size_lock=threading.Lock(),  # As workers may add to sum_size in parallel
         **kwargs,
     )
     batch.process(gridfile_assets, import_gridfs_job)
@@ -179,7 +181,8 @@ def import_gridfs_job(job, data, commit=False, **kwargs):
     results_metadata["exists"] = exist_status
 
     if exist_status == "miss" or exist_status == "unknown":
-        job.context["sum_size"] += gridfile.length
+        with job.context["sum_size_lock"]:
+            job.context["sum_size"] += gridfile.length
         if commit:
             media = MediaIoBaseUpload(gridfile, mimetype=gridfile.content_type, chunksize=1024 * 1024, resumable=True)
             file = api.create(body=file_metadata, media_body=media, fields="id").execute()
@@ -56,26 +56,31 @@ category_ns_pattern = re.compile(f"[: ]?({category_ns}){ns_divider}", flags=re.D
 
 
 def wikitext_generator(wiki_xml_file):
-    tree = ET.parse(wiki_xml_file)
-    root = tree.getroot()
-    ns = "{http://www.mediawiki.org/xml/export-0.3/}"
-    for page in root.findall(f".//{ns}page"):
-        text = page.find(f".//{ns}text").text or ""
+    """Yields each page in a MediaWiki XML export as it's read, so that the whole dump never has to fit in memory.
+    The namespace is read from the root element, so any version of the export schema works."""
+    context = ET.iterparse(wiki_xml_file, events=("start", "end"))
+    _event, root = next(context)
+    ns = root.tag[: root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+    for event, elem in context:
+        if event != "end" or elem.tag != f"{ns}page":
+            continue
+        text = elem.findtext(f".//{ns}text") or ""
         # Fix, spaces in wikitable attributes breaks pandoc
         text = text.replace(' = "', '="')
         text = text.replace(" '''", "'''")  # Fix, space before ending ''' (bold) breaks
         # Pandoc doesn't recognize localized or incorrectly cased namespaces as image links, e.g.
         # `[[Fil:`, `[[image:`, `[[file:` will become just a normal link.
         text = simplify_image_links.sub(r"[[Image", text)
-        title_el = page.find(f"{ns}title")
-        created_at_el = page.find(f".//{ns}timestamp")
-        author_el = page.find(f".//{ns}username")
-        yield {
-            "title": title_el.text if title_el is not None else "",
-            "created_at": created_at_el.text if created_at_el is not None else "",
-            "author": author_el.text if author_el is not None else "",
+        page = {
+            "title": elem.findtext(f"{ns}title", ""),
+            "created_at": elem.findtext(f".//{ns}timestamp", ""),
+            "author": elem.findtext(f".//{ns}username", ""),
             "text": text,
         }
+        # Drop the parsed page, and the reference to it from root, before the next is read
+        elem.clear()
+        root.clear()
+        yield page
 
 
 def action_count_headers(elem, doc, job):
@@ -150,6 +155,23 @@ def action_print_links(elem, doc, job):
         job.debug(elem)
 
 
+clean_actions = [action_arrange_headers, action_clean_link, action_extract_namespace, action_print_links]
+
+
+def action_clean(elem, doc, job):
+    """Applies all clean_actions to each element in one walk of the document, instead of one walk per action.
+    The actions work on different kinds of elements, so the result is the same as running them one by one.
+    """
+    replaced = None
+    for action in clean_actions:
+        result = action(elem, doc, job)
+        if isinstance(result, list):
+            return result  # Element removed, nothing more to do
+        elif result is not None and result is not elem:
+            elem = replaced = result
+    return replaced
+
+
 def clean_headers(h):
     offset = 0
     if 1 in h:
@@ -165,37 +187,54 @@ def clean_headers(h):
 
 # TODO don't put occurences under links, should be root/occurrences/<type>
 # TODO don't hard wrap lines
+def unique_pages(pages, all_pages=None, bugreport=False):
+    """Gives each page from pages an id, and marks pages to skip because of a namespace or an id that
+    is already taken. Runs in the order pages are read, before the pages are handed out to jobs, so that
+    the outcome doesn't depend on which job finishes first when running in parallel.
+
+    all_pages -- dict of id to (title, is_redirect) of the pages that got an id, filled in while reading
+    """
+    all_pages = all_pages if all_pages is not None else {}
+    for data in pages:
+        title = data["title"]
+        data["id"] = id = slugify(title, lower=False, spaces=True)
+        data["is_redirect"] = is_redirect = bool(redirect_pattern.match(data["text"]))
+        match = all_ns_pattern.match(title)
+        if bugreport or not title:
+            pass  # Let the job report it
+        elif match and match.group("ns"):
+            data["skip"] = "Skipping page as title includes a Mediawiki namespace"
+        elif id in all_pages:
+            if not is_redirect and not all_pages[id][1]:
+                data[
+                    "skip"
+                ] = f"Skipping page '{title}' as it has same id ({id}) as '{all_pages[id][0]}' and none are redirects"
+            elif is_redirect:
+                # Current page is just a redirect to something with same slugified id, so we can ignore it
+                data["skip"] = ""
+        else:
+            all_pages[id] = (title, is_redirect)
+        yield data
+
+
 def job_wikitext_to_markdown(job, data):
-    title, text = data["title"], data["text"]
-    all_pages = job.context["all_pages"]
-    id = slugify(title, lower=False, spaces=True)
+    """Converts a page to Markdown. Expects pages from unique_pages, and is self-contained so that it can run
+    in a process pool."""
+    title, text, id = data["title"], data["text"], data["id"]
     job.id = id
     file_path = os.path.join(job.context["out_folder"], id + ".md")
 
     assert len(title) > 0, "Title cannot be empty"
-    match = all_ns_pattern.match(title)
-    if match and match.group("ns") and not job.is_bugreport:
-        job.warn("Skipping page as title includes a Mediawiki namespace")
+    if "skip" in data:
+        if data["skip"]:
+            job.warn(data["skip"])
         job.success = JobSuccess.SKIP
         return
 
-    new_text, is_redirect = redirect_pattern.subn("Alias for ", text)
+    is_redirect = data["is_redirect"]
     if is_redirect:
-        text = new_text
-
-    if id in all_pages and not job.is_bugreport:
-        if not is_redirect and not all_pages[id][1]:
-            job.warn(
-                f"Skipping page '{title}' as it has same id ({id}) as '{all_pages[id][0]}' and none are redirects"
-            )
-            job.success = JobSuccess.SKIP
-            return
-        elif is_redirect:
-            # Current page is just a redirect to something with same slugified id, so we can ignore it
-            job.success = JobSuccess.SKIP
-            return
-    else:
-        all_pages[id] = (title, is_redirect)
+        text = redirect_pattern.sub("Alias for ", text)
+
     if job.context.get("filter", None) and job.context["filter"] not in id and not job.is_bugreport:
         # print(f"filter={job.context['filter']}, id={id}, in it={job.context['filter'] in id}")
         job.success = JobSuccess.SKIP
@@ -210,9 +249,7 @@ def job_wikitext_to_markdown(job, data):
         pf.run_filters([action_count_headers], doc=doc, job=job)
         clean_headers(doc.headers)
         job.debug(f"Headers: {doc.headers}")
-        pf.run_filters(
-            [action_arrange_headers, action_clean_link, action_extract_namespace, action_print_links], doc=doc, job=job
-        )
+        pf.run_filter(action_clean, doc=doc, job=job)
     if not job.batch.no_metadata:
         # Use RawInline to avoid using markdown escape rules on the content. See issue https://github.com/jgm/pandoc/issues/2139
         doc.metadata["id"] = pf.RawInline(id)
@@ -10,7 +10,7 @@ from lore.model.world import import_article
 from lore.model.user import import_user
 from lore.model.import_topic import job_import_sheettopic
 from lore.model.misc import to_camelcase
-from tools.batch import Batch, Column, bulk_update
+from tools.batch import Batch, BulkCommitter, Column, bulk_update
 
 # Performance:
 # Use a raw query or re-use a Q object
@@ -34,7 +34,7 @@ model_field_mapping = {
 }
 
 
-def import_data(url_or_id, model, sheet, limit, commit, log_level, if_newer=True, **kwargs):
+def import_data(url_or_id, model, sheet, limit, commit, log_level, if_newer=True, commit_every=0, **kwargs):
     assert type(url_or_id) == str
 
     if not limit or limit < 1:
@@ -83,6 +83,10 @@ def import_data(url_or_id, model, sheet, limit, commit, log_level, if_newer=True
         default_scopes = kwargs.pop("default_scopes")
         default_associations = kwargs.pop("default_associations")
         kwargs["topic_factory"] = TopicFactory(default_bases, default_scopes, default_associations)
+        if commit and commit_every:
+            # Save topics in chunks while importing, instead of all at the end
+            kwargs["bulk_committer"] = BulkCommitter(Topic, chunk_size=commit_every)
+            kwargs["commit_every"] = commit_every
     else:
         data_gen = (
             {to_camelcase(k): v for k, v in dct.items()} for dct in stop_at_empty_generator()
@@ -116,6 +120,11 @@ def import_data(url_or_id, model, sheet, limit, commit, log_level, if_newer=True
     #         last_row = row
     batch.process(data_gen, job_funcs[model], if_newer=if_newer)
     if commit and model == "topic":
-        bulk_update(Topic, kwargs["topic_factory"].topic_dict.values())
+        if committer := kwargs.get("bulk_committer"):
+            batch.commit()
+            committer.add_all(kwargs["topic_factory"].pop_touched())
+            committer.flush()
+        else:
+            bulk_update(Topic, kwargs["topic_factory"].topic_dict.values())
 
     print(batch.summary_str())